@@ -1,25 +1,62 @@
+import csv
+import heapq
 import pandas as pd
 
+COLUMNS = ['Transformer', 'ReadTimestamp', 'Delta A+[kWh]']
+
 def read_df(fname: str) -> pd.DataFrame:
     df = pd.read_csv(fname, sep=';', decimal=',')
     df['ReadTimestamp'] = pd.to_datetime(df['ReadTimestamp'])
     df.sort_values('ReadTimestamp')
-    df = df[['Transformer', 'ReadTimestamp', 'Delta A+[kWh]']]
+    df = df[COLUMNS]
     return df
 
+def read_rows(fname: str, chunksize: int = 100000):
+    '''Reads the rows of a time ordered meter export in chunks. Raises a
+    ValueError if the rows are not in time order.'''
+    last = None
+    with pd.read_csv(fname, sep=';', decimal=',', chunksize=chunksize) as reader:
+        for chunk in reader:
+            chunk['ReadTimestamp'] = pd.to_datetime(chunk['ReadTimestamp'])
+            timestamps = chunk['ReadTimestamp']
+            if len(timestamps) == 0:
+                continue
+            if not timestamps.is_monotonic_increasing or (
+                    last is not None and timestamps.iloc[0] < last):
+                raise ValueError(f'The rows of {fname} are not in time order!')
+            last = timestamps.iloc[-1]
+            yield from chunk[COLUMNS].itertuples(index=False, name=None)
+
+def _get_key(row: tuple) -> tuple:
+    '''Returns the key of a row used to find its duplicates, NaNs are equal.'''
+    return tuple(None if pd.isna(value) else value for value in row)
+
+def merge_rows(*fnames: str):
+    '''Merges the rows of the meter exports by timestamp with a heap, and drops
+    the duplicate rows on the fly. The exports have to be in time order, see
+    `read_rows`. Only the rows of the current timestamp are kept in memory.'''
+    seen, curr_time = set(), None
+    for row in heapq.merge(*map(read_rows, fnames), key=lambda row: row[1]):
+        if row[1] != curr_time:
+            seen, curr_time = set(), row[1]
+        key = _get_key(row)
+        if key not in seen:
+            seen.add(key)
+            yield row
+
 def main():
-    df1 = read_df('Sub71125.csv')
-    df2 = read_df('Sub71125_del_1_juni.csv')
-    df3 = read_df('Sub71125_16_JUNI_1JULI.csv')
-    df4 = read_df('MP71125_1_Juli_31_Juli.csv')
-
-    df = pd.concat([df1, df2, df3, df4])
-    df = df.sort_values('ReadTimestamp')
-    df = df.drop_duplicates()
-    df = df.reset_index(drop=True)
-    print(df)
-
-    df.to_csv('out.csv')
+    fnames = [
+        'Sub71125.csv',
+        'Sub71125_del_1_juni.csv',
+        'Sub71125_16_JUNI_1JULI.csv',
+        'MP71125_1_Juli_31_Juli.csv',
+    ]
+
+    with open('out.csv', 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['', *COLUMNS])
+        for idx, row in enumerate(merge_rows(*fnames)):
+            writer.writerow([idx, *row])
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,210 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+HOUR = np.timedelta64(1, 'h')
+
+def _to_utc_hours(timestamps) -> np.ndarray:
+    '''Converts timestamps into hours since the epoch. Timezone aware timestamps
+    are converted to UTC first (unlike `util._to_wall_hours`), so the hours of the
+    store are continuous across daylight saving time changes.'''
+    timestamps = pd.DatetimeIndex(timestamps)
+    if timestamps.tz is not None:
+        timestamps = timestamps.tz_convert('UTC').tz_localize(None)
+    return timestamps.to_numpy().astype('datetime64[h]').astype(np.int64)
+
+class TimeSeriesStore:
+    '''On-disk store of hourly time series, one directory per transformer. Every
+    column is a flat binary file, and row idx of each column belongs to the hour
+    `start + idx`, where `start` is kept in `meta.json` together with the number of
+    rows and the types of the columns. Hours without data are NaN.
+
+    Data is only ever appended to the end of the files, so a new monthly export
+    can be added without rewriting the existing data. Reading maps the files into
+    memory, so a time range can be accessed without loading the rest.
+    Args:
+        - root: directory of the store, created if it does not exist.'''
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _get_dir(self, transformer) -> str:
+        return os.path.join(self.root, str(transformer))
+
+    def _read_meta(self, transformer) -> dict:
+        path = os.path.join(self._get_dir(transformer), 'meta.json')
+        if not os.path.exists(path):
+            raise KeyError(f'Unknown transformer: {transformer}')
+        with open(path) as file:
+            return json.load(file)
+
+    def _write_meta(self, transformer, meta: dict):
+        # the meta file is replaced atomically, so the rows written after a
+        # failed append are ignored
+        path = os.path.join(self._get_dir(transformer), 'meta.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(meta, file, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def get_transformers(self) -> list[str]:
+        '''Returns the ids of the transformers in the store.'''
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.exists(os.path.join(self.root, name, 'meta.json')))
+
+    def get_range(self, transformer) -> tuple[np.datetime64, np.datetime64]:
+        '''Returns the first hour and the hour after the last one of a transformer.'''
+        meta = self._read_meta(transformer)
+        start = np.datetime64(meta['start'], 'h')
+        return start, start + meta['length'] * HOUR
+
+    def append(self, transformer, df: pd.DataFrame,
+               columns=('net', 'price (cents/kWh)')) -> int:
+        '''Appends the rows of a DataFrame to the series of a transformer. The
+        timestamps are floored to the hour, and for several rows in the same hour
+        the last one is kept. Rows before the end of the stored series are
+        ignored, and the hours between the end and the first new row are NaN.
+        Args:
+            - transformer: id of the transformer.
+            - df: pandas.DataFrame with a `timestamp` column and the columns.
+            - columns: names of the value columns. They have to be the same for
+                every append of a transformer.
+        Returns: the number of new rows (hours) in the store.'''
+        hours = _to_utc_hours(df['timestamp'])
+        order = np.argsort(hours, kind='stable')
+        hours = hours[order]
+        # last row of each hour
+        last = np.append(hours[1:] != hours[:-1], True)
+        hours = hours[last]
+        values = {col: df[col].to_numpy(dtype=float)[order][last] for col in columns}
+
+        dirname = self._get_dir(transformer)
+        try:
+            meta = self._read_meta(transformer)
+        except KeyError:
+            if hours.size == 0:
+                return 0
+            os.makedirs(dirname, exist_ok=True)
+            meta = {
+                'start': str(np.datetime64(int(hours[0]), 'h')),
+                'length': 0,
+                'columns': [{'name': col, 'file': f'{idx}.bin', 'dtype': '<f8'}
+                            for idx, col in enumerate(columns)],
+            }
+        if [col['name'] for col in meta['columns']] != list(columns):
+            raise ValueError(f'Columns {list(columns)} do not match the stored ' +
+                             f'columns of transformer {transformer}!')
+
+        start = np.datetime64(meta['start'], 'h').astype(np.int64)
+        end = start + meta['length']
+        keep = hours >= end
+        if not np.any(keep):
+            return 0
+        hours = hours[keep]
+        length = int(hours[-1] - end + 1)
+
+        for col in meta['columns']:
+            data = np.full(length, np.nan, dtype=col['dtype'])
+            data[hours - end] = values[col['name']][keep]
+            path = os.path.join(dirname, col['file'])
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as file:
+                # drop what an interrupted append may have left after the end
+                file.truncate(meta['length'] * data.itemsize)
+                file.seek(0, os.SEEK_END)
+                file.write(data.tobytes())
+
+        meta['length'] += length
+        self._write_meta(transformer, meta)
+        return length
+
+    def open(self, transformer, start=None, end=None,
+             allow_missing: bool = True) -> pd.DataFrame:
+        '''Returns the hours in [start, end) of a transformer as a DataFrame with a
+        `timestamp` column and the stored columns. The value columns are views of
+        the memory-mapped files, they are not copied and are read-only.
+        Args:
+            - transformer: id of the transformer.
+            - start: first hour of the range, the beginning of the series if None.
+            - end: end of the range (exclusive), the end of the series if None.
+            - allow_missing: if False, a ValueError is raised if the range has
+                hours without data (NaN values), e.g. for the simulations, which
+                do not handle them.'''
+        meta = self._read_meta(transformer)
+        first = np.datetime64(meta['start'], 'h').astype(np.int64)
+        idxfrom = 0 if start is None else int(_to_utc_hours([start])[0] - first)
+        idxto = meta['length'] if end is None else int(_to_utc_hours([end])[0] - first)
+        idxfrom = min(max(idxfrom, 0), meta['length'])
+        idxto = min(max(idxto, idxfrom), meta['length'])
+
+        timestamps = (np.datetime64(meta['start'], 'h') +
+                      np.arange(idxfrom, idxto) * HOUR).astype('datetime64[ns]')
+        data = {'timestamp': timestamps}
+        for col in meta['columns']:
+            if meta['length'] == 0:
+                data[col['name']] = np.empty(0, dtype=col['dtype'])
+                continue
+            path = os.path.join(self._get_dir(transformer), col['file'])
+            values = np.memmap(path, dtype=col['dtype'], mode='r',
+                               shape=(meta['length'],))
+            data[col['name']] = values[idxfrom:idxto]
+        df = pd.DataFrame(data, copy=False)
+        if not allow_missing:
+            missing = df[[col['name'] for col in meta['columns']]].isna().any(axis=1)
+            if missing.any():
+                raise ValueError(f'{int(missing.sum())} hours of transformer ' +
+                                 f'{transformer} have no data, the first one is ' +
+                                 f'{df["timestamp"][missing].iloc[0]}!')
+        return df
+
+if __name__ == '__main__':
+    import tempfile
+    import unittest
+
+    class TestTimeSeriesStore(unittest.TestCase):
+        def _get_df(self, start: str, size: int) -> pd.DataFrame:
+            timestamps = pd.date_range(start, periods=size, freq='h')
+            return pd.DataFrame({'timestamp': timestamps,
+                                 'net': np.arange(size, dtype=float),
+                                 'price (cents/kWh)': np.ones(size)})
+
+        def test1(self):
+            with tempfile.TemporaryDirectory() as root:
+                store = TimeSeriesStore(root)
+                self.assertEqual(store.append(71125, self._get_df('2021-06-01', 48)), 48)
+                # overlapping rows are skipped, the gap is filled with NaN
+                df = self._get_df('2021-06-02', 72)
+                df = df.drop(index=[30, 31])
+                self.assertEqual(store.append(71125, df), 48)
+                self.assertEqual(store.get_transformers(), ['71125'])
+
+                df = store.open(71125)
+                self.assertEqual(len(df), 96)
+                self.assertTrue(np.all(np.diff(df['timestamp']) == HOUR))
+                self.assertEqual(np.isnan(df['net']).sum(), 2)
+                with self.assertRaises(ValueError):
+                    store.open(71125, allow_missing=False)
+                self.assertEqual(len(store.open(71125, end='2021-06-03 06:00',
+                                                allow_missing=False)), 54)
+
+                df = store.open('71125', '2021-06-03 05:00', '2021-06-04')
+                self.assertEqual(len(df), 19)
+                self.assertEqual(df['timestamp'].iloc[0],
+                                 pd.Timestamp('2021-06-03 05:00'))
+                self.assertEqual(df['net'].iloc[0], 29)
+                # the column is a view of the mapped file
+                base = df['net'].to_numpy()
+                while base.base is not None and isinstance(base.base, np.ndarray):
+                    base = base.base
+                self.assertIsInstance(base, np.memmap)
+
+        def test2(self):
+            with tempfile.TemporaryDirectory() as root:
+                store = TimeSeriesStore(root)
+                store.append('a', self._get_df('2021-06-01', 5))
+                with self.assertRaises(ValueError):
+                    store.append('a', self._get_df('2021-06-02', 5), columns=['net'])
+                with self.assertRaises(KeyError):
+                    store.open('b')
+
+    unittest.main()
@@ -6,7 +6,8 @@ import pandas as pd
 
 from ..common.batteries import EnergyHub
 from ..common.battery import IdealBattery
-from ..common.util import process_file
+from ..common.util import process_file, infer_tdelta
+from ..common.timeseries import TimeSeriesStore
 
 MAXSOC = 100
 class EhubEnv(gym.Env):
@@ -23,8 +24,13 @@ class EhubEnv(gym.Env):
                                        high=np.array([366, 24, MAXSOC, float('inf')]))
         })
         self.df_length = None
-        self.df = self._load_file(config['filename'])
-        self.ehub = EnergyHub(config['ehub_config'])
+        if 'store' in config:
+            self.df = self._load_store(config['store'], config['transformer'],
+                                       config.get('start'), config.get('end'))
+        else:
+            self.df = self._load_file(config['filename'])
+        # the hub steps as long as the rows of the data unless set otherwise
+        self.ehub = EnergyHub(dict({'tdelta': self.tdelta}, **config['ehub_config']))
         self.trafo_maxpower = config['trafo_max_power']
         self.trafo_nompower = config['trafo_nominal_power']
         self.eval_mode = config['eval_mode']
@@ -38,7 +44,8 @@ class EhubEnv(gym.Env):
         return self._get_observation()
 
     def step(self, action):
-        '''Makes one step in the environment. Currently this step is 1-hour in time.
+        '''Makes one step in the environment. The step is as long as a row of the
+        data, `tdelta` hours.
         Args:
             - action: int, selecting the action. Use the `action_mask` from the
                       observation dict to see what are the possible actions in the
@@ -103,11 +110,26 @@ class EhubEnv(gym.Env):
         print(f'Loading from {fname}')
         
         df = process_file(fname)
+        return self._get_observed_columns(df)
+
+    def _load_store(self, root: str, transformer, start=None, end=None) -> pd.DataFrame:
+        '''Loads the hours in [start, end) of a transformer from a `TimeSeriesStore`.
+        Only the range is read from the memory-mapped store, the observed columns
+        are copied into a new DataFrame. The range must not have hours without
+        data.'''
+        print(f'Loading transformer {transformer} from {root}')
+
+        df = TimeSeriesStore(root).open(transformer, start, end, allow_missing=False)
+        return self._get_observed_columns(df)
+
+    def _get_observed_columns(self, df: pd.DataFrame) -> pd.DataFrame:
         self.df_length = len(df)
+        self.tdelta = infer_tdelta(df['timestamp'])
 
-        # convert ['timestamp'] to ['day', 'hour']
+        # convert ['timestamp'] to ['day', 'hour'], the hour is fractional for
+        # sub-hourly data
         df['day'] = df['timestamp'].dt.day_of_year.astype(float)
-        df['hour'] = df['timestamp'].dt.hour.astype(float)
+        df['hour'] = (df['timestamp'].dt.hour + df['timestamp'].dt.minute / 60).astype(float)
 
         df = df[['day', 'hour', 'net']]
         return df
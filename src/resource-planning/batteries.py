@@ -3,7 +3,7 @@ import os
 from re import L
 import yaml
 import numpy as np
-from util import chop
+from util import chop, PriceIndex
 
 CONFIG = None
 CONFFILE = '/batteries.yaml'
@@ -23,6 +23,7 @@ class Battery(ABC):
     etacharge = None
     etadischarge = None
     selfdischarge = None # 1/month
+    count = 1 # number of identical units represented by the object
 
     @abstractmethod
     def __init__(self) -> None:
@@ -70,6 +71,17 @@ class Battery(ABC):
     def get_maxsoc(self):
         return self.maxsoc
 
+    def aggregate(self, count):
+        '''Makes this object represent `count` identical units filled in sequence,
+        by scaling the capacity, the power limits and the costs by `count`. The
+        self-discharge is proportional to the soc, so it needs no scaling.'''
+        self.count = count
+        self.maxsoc = self.maxsoc * count
+        self.maxcharge = self.maxcharge * count
+        self.maxdischarge = self.maxdischarge * count
+        self.capex = self.capex * count
+        self.opex = self.opex * count
+
     def charge(self, pdemand, tdelta=1):
         '''Use pdemand (or a portion of it) to charge the battery.
         Args:
@@ -87,7 +99,7 @@ class Battery(ABC):
         #     print('Charging LiIonBattery')
 
         # self-discharge always happens
-        sdcharge = self._selfdischarge()
+        sdcharge = self._selfdischarge(tdelta)
 
         penalty = 0
         prev_soc = self.soc
@@ -110,7 +122,9 @@ class Battery(ABC):
         premain = pdemand - pcharge
 
         if isinstance(self, LiIonBattery):
-            penalty = (prev_soc - self.soc) ** 2
+            penalty = self._penalty(self.soc - prev_soc,
+                                    self.etacharge * (self.maxcharge / self.count * tdelta),
+                                    tdelta)
 
         return pcharge, premain, sdcharge, penalty
 
@@ -127,7 +141,7 @@ class Battery(ABC):
         assert pdemand >= 0
 
         # self-discharge always happens
-        sdcharge = self._selfdischarge()
+        sdcharge = self._selfdischarge(tdelta)
 
         penalty = 0
         prev_soc = self.soc
@@ -146,19 +160,48 @@ class Battery(ABC):
         premain = chop(pdemand - pdischarge * self.etadischarge)
 
         if isinstance(self, LiIonBattery):
-            penalty += (self.soc - prev_soc) ** 2
+            penalty += self._penalty(self.soc - prev_soc,
+                                     self.etadischarge * (self.maxdischarge / self.count * tdelta),
+                                     tdelta)
 
         return pdischarge, premain, sdcharge, penalty
 
-    def _selfdischarge(self):
-        sdcharge = self.selfdischarge * self.soc
+    def get_selfdischarge_rate(self, tdelta=1):
+        '''Returns the fraction of the soc lost to self-discharge during tdelta
+        hours. `selfdischarge` is the rate of a one hour step.'''
+        if tdelta == 1:
+            return self.selfdischarge
+        return 1 - (1 - self.selfdischarge) ** tdelta
+
+    def _selfdischarge(self, tdelta=1):
+        sdcharge = self.get_selfdischarge_rate(tdelta) * self.soc
         self.soc = self.soc - sdcharge
         return sdcharge
 
+    def _penalty(self, deltasoc, unit_deltasoc, tdelta=1):
+        '''Penalty signal for changing the soc by deltasoc. The units of an
+        aggregated battery are penalized as in the cascade, where they are
+        charged one after the other, each by at most unit_deltasoc. The penalty
+        is divided by tdelta, so it does not shrink with shorter steps.'''
+        full, rest = divmod(abs(deltasoc), unit_deltasoc)
+        return (full * unit_deltasoc ** 2 + rest ** 2) / tdelta
+
     def do_nothing(self, tdelta=1):
-        sdcharge = self._selfdischarge()
+        sdcharge = self._selfdischarge(tdelta)
         return 0, 0, sdcharge
 
+    def idle(self, steps, tdelta=1):
+        '''Applies the self-discharge of `steps` consecutive `do_nothing` calls in
+        closed form: soc * (1 - r)^k.
+        Returns:
+            - socs: array containing the soc after each step
+            - sdcharge: the total amount of self-discharge'''
+        rate = self.get_selfdischarge_rate(tdelta)
+        socs = self.soc * (1 - rate) ** np.arange(1, steps + 1)
+        sdcharge = self.soc - socs[-1]
+        self.soc = socs[-1]
+        return socs, sdcharge
+
     def power_to_max(self) -> float:
         '''Returns the amount of power needed to charge up this battery to
         the max.'''
@@ -202,7 +245,10 @@ class EnergyHub:
         '''Initialize energy storage hub containing multiple batteries.
         params:
             - config: dict containing the following keys:
-              {`LiIonBattery`, `Flywheel`, `Supercapacitor`}'''
+              {`LiIonBattery`, `Flywheel`, `Supercapacitor`}, and optionally
+              `aggregate`: if True, the units of the same type are represented
+              by a single scaled unit (see `Battery.aggregate`), and
+              `tdelta`: length of a simulation step in hours (1 by default)'''
         
         if __debug__:
             print(f'{os.path.basename(__file__)}: EnergyHub initialized with config: {config}')
@@ -210,27 +256,40 @@ class EnergyHub:
         self.liion_cnt = config['LiIonBattery']
         self.flywh_cnt = config['Flywheel']
         self.sucap_cnt = config['Supercapacitor']
+        self.aggregate = config.get('aggregate', False)
+        self.tdelta = config.get('tdelta', 1)
         self.storages = [] # type: list[Battery]
 
         self._init_batteries()
 
+    def _storage_types(self) -> list[tuple[type, int]]:
+        '''Returns the storage types in the order they are charged/discharged,
+        with the number of units represented by each object of the hub.'''
+        counts = [(Supercapacitor, self.sucap_cnt),
+                  (Flywheel, self.flywh_cnt),
+                  (LiIonBattery, self.liion_cnt)]
+        if self.aggregate:
+            return [(cls, count) for cls, count in counts if count > 0]
+        return [(cls, 1) for cls, count in counts for _ in range(count)]
+
     def _init_batteries(self):
-        for _ in range(self.sucap_cnt):
-            self.storages.append(Supercapacitor())
-        for _ in range(self.flywh_cnt):
-            self.storages.append(Flywheel())
-        for _ in range(self.liion_cnt):
-            self.storages.append(LiIonBattery())
+        for cls, count in self._storage_types():
+            battery = cls()
+            if count > 1:
+                battery.aggregate(count)
+            self.storages.append(battery)
     
-    def charge(self, pdemand, tdelta=1):
+    def charge(self, pdemand, tdelta=None):
         '''Attempts to charge batteries in the storage in order.
         Args:
             - pdemand: demand load in kW, the amount of power we want to store
             - tdelta: time duration for which charging power should be applied
-                      (in hour)
+                      (in hour), the `tdelta` of the hub by default
         Returns:
             - total amount charged (in kW)
             - total charge lost to self-discharge (in kW)'''
+        if tdelta is None:
+            tdelta = self.tdelta
 
         total_charge = 0
         total_selfdischarge = 0
@@ -243,16 +302,19 @@ class EnergyHub:
 
         return total_charge, total_selfdischarge, total_penalty
 
-    def discharge(self, pdemand, tdelta=1):
+    def discharge(self, pdemand, tdelta=None):
         '''Attempts to discharge batteries in the storage in order.
         Args:
             - pdemand: demand load in kW, the amount of power we want to store
             - tdelta: time duration for which charging power should be applied
-                      (in hour)
+                      (in hour), the `tdelta` of the hub by default
         Returns:
             - total amount charged (in kW)
             - total charge lost to self-discharge (in kW)
         '''
+        if tdelta is None:
+            tdelta = self.tdelta
+
         total_discharge = 0
         total_selfdischarge = 0
         total_penalty = 0
@@ -263,13 +325,34 @@ class EnergyHub:
             total_penalty += penalty
         return total_discharge, total_selfdischarge, total_penalty
 
-    def do_nothing(self):
+    def do_nothing(self, tdelta=None):
+        if tdelta is None:
+            tdelta = self.tdelta
+
         total_selfdischarge = 0
         for battery in self.storages:
-            _, _, sdcharge = battery.do_nothing()
+            _, _, sdcharge = battery.do_nothing(tdelta)
             total_selfdischarge += sdcharge
         return 0, 0, total_selfdischarge
 
+    def idle(self, steps, tdelta=None):
+        '''Lets the batteries self-discharge for `steps` consecutive steps without
+        charging or discharging them. Equivalent to calling `do_nothing` `steps`
+        times.
+        Returns:
+            - socs: array containing the total state-of-charge after each step
+            - total_selfdischarge: total charge lost to self-discharge (in kW)'''
+        if tdelta is None:
+            tdelta = self.tdelta
+
+        socs = np.zeros(steps)
+        total_selfdischarge = 0
+        for battery in self.storages:
+            battery_socs, sdcharge = battery.idle(steps, tdelta)
+            socs += battery_socs
+            total_selfdischarge += sdcharge
+        return socs, total_selfdischarge
+
     def get_soc(self):
         '''Returns the total state-of-charge of all batteries (in kWh).'''
         return sum(battery.get_soc() for battery in self.storages)
@@ -325,15 +408,21 @@ class EnergyHub:
         self.load_soc(soc_list)
         return hours
 
-    def find_next_charge_time(self, price_list, treserve):
+    def find_next_charge_time(self, price_list, treserve, start=0):
         '''
         Args:
-            - price_list: list of electricity prices
+            - price_list: list of electricity prices, or a `PriceIndex` built
+                on the prices of the whole dataset
             - treserve: amount of time the energyhub would last if it was full
+            - start: position of the current price in price_list
+        Returns:
+            - the number of hours from start until the cheapest price within
+              the reserve time
         '''
-        curr_price = price_list[0]
-        end = min(len(price_list), treserve + 1)
-        min_idx = np.argmin(price_list[:end])
+        end = min(len(price_list), start + treserve + 1)
+        if isinstance(price_list, PriceIndex):
+            return price_list.argmin(start, end) - start
+        min_idx = np.argmin(price_list[start:end])
         return min_idx
 
     def power_until(self, tstep, pnet_list):
@@ -355,9 +444,385 @@ class EnergyHub:
         for idx, battery in enumerate(self.storages):
             battery.soc = soc_list[idx]
 
+class ArrayEnergyHub(EnergyHub):
+    '''Energy hub that keeps the parameters and the state of its storage units in
+    NumPy arrays instead of a list of `Battery` objects. The units are filled and
+    drained in the same order as in `EnergyHub`, but a charge/discharge step is
+    computed for all units at once with cumulative sums, so the cost of a step
+    does not grow with the number of units.'''
+
+    def _init_batteries(self):
+        units = self._storage_types()
+        types = [cls for cls, _ in units]
+
+        def attribute(name):
+            return np.array([getattr(cls, name) for cls in types], dtype=float)
+
+        self.count = np.array([count for _, count in units], dtype=float)
+        self.soc = np.zeros(len(types))
+        self.minsoc = attribute('minsoc')
+        self.maxsoc = attribute('maxsoc') * self.count
+        self.maxcharge = attribute('maxcharge') * self.count
+        self.maxdischarge = attribute('maxdischarge') * self.count
+        self.etacharge = attribute('etacharge')
+        self.etadischarge = attribute('etadischarge')
+        self.selfdischarge = attribute('selfdischarge')
+        self.step_selfdischarge = {} # self-discharge rates by step length
+        self.capex = attribute('capex') * self.count
+        self.opex = attribute('opex') * self.count
+        self.lifetime = attribute('lifetime')
+        self.unitmaintenance = attribute('unitmaintenance')
+        self.is_liion = np.array([cls is LiIonBattery for cls in types], dtype=bool)
+
+    @staticmethod
+    def _cascade(pdemand, limits):
+        '''Distributes pdemand over the units in order, each unit taking at most
+        its limit. Returns the share of each unit.'''
+        before = np.cumsum(limits) - limits
+        return np.clip(pdemand - before, 0, limits)
+
+    def _get_selfdischarge_rates(self, tdelta):
+        '''Returns the self-discharge rates of the units for a step of tdelta
+        hours, computed once for each step length.'''
+        rates = self.step_selfdischarge.get(tdelta)
+        if rates is None:
+            rates = (self.selfdischarge if tdelta == 1 else
+                     1 - (1 - self.selfdischarge) ** tdelta)
+            self.step_selfdischarge[tdelta] = rates
+        return rates
+
+    def _selfdischarge(self, tdelta):
+        sdcharge = self._get_selfdischarge_rates(tdelta) * self.soc
+        self.soc = self.soc - sdcharge
+        return sdcharge.sum()
+
+    def _penalty(self, deltasoc, unit_deltasoc, tdelta=1):
+        '''Vectorized `Battery._penalty` summed over the Li-ion units.'''
+        full, rest = np.divmod(np.abs(deltasoc[self.is_liion]),
+                               unit_deltasoc[self.is_liion])
+        return np.sum(full * unit_deltasoc[self.is_liion] ** 2 + rest ** 2) / tdelta
+
+    def charge(self, pdemand, tdelta=None):
+        '''Attempts to charge batteries in the storage in order. See
+        `EnergyHub.charge` for the arguments and the returned values.'''
+        assert pdemand >= 0
+        if tdelta is None:
+            tdelta = self.tdelta
+
+        total_selfdischarge = self._selfdischarge(tdelta)
+        if pdemand == 0 or self.soc.size == 0:
+            return 0, total_selfdischarge, 0
+
+        # the most each unit can take: limited by max charging power and max soc
+        limits = np.minimum(self.maxcharge,
+                            (self.maxsoc - self.soc) / self.etacharge / tdelta)
+        pcharge = self._cascade(pdemand, limits)
+
+        deltasoc = self.etacharge * (pcharge * tdelta)
+        self.soc = np.minimum(self.soc + deltasoc, self.maxsoc)
+
+        total_charge = pcharge.sum()
+        total_penalty = self._penalty(
+            deltasoc, self.etacharge * (self.maxcharge / self.count * tdelta), tdelta)
+        return total_charge, total_selfdischarge, total_penalty
+
+    def discharge(self, pdemand, tdelta=None):
+        '''Attempts to discharge batteries in the storage in order. See
+        `EnergyHub.discharge` for the arguments and the returned values.'''
+        assert pdemand >= 0
+        if tdelta is None:
+            tdelta = self.tdelta
+
+        total_selfdischarge = self._selfdischarge(tdelta)
+        if pdemand == 0 or self.soc.size == 0:
+            return 0, total_selfdischarge, 0
+
+        # the most power each unit can deliver after the discharge losses
+        limits = self.etadischarge * np.minimum(self.maxdischarge,
+                                                (self.soc - self.minsoc) / tdelta)
+        pdelivered = self._cascade(pdemand, limits)
+        pdischarge = pdelivered / self.etadischarge
+
+        deltasoc = self.etadischarge * (pdischarge * tdelta)
+        soc = self.soc - deltasoc
+        # same as calling `chop` on every unit
+        soc[np.abs(soc) <= 1e-10] = 0
+        self.soc = np.maximum(soc, self.minsoc)
+
+        total_penalty = self._penalty(
+            deltasoc, self.etadischarge * (self.maxdischarge / self.count * tdelta),
+            tdelta)
+        return pdischarge.sum(), total_selfdischarge, total_penalty
+
+    def do_nothing(self, tdelta=None):
+        return 0, 0, self._selfdischarge(self.tdelta if tdelta is None else tdelta)
+
+    def idle(self, steps, tdelta=None):
+        '''Lets the batteries self-discharge for `steps` consecutive steps. See
+        `EnergyHub.idle`.'''
+        rates = self._get_selfdischarge_rates(self.tdelta if tdelta is None else tdelta)
+        decay = (1 - rates)[:, np.newaxis] ** np.arange(1, steps + 1)
+        socs = self.soc[:, np.newaxis] * decay
+        total_selfdischarge = np.sum(self.soc - socs[:, -1])
+        self.soc = socs[:, -1]
+        return socs.sum(axis=0), total_selfdischarge
+
+    def get_soc(self):
+        '''Returns the total state-of-charge of all batteries (in kWh).'''
+        return self.soc.sum()
+
+    def get_maxsoc(self):
+        '''Returns the total maximum state-of-charge of all batteries (in kWh).'''
+        return self.maxsoc.sum()
+
+    def reset(self):
+        self.soc = np.zeros_like(self.maxsoc)
+
+    def power_to_max(self):
+        '''Returns the amount of power necessary to charge the whole ehub to max.'''
+        return np.sum((self.maxsoc - self.soc) / self.etacharge)
+
+    def compute_full_reserve(self, pnet_list):
+        '''Given a list of power demands, computes, how long would we last if the
+        batteries were full.
+        Args:
+            - pnet_list: list of power demands
+        Returns:
+            - hours: '''
+        soc_list = self.save_soc()
+
+        self.soc = self.maxsoc.copy()
+        hours = self.compute_reserve_time(pnet_list)
+
+        self.load_soc(soc_list)
+        return hours
+
+    def get_capex(self, t) -> float:
+        return np.sum(self.capex / self.lifetime * t)
+
+    def get_opex(self, t) -> float:
+        return np.sum(self.opex / self.unitmaintenance * t)
+
+    def save_soc(self) -> list[float]:
+        return self.soc.tolist()
+
+    def load_soc(self, soc_list: list[float]):
+        self.soc = np.array(soc_list, dtype=float)
+
+class PopulationEnergyHub:
+    '''Energy hubs of a population of battery configurations, advanced together.
+    The state-of-charge of the units is a (configs, units) array, and like in
+    `ArrayEnergyHub`, the units of each hub are charged and discharged in order
+    with cumulative sums, so a step of the whole population costs a few array
+    operations.
+    Args:
+        - counts: (configs, 3) array with the number of Li-ion batteries,
+            flywheels and supercapacitors of each configuration.
+        - aggregate: see `EnergyHub`. If False, every unit has a column, and the
+            configurations with fewer units of a type have empty columns.
+        - tdelta: length of a simulation step in hours.'''
+
+    def __init__(self, counts, aggregate=False, tdelta=1) -> None:
+        counts = np.asarray(counts, dtype=int).reshape(-1, 3)
+        # the storage types in the order of `EnergyHub._storage_types`
+        type_counts = {Supercapacitor: counts[:, 2],
+                       Flywheel: counts[:, 1],
+                       LiIonBattery: counts[:, 0]}
+        types, columns = [], []
+        for cls, count in type_counts.items():
+            if aggregate:
+                types.append(cls)
+                columns.append(count)
+            else:
+                for idx in range(count.max(initial=0)):
+                    types.append(cls)
+                    columns.append(count > idx)
+
+        def attribute(name):
+            return np.array([getattr(cls, name) for cls in types], dtype=float)
+
+        self.tdelta = tdelta
+        self.count = np.array(columns, dtype=float).reshape(len(types), len(counts)).T
+        self.minsoc = attribute('minsoc')
+        self.maxsoc = attribute('maxsoc') * self.count
+        self.maxcharge = attribute('maxcharge') * self.count
+        self.maxdischarge = attribute('maxdischarge') * self.count
+        self.etacharge = attribute('etacharge')
+        self.etadischarge = attribute('etadischarge')
+        selfdischarge = attribute('selfdischarge')
+        self.selfdischarge = (selfdischarge if tdelta == 1 else
+                              1 - (1 - selfdischarge) ** tdelta)
+        self.capex = attribute('capex') / attribute('lifetime') * self.count
+        self.opex = attribute('opex') / attribute('unitmaintenance') * self.count
+        self.is_liion = np.array([cls is LiIonBattery for cls in types], dtype=bool)
+        # the soc change of a single unit at full power, see `Battery._penalty`
+        self.unit_charge = (self.etacharge * (attribute('maxcharge') * tdelta))[self.is_liion]
+        self.unit_discharge = (self.etadischarge *
+                               (attribute('maxdischarge') * tdelta))[self.is_liion]
+        self.reset()
+
+    def __len__(self):
+        return self.count.shape[0]
+
+    def reset(self):
+        self.soc = np.zeros_like(self.maxsoc)
+
+    def get_soc(self) -> np.ndarray:
+        '''Returns the total state-of-charge of each hub (in kWh).'''
+        return self.soc.sum(axis=1)
+
+    def get_maxsoc(self) -> np.ndarray:
+        return self.maxsoc.sum(axis=1)
+
+    def select(self, rows):
+        '''Keeps only the hubs of the given rows, e.g. to stop simulating some of
+        the configurations. The units (columns) are not changed.'''
+        for name in ('count', 'maxsoc', 'maxcharge', 'maxdischarge', 'capex', 'opex',
+                     'soc'):
+            setattr(self, name, getattr(self, name)[rows])
+
+    def get_unit_soc(self, idx: int) -> np.ndarray:
+        '''Returns the state-of-charge of the units of hub idx, without its empty
+        columns, so it can be restored in a population of other configurations.'''
+        return self.soc[idx, self.count[idx] > 0].copy()
+
+    def set_unit_soc(self, idx: int, soc):
+        '''Restores the state-of-charge of the units of hub idx, see `get_unit_soc`.'''
+        self.soc[idx, self.count[idx] > 0] = soc
+
+    def get_capex(self, t) -> np.ndarray:
+        return self.capex.sum(axis=1) * t
+
+    def get_opex(self, t) -> np.ndarray:
+        return self.opex.sum(axis=1) * t
+
+    def _penalty(self, deltasoc, unit_deltasoc) -> np.ndarray:
+        '''Vectorized `Battery._penalty` summed over the Li-ion units of each hub.'''
+        full, rest = np.divmod(np.abs(deltasoc[:, self.is_liion]), unit_deltasoc)
+        return (full * unit_deltasoc ** 2 + rest ** 2).sum(axis=1) / self.tdelta
+
+    def exchange(self, pcharge, pdischarge):
+        '''Makes a step of every hub: the batteries self-discharge, and then they
+        are charged with pcharge and discharged by pdischarge. For a single hub
+        this is the same as calling `charge` or `discharge` (or `do_nothing` if
+        both are zero) of `ArrayEnergyHub`.
+        Args:
+            - pcharge: array of the power to store in each hub (in kW)
+            - pdischarge: array of the power demanded from each hub (in kW), zero
+                where pcharge is positive
+        Returns:
+            - total_charge: array of the power charged into each hub (in kW)
+            - total_discharge: array of the power discharged from each hub (in kW)
+            - total_penalty: array of the penalties of the Li-ion batteries'''
+        tdelta = self.tdelta
+        soc = self.soc - self.selfdischarge * self.soc
+
+        # the most each unit can take: limited by max charging power and max soc
+        limits = np.minimum(self.maxcharge, (self.maxsoc - soc) / self.etacharge / tdelta)
+        before = limits.cumsum(axis=1) - limits
+        charged = np.minimum(np.maximum(pcharge[:, np.newaxis] - before, 0), limits)
+        chargesoc = self.etacharge * (charged * tdelta)
+        soc = np.minimum(soc + chargesoc, self.maxsoc)
+
+        # the most power each unit can deliver after the discharge losses
+        limits = self.etadischarge * np.minimum(self.maxdischarge,
+                                                (soc - self.minsoc) / tdelta)
+        before = limits.cumsum(axis=1) - limits
+        discharged = np.minimum(np.maximum(pdischarge[:, np.newaxis] - before, 0),
+                                limits) / self.etadischarge
+        dischargesoc = self.etadischarge * (discharged * tdelta)
+        soc = soc - dischargesoc
+        # same as calling `chop` on every discharged unit
+        soc[(np.abs(soc) <= 1e-10) & (pdischarge > 0)[:, np.newaxis]] = 0
+        self.soc = np.maximum(soc, self.minsoc)
+
+        total_penalty = (self._penalty(chargesoc, self.unit_charge) +
+                         self._penalty(dischargesoc, self.unit_discharge))
+        return charged.sum(axis=1), discharged.sum(axis=1), total_penalty
+
+    def idle(self, steps):
+        '''Lets the batteries of every hub self-discharge for `steps` steps.
+        Returns: (configs, steps) array of the total state-of-charge of each hub
+            after each step.'''
+        decay = (1 - self.selfdischarge)[:, np.newaxis] ** np.arange(1, steps + 1)
+        socs = self.soc @ decay
+        self.soc = self.soc * decay[:, -1]
+        return socs
+
+def test_aggregated_hub():
+    '''Compares the aggregated storage mode against the per-unit cascade on a
+    synthetic daily demand curve with peak-shaving limits.'''
+    rng = np.random.default_rng(0)
+    pnets = 2000 + 1500 * np.sin(np.arange(2000) * 2 * np.pi / 24)
+    pnets += rng.normal(0, 300, pnets.size)
+    lowerlim, upperlim = 1500, 2500
+
+    for HubClass in (EnergyHub, ArrayEnergyHub):
+        for config in ({'LiIonBattery': 9, 'Flywheel': 9, 'Supercapacitor': 9},
+                       {'LiIonBattery': 4, 'Flywheel': 0, 'Supercapacitor': 2}):
+            cascade = HubClass(config)
+            aggregated = HubClass(dict(config, aggregate=True))
+            assert np.isclose(cascade.get_maxsoc(), aggregated.get_maxsoc())
+            assert np.isclose(cascade.get_capex(100), aggregated.get_capex(100))
+
+            totals = np.zeros((2, 3))
+            max_socdiff = 0
+            for pnet in pnets:
+                for row, ehub in enumerate((cascade, aggregated)):
+                    if pnet > upperlim:
+                        results = ehub.discharge(pnet - upperlim)
+                    elif pnet < lowerlim:
+                        results = ehub.charge(lowerlim - pnet)
+                    else:
+                        results = ehub.do_nothing()
+                    totals[row] += results[:3]
+                socdiff = abs(cascade.get_soc() - aggregated.get_soc())
+                max_socdiff = max(max_socdiff, socdiff / cascade.get_maxsoc())
+
+            # the same energy goes through the hub, only its distribution
+            # between the units differs
+            assert np.allclose(totals[0, :2], totals[1, :2], rtol=1e-3)
+            assert max_socdiff < 0.1
+            assert np.isclose(totals[0, 2], totals[1, 2], rtol=0.15)
+
+def test_population_hub():
+    '''Compares the hubs of a population against separate `ArrayEnergyHub`s.'''
+    rng = np.random.default_rng(0)
+    pnets = 2000 + 1500 * np.sin(np.arange(500) * 2 * np.pi / 24)
+    pnets += rng.normal(0, 300, pnets.size)
+    counts = np.array([[9, 9, 9], [4, 0, 2], [0, 0, 0], [1, 3, 0]])
+    lowerlims = np.array([1500, 1000, 1500, 1800])
+    upperlims = np.array([2500, 3000, 2500, 2200])
+
+    for aggregate in (False, True):
+        population = PopulationEnergyHub(counts, aggregate)
+        hubs = [ArrayEnergyHub({'LiIonBattery': liion_cnt, 'Flywheel': flywh_cnt,
+                                'Supercapacitor': sucap_cnt, 'aggregate': aggregate})
+                for liion_cnt, flywh_cnt, sucap_cnt in counts]
+        assert np.allclose(population.get_capex(100), [hub.get_capex(100) for hub in hubs])
+        for pnet in pnets:
+            pdischarge = np.maximum(pnet - upperlims, 0)
+            pcharge = np.maximum(lowerlims - pnet, 0)
+            results = np.array(population.exchange(pcharge, pdischarge)).T
+            for hub, row, lowerlim, upperlim in zip(hubs, results, lowerlims, upperlims):
+                if pnet > upperlim:
+                    expected = (0, *hub.discharge(pnet - upperlim)[::2])
+                elif pnet < lowerlim:
+                    charge, _, penalty = hub.charge(lowerlim - pnet)
+                    expected = (charge, 0, penalty)
+                else:
+                    expected = (0, 0, 0)
+                    hub.do_nothing()
+                assert np.allclose(row, expected)
+            assert np.allclose(population.get_soc(), [hub.get_soc() for hub in hubs])
+
+        socs = population.idle(5)
+        for hub, soc in zip(hubs, socs):
+            assert np.allclose(hub.idle(5)[0], soc)
+
 def test():
-    #TODO
-    pass
+    test_aggregated_hub()
+    test_population_hub()
 
 if __name__ == '__main__':
     test()
@@ -1,16 +1,279 @@
-import pandas as pd
-from scipy.optimize import brute
-from objective import objective
-
-DF = pd.read_csv('../data/full.csv')
-def fitness(sol):
-    liion_cnt = sol[0]
-    flywh_cnt = sol[1]
-    sucap_cnt = sol[2]
-    cost = objective(DF, float('inf'), liion_cnt, flywh_cnt, sucap_cnt)
-    return cost
-
-x0, fval, _, _ = brute(fitness, (slice(0, 50, 1), slice(0, 50, 1), slice(0, 50, 1)), disp=True, finish=None, full_output=True)
-
-print(x0)
-print(fval)
+import argparse
+import csv
+from itertools import product
+import os
+import time
+from limits import SCHEDULE_CACHE
+from parallel import FitnessPool
+from halving import SuccessiveHalving
+from experiments import EXPERIMENTS, add_data_arguments, get_data_config
+from experiments import load_dataframe
+from peak_shave_sim import PRUNABLE_METRICS, Incumbent, objective
+from population_sim import population_objective
+
+DF = None
+RUN_CONFIG = None
+# with early abort, the simulations are aborted once the objective metric exceeds
+# the lowest one of a whole simulation in this process
+INCUMBENT = Incumbent()
+
+# experiments with a margin parameter, and the margins searched by default
+MARGIN_EXPERIMENTS = {'const', 'dyn'}
+DEFAULT_MARGINS = [0, .05, .1, .15, .2]
+# result columns of the `greedy` experiment that can be minimized, it has no
+# limits and no peak metrics
+GREEDY_METRICS = {'total_costs', 'fluctuation', 'mean_periodic_fluctuation',
+                  'max_bought'}
+
+def enumerate_grid(max_count: int, margins=None):
+    '''Enumerates the configurations of the search: every combination of battery
+    counts in [0, max_count], crossed with the margins if they are given.
+    Returns: list of (liion_cnt, flywh_cnt, sucap_cnt, margin) tuples, where
+        margin is None if margins is None.'''
+    counts = range(max_count + 1)
+    margins = [None] if margins is None else margins
+    return [(liion_cnt, flywh_cnt, sucap_cnt, margin)
+            for liion_cnt, flywh_cnt, sucap_cnt, margin
+            in product(counts, counts, counts, margins)]
+
+def chunk(configs: list, size: int) -> list[list]:
+    '''Splits the configurations into batches of at most size elements.'''
+    return [configs[idx:idx + size] for idx in range(0, len(configs), size)]
+
+def _get_run_config() -> dict:
+    '''Returns the parameters of the strategy that are not searched.'''
+    experiment = RUN_CONFIG['experiment']
+    run_config = {}
+    if experiment != 'greedy':
+        run_config = {'penalize_charging': True, 'create_log': False}
+    if experiment in {'dyn', 'equalize'}:
+        run_config['lookahead'] = RUN_CONFIG['lookahead']
+    return run_config
+
+def _get_row(liion_cnt, flywh_cnt, sucap_cnt, margin, costs, metrics) -> dict:
+    row = {
+        'liion_cnt': liion_cnt,
+        'flywh_cnt': flywh_cnt,
+        'sucap_cnt': sucap_cnt,
+        'margin': margin,
+        'total_costs': costs['total_costs'],
+    }
+    row.update(metrics)
+    return row
+
+def evaluate_config(liion_cnt, flywh_cnt, sucap_cnt, margin=None) -> dict:
+    '''Simulates a single configuration on the global dataframe.
+    Returns: a row of the result table.'''
+    run_config = _get_run_config()
+    if margin is not None:
+        run_config['margin'] = margin
+
+    costs, metrics = objective(EXPERIMENTS[RUN_CONFIG['experiment']], DF, liion_cnt,
+                               flywh_cnt, sucap_cnt, aggregate=RUN_CONFIG['aggregate'],
+                               store_trace=False, **run_config,
+                               **INCUMBENT.get_cutoff_config())
+    INCUMBENT.update(costs, metrics)
+    return _get_row(liion_cnt, flywh_cnt, sucap_cnt, margin, costs, metrics)
+
+def evaluate_batch(batch: list, _=None) -> list[dict]:
+    '''Simulates a batch of configurations, used as the task of a worker. The
+    configurations of the peak-shave experiments are simulated together with
+    `PopulationSim`.'''
+    if RUN_CONFIG['experiment'] == 'greedy' or not RUN_CONFIG['population']:
+        return [evaluate_config(*config) for config in batch]
+
+    counts = [config[:3] for config in batch]
+    margins = [config[3] for config in batch]
+    if margins[0] is None:
+        margins = None
+    results = population_objective(EXPERIMENTS[RUN_CONFIG['experiment']], DF, counts,
+                                   margins, aggregate=RUN_CONFIG['aggregate'],
+                                   **_get_run_config(), **INCUMBENT.get_cutoff_config())
+    for costs, metrics in results:
+        INCUMBENT.update(costs, metrics)
+    return [_get_row(*config, costs, metrics)
+            for config, (costs, metrics) in zip(batch, results)]
+
+def init_worker(df, run_config: dict) -> None:
+    '''Sets the globals of a worker process.'''
+    global DF, RUN_CONFIG, INCUMBENT
+    DF = df
+    RUN_CONFIG = run_config
+    INCUMBENT = Incumbent(run_config['metric'], run_config['early_abort'])
+    SCHEDULE_CACHE.cachedir = run_config['limit_cache_dir']
+
+def search(configs: list, batch_size: int, workers: int, output: str) -> dict:
+    '''Evaluates every configuration and writes the results to a CSV table, one
+    row per configuration, as soon as a batch is done. The batches are spread
+    over a pool of processes that share the global dataframe.
+    Returns: the row of the configuration with the lowest objective metric.'''
+    batches = chunk(configs, batch_size)
+    metric = RUN_CONFIG['metric']
+    best = None
+    start = time.time()
+
+    def write_rows(results, file):
+        nonlocal best
+        writer = None
+        done = 0
+        for rows in results:
+            if writer is None:
+                writer = csv.DictWriter(file, fieldnames=list(rows[0].keys()))
+                writer.writeheader()
+            writer.writerows(rows)
+            file.flush()
+            for row in rows:
+                if best is None or row[metric] < best[metric]:
+                    best = row
+            done += len(rows)
+            print(f'{done}/{len(configs)} configurations done in ' +
+                  f'{time.time() - start:.1f}s, best {metric}: {best[metric]:.2f}')
+
+    dirname = os.path.dirname(output)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(output, 'w', newline='') as file:
+        if workers <= 1:
+            write_rows(map(evaluate_batch, batches), file)
+        else:
+            with FitnessPool(evaluate_batch, DF, workers, init_worker,
+                             (RUN_CONFIG,)) as pool:
+                write_rows(pool.imap(batches, range(len(batches))), file)
+    return best
+
+def search_halving(configs: list, batch_size: int, output: str) -> dict:
+    '''Evaluates the configurations with successive halving in the main process:
+    only the best ones are simulated on the whole dataset. The result table has
+    a row for every configuration, with the results at the longest horizon it
+    was simulated on, and that horizon.
+    Returns: the row of the configuration with the lowest objective metric, among
+        the ones simulated on the whole dataset.'''
+    start = time.time()
+    halving = SuccessiveHalving(EXPERIMENTS[RUN_CONFIG['experiment']], DF,
+                                RUN_CONFIG['aggregate'], rungs=RUN_CONFIG['rungs'],
+                                keep=RUN_CONFIG['keep'], metric=RUN_CONFIG['metric'],
+                                batch_size=batch_size, maxsize=len(configs),
+                                **_get_run_config())
+    results = halving.evaluate(configs)
+    rows = []
+    for config, (horizon, costs, metrics) in zip(configs, results):
+        row = _get_row(*config, costs, metrics)
+        row['horizon'] = horizon
+        rows.append(row)
+    print(f'{len(configs)} configurations done in {time.time() - start:.1f}s, ' +
+          f'{halving.simulated_steps} steps simulated instead of ' +
+          f'{len(configs) * len(DF)}, horizons: {halving.horizons}')
+
+    dirname = os.path.dirname(output)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(output, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    metric = RUN_CONFIG['metric']
+    return min((row for row in rows if row['horizon'] == len(DF)),
+               key=lambda row: row[metric])
+
+def parse_config() -> dict:
+    parser = argparse.ArgumentParser(description='Exhaustive search of the battery ' +
+                                     'counts (and margins) of peak-shave.')
+    parser.add_argument('--experiment', type=str, default='const',
+                        choices=list(EXPERIMENTS),
+                        help='Determines the experiment to run.')
+    parser.add_argument('--max_count', type=int, default=10,
+                        help='Every battery count from 0 to max_count is searched.')
+    parser.add_argument('--margins', type=float, nargs='+', default=None,
+                        help='Margins crossed with the battery counts, only used ' +
+                        f'by `const` and `dyn`. Default: {DEFAULT_MARGINS}.')
+    parser.add_argument('--lookahead', type=int, default=24,
+                        help='Lookahead of `dyn` and `equalize`.')
+    parser.add_argument('--metric', type=str, default=None,
+                        help='The result column minimized by the search. Default: ' +
+                        '`total_costs` for `greedy`, `peak_power_sum` otherwise.')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='Number of configurations simulated by a task.')
+    parser.add_argument('--population', action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help='Simulate the configurations of a batch together, ' +
+                        'not used by the `greedy` experiment.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes running the simulations.')
+    parser.add_argument('--early_abort', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='Abort the simulations whose objective metric exceeds ' +
+                        'the best one found so far by the process, their row has ' +
+                        'a lower bound of the metric and `pruned` set. The metric ' +
+                        f'must be one of {sorted(PRUNABLE_METRICS)}.')
+    parser.add_argument('--halving', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='Search with successive halving: only the best ' +
+                        'configurations are simulated on the whole dataset. Not ' +
+                        'used by the `greedy` experiment, runs in the main process.')
+    parser.add_argument('--rungs', type=int, default=3,
+                        help='Number of horizons of successive halving.')
+    parser.add_argument('--keep', type=float, default=1/3,
+                        help='Fraction of the configurations promoted to the next ' +
+                        'horizon of successive halving.')
+    parser.add_argument('--output', type=str, default='logs/brute_op.csv',
+                        help='CSV file the result table is written to.')
+    add_data_arguments(parser)
+    args = parser.parse_args()
+
+    metric = args.metric
+    if metric is None:
+        metric = 'total_costs' if args.experiment == 'greedy' else 'peak_power_sum'
+    if args.experiment == 'greedy' and metric not in GREEDY_METRICS:
+        raise Exception('The `greedy` experiment needs a --metric of ' +
+                        f'{sorted(GREEDY_METRICS)}!')
+    if args.early_abort and metric not in PRUNABLE_METRICS:
+        raise Exception(f'--early_abort needs a --metric of {sorted(PRUNABLE_METRICS)}!')
+
+    margins = args.margins
+    if args.experiment in MARGIN_EXPERIMENTS and margins is None:
+        margins = DEFAULT_MARGINS
+    elif args.experiment not in MARGIN_EXPERIMENTS:
+        margins = None
+
+    return {
+        'experiment': args.experiment,
+        'max_count': args.max_count,
+        'margins': margins,
+        'lookahead': args.lookahead,
+        'metric': metric,
+        'batch_size': args.batch_size,
+        'population': args.population,
+        'workers': args.workers,
+        'halving': args.halving and args.experiment != 'greedy',
+        'early_abort': args.early_abort and not args.halving,
+        'rungs': args.rungs,
+        'keep': args.keep,
+        'output': args.output,
+        **get_data_config(args),
+    }
+
+def main(run_config: dict):
+    global DF
+    DF = load_dataframe(run_config)
+    init_worker(DF, run_config)
+
+    configs = enumerate_grid(run_config['max_count'], run_config['margins'])
+    print(f'Searching {len(configs)} configurations with ' +
+          f'{run_config["workers"]} workers...')
+    start = time.time()
+    if run_config['halving']:
+        best = search_halving(configs, run_config['batch_size'], run_config['output'])
+    else:
+        best = search(configs, run_config['batch_size'], run_config['workers'],
+                      run_config['output'])
+    print(f'Search took {time.time() - start:.1f}s, results: {run_config["output"]}')
+
+    margin = best['margin']
+    print(f'Solution: LiIon: {best["liion_cnt"]} Flywheel: {best["flywh_cnt"]} ' +
+          f'Supercapacitor: {best["sucap_cnt"]}' +
+          ('' if margin is None else f' Margin: {margin}'))
+    print(f'{run_config["metric"]}: {best[run_config["metric"]]:.2f} ' +
+          f'Cost: {best["total_costs"]:.2f}')
+
+if __name__ == '__main__':
+    main(parse_config())
@@ -0,0 +1,68 @@
+import argparse
+import pandas as pd
+from util import process_file
+from experiments import EXPERIMENTS
+from representative_days import report_error
+
+def parse_config() -> dict:
+    parser = argparse.ArgumentParser(description='Report the error of the results ' +
+                                     'estimated from representative days.')
+    parser.add_argument('--experiment', type=str, default='const',
+                        choices=list(EXPERIMENTS),
+                        help='Determines the experiment to run.')
+    parser.add_argument('--datafile', type=str, default='full.csv',
+                        help='Name of the file used as source data. File has to ' +
+                        'be in the data folder.')
+    parser.add_argument('--clusters', type=int, nargs='+', default=[4, 8, 16, 32, 64],
+                        help='Numbers of representative days compared.')
+    parser.add_argument('--configs', type=str, nargs='+', default=['3,3,3', '9,0,4'],
+                        help='Battery configurations simulated, as ' +
+                        '`liion,flywheel,supercap` counts.')
+    parser.add_argument('--margin', type=float, default=.05,
+                        help='Margin of `const` and `dyn`.')
+    parser.add_argument('--lookahead', type=int, default=24,
+                        help='Lookahead of `dyn` and `equalize`.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the clustering.')
+    parser.add_argument('--aggregate', action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help='Represent the batteries of each type as a single ' +
+                        'scaled unit in the simulation.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='CSV file the report is written to.')
+    args = parser.parse_args()
+
+    run_config = {}
+    if args.experiment != 'greedy':
+        run_config = {'penalize_charging': True, 'create_log': False}
+    if args.experiment in {'const', 'dyn'}:
+        run_config['margin'] = args.margin
+    if args.experiment in {'dyn', 'equalize'}:
+        run_config['lookahead'] = args.lookahead
+
+    return {
+        'experiment': args.experiment,
+        'datafile': args.datafile,
+        'clusters': args.clusters,
+        'configs': [tuple(int(count) for count in config.split(','))
+                    for config in args.configs],
+        'seed': args.seed,
+        'aggregate': args.aggregate,
+        'output': args.output,
+        'run_config': run_config,
+    }
+
+def main(config: dict):
+    df = process_file('../data/' + config['datafile'])
+    report = report_error(EXPERIMENTS[config['experiment']], df, config['clusters'],
+                          config['configs'], config['seed'], config['aggregate'],
+                          **config['run_config'])
+    report = pd.DataFrame(report)
+    with pd.option_context('display.width', 200, 'display.max_columns', None,
+                           'display.float_format', '{:.4f}'.format):
+        print(report)
+    if config['output'] is not None:
+        report.to_csv(config['output'], index=False)
+
+if __name__ == '__main__':
+    main(parse_config())
@@ -0,0 +1,94 @@
+import argparse
+import pandas as pd
+from greedy import GreedySim
+from util import process_file, regularize_hourly
+from representative_days import build_dataset
+from timeseries import TimeSeriesStore
+from peak_shave_sim import ConstLimPeakShaveSim
+from peak_shave_sim import DynamicLimPeakShaveSim
+from peak_shave_sim import EqualizedLimPeakShaveSim
+
+# the simulations of the experiments of the optimization scripts
+EXPERIMENTS = {
+    'const': ConstLimPeakShaveSim,
+    'dyn': DynamicLimPeakShaveSim,
+    'equalize': EqualizedLimPeakShaveSim,
+    'greedy': GreedySim,
+}
+
+def add_data_arguments(parser: argparse.ArgumentParser):
+    '''Adds the options selecting and preparing the data of an optimization script,
+    they are read by `get_data_config`.'''
+    parser.add_argument('--datafile', type=str, default='Sub71125.csv',
+                        help='Name of the file used as source data. File has to ' +
+                        'be in the data folder.')
+    parser.add_argument('--aggregate', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='Represent the batteries of each type as a single ' +
+                        'scaled unit in the simulation.')
+    parser.add_argument('--limit_cache_dir', type=str, default=None,
+                        help='Directory where computed limit schedules are ' +
+                        'stored and reused across runs.')
+    parser.add_argument('--store', type=str, default=None,
+                        help='Directory of a time-series store. If set, the data ' +
+                        'of --transformer is read from it instead of --datafile.')
+    parser.add_argument('--transformer', type=str, default='71125',
+                        help='Id of the transformer in the store.')
+    parser.add_argument('--start', type=str, default=None,
+                        help='First hour of the data read from the store.')
+    parser.add_argument('--end', type=str, default=None,
+                        help='End of the data read from the store (exclusive).')
+    parser.add_argument('--regularize', type=str, default=None,
+                        choices=['interpolate', 'ffill', 'zero'],
+                        help='Reindex the data onto a strict hourly grid and fill ' +
+                        'the missing hours with the given policy. Required if ' +
+                        'the data read from the store has hours without data.')
+    parser.add_argument('--representative_days', type=int, default=None,
+                        help='Simulate this many representative days of the data, ' +
+                        'weighted by the number of days they represent, see ' +
+                        '`cluster_days.py` for the estimation error.')
+
+def get_data_config(args: argparse.Namespace) -> dict:
+    '''Returns the options added by `add_data_arguments` as a dict.'''
+    return {
+        'datafile': args.datafile,
+        'aggregate': args.aggregate,
+        'limit_cache_dir': args.limit_cache_dir,
+        'store': args.store,
+        'transformer': args.transformer,
+        'start': args.start,
+        'end': args.end,
+        'regularize': args.regularize,
+        'representative_days': args.representative_days,
+    }
+
+def load_dataframe(run_config: dict) -> pd.DataFrame:
+    '''Loads the data of an optimization script, see `add_data_arguments`. The
+    data is read from the store or from the data folder, then regularized and
+    compressed into representative days if requested.
+    Returns: pandas.DataFrame with the `timestamp`, `net` and `price (cents/kWh)`
+        columns.'''
+    regularize = run_config['regularize']
+    if run_config['store'] is not None:
+        print(f'Set dataframe from transformer {run_config["transformer"]} in ' +
+              f'store: {run_config["store"]}')
+        df = TimeSeriesStore(run_config['store']).open(
+            run_config['transformer'], run_config['start'], run_config['end'],
+            allow_missing=regularize is not None)
+        if regularize is not None:
+            # the hours without data are filled like the missing rows of a file
+            df = df.dropna().reset_index(drop=True)
+    else:
+        fname = '../data/' + run_config['datafile']
+        print(f'Set dataframe from file: {fname}')
+        df = process_file(fname)
+    if regularize is not None:
+        df, report = regularize_hourly(df, regularize)
+        print(f'Regularized dataframe: {report["duplicates"]} duplicate hours ' +
+              f'dropped, {report["missing"]} missing hours in ' +
+              f'{len(report["gap_lengths"])} gaps filled ({regularize})')
+    if run_config['representative_days'] is not None:
+        df = build_dataset(df, run_config['representative_days'])
+        print(f'Compressed dataframe into {run_config["representative_days"]} ' +
+              f'representative days ({len(df)} steps)')
+    return df
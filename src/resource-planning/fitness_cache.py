@@ -0,0 +1,206 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+def _to_json(value) -> str:
+    # numpy scalars (e.g. genes) are converted to plain numbers
+    return json.dumps(value, sort_keys=True, default=lambda value: value.item())
+
+class FitnessCache:
+    '''Memoizes the fitness of the genomes of a GA run. The key of a genome is
+    (dataset, experiment, params, genome), where params are the parameters of the
+    strategy that are not part of the genome.
+    The cache keeps the `maxsize` most recently used values in memory, and if
+    `path` is set, it also stores every value in an SQLite database there, so a
+    rerun or a resumed run of the same experiment does not simulate the genomes
+    again.'''
+
+    def __init__(self, maxsize: int = 4096, path: str = None) -> None:
+        self.maxsize = maxsize
+        self.path = path
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.conn = None
+        self.pid = None
+
+    @staticmethod
+    def fingerprint(df: pd.DataFrame) -> str:
+        '''Returns a hash of the timestamps and the values of a dataset.'''
+        digest = hashlib.sha1()
+        for name in df.columns:
+            values = df[name].to_numpy()
+            if values.dtype.kind == 'M':
+                values = values.astype('datetime64[ns]').astype(np.int64)
+            elif values.dtype.kind not in 'biuf':
+                continue
+            digest.update(str(name).encode())
+            digest.update(np.ascontiguousarray(values, dtype=float).tobytes())
+        return digest.hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        # a connection must not be shared with forked worker processes
+        if self.conn is None or self.pid != os.getpid():
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=60)
+            self.pid = os.getpid()
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS fitness (' +
+                                  'dataset TEXT, experiment TEXT, params TEXT, ' +
+                                  'genome TEXT, fitness REAL, ' +
+                                  'PRIMARY KEY (dataset, experiment, params, genome))')
+        return self.conn
+
+    def _remember(self, key: tuple, value: float):
+        self.values[key] = value
+        self.values.move_to_end(key)
+        if len(self.values) > self.maxsize:
+            self.values.popitem(last=False)
+
+    def lookup(self, dataset: str, experiment: str, params: dict, genome):
+        '''Returns the cached fitness of a genome, or None if it is unknown.'''
+        key = (dataset, experiment, _to_json(params), _to_json(list(genome)))
+        if key in self.values:
+            self.hits += 1
+            self.values.move_to_end(key)
+            return self.values[key]
+
+        if self.path is not None:
+            row = self._connect().execute(
+                'SELECT fitness FROM fitness WHERE dataset=? AND experiment=? ' +
+                'AND params=? AND genome=?', key).fetchone()
+            if row is not None:
+                self.hits += 1
+                self._remember(key, row[0])
+                return row[0]
+        self.misses += 1
+        return None
+
+    def store(self, dataset: str, experiment: str, params: dict, genome,
+              value: float):
+        '''Adds the fitness of a genome to the cache.'''
+        key = (dataset, experiment, _to_json(params), _to_json(list(genome)))
+        value = float(value)
+        self._remember(key, value)
+        if self.path is not None:
+            with self._connect() as conn:
+                conn.execute('INSERT OR REPLACE INTO fitness VALUES (?, ?, ?, ?, ?)',
+                             (*key, value))
+
+    def get_hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+class CachedFitness:
+    '''Batch fitness function of pygad that only evaluates the genomes missing
+    from a `FitnessCache`. Duplicates within a batch are evaluated once.
+    Args:
+        - evaluate: function(solutions, indices) -> list of fitness values, e.g.
+            `FitnessPool.evaluate`.
+        - cache: the FitnessCache.
+        - dataset: fingerprint of the dataset.
+        - experiment: name of the experiment.
+        - params: parameters of the strategy that are not part of the genome.
+        - is_final: function(solution) -> bool, whether the fitness of an evaluated
+            solution is final and can be cached, e.g. not an estimate that a later
+            evaluation refines. Every fitness is cached if None.'''
+
+    def __init__(self, evaluate, cache: FitnessCache, dataset: str,
+                 experiment: str, params: dict, is_final=None) -> None:
+        self.evaluate_batch = evaluate
+        self.cache = cache
+        self.dataset = dataset
+        self.experiment = experiment
+        self.params = params
+        self.is_final = is_final
+
+    def evaluate(self, solutions, indices) -> list[float]:
+        '''Returns the fitness of every solution in the batch.'''
+        fitness = [None] * len(solutions)
+        # positions of the missing genomes, grouped by genome
+        missing = {}
+        for pos, sol in enumerate(solutions):
+            value = self.cache.lookup(self.dataset, self.experiment, self.params, sol)
+            if value is None:
+                missing.setdefault(_to_json(list(sol)), []).append(pos)
+            else:
+                fitness[pos] = value
+
+        firsts = [positions[0] for positions in missing.values()]
+        values = []
+        if firsts:
+            values = self.evaluate_batch([solutions[pos] for pos in firsts],
+                                         [indices[pos] for pos in firsts])
+        for positions, value in zip(missing.values(), values):
+            sol = solutions[positions[0]]
+            if self.is_final is None or self.is_final(sol):
+                self.cache.store(self.dataset, self.experiment, self.params, sol, value)
+            for pos in positions:
+                fitness[pos] = value
+        return fitness
+
+if __name__ == '__main__':
+    import tempfile
+    import unittest
+
+    class TestFitnessCache(unittest.TestCase):
+        def test1(self):
+            calls = []
+            def evaluate(solutions, indices):
+                calls.extend(indices)
+                return [float(sum(sol)) for sol in solutions]
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'fitness.sqlite')
+                cache = FitnessCache(maxsize=2, path=path)
+                fitness = CachedFitness(evaluate, cache, 'abc', 'equalize',
+                                        {'lookahead': 24})
+                sols = [np.array([1, 2, 3]), np.array([1, 2, 3]), np.array([0, 0, 9])]
+                self.assertEqual(fitness.evaluate(sols, [0, 1, 2]), [6, 6, 9])
+                self.assertEqual(calls, [0, 2])
+                self.assertEqual(fitness.evaluate(sols[:1], [5]), [6])
+                self.assertEqual(calls, [0, 2])
+
+                # a new cache finds the values in the database
+                cache = FitnessCache(maxsize=2, path=path)
+                fitness = CachedFitness(evaluate, cache, 'abc', 'equalize',
+                                        {'lookahead': 24})
+                self.assertEqual(fitness.evaluate(sols, [0, 1, 2]), [6, 6, 9])
+                self.assertEqual(calls, [0, 2])
+                self.assertEqual(cache.get_hit_rate(), 1)
+
+                # other parameters are different keys
+                fitness.params = {'lookahead': 12}
+                fitness.evaluate(sols[:1], [0])
+                self.assertEqual(calls, [0, 2, 0])
+
+        def test3(self):
+            calls = []
+            def evaluate(solutions, indices):
+                calls.extend(indices)
+                return [float(sum(sol)) for sol in solutions]
+
+            # only the fitness of the even genomes is final
+            fitness = CachedFitness(evaluate, FitnessCache(), 'abc', 'const', {},
+                                    is_final=lambda sol: sum(sol) % 2 == 0)
+            sols = [np.array([1, 1]), np.array([1, 2])]
+            self.assertEqual(fitness.evaluate(sols, [0, 1]), [2, 3])
+            self.assertEqual(fitness.evaluate(sols, [2, 3]), [2, 3])
+            self.assertEqual(calls, [0, 1, 3])
+
+        def test2(self):
+            df = pd.DataFrame({'timestamp': pd.date_range('2021-06-01', periods=3,
+                                                          freq='h'),
+                               'net': [1., 2., 3.]})
+            fingerprint = FitnessCache.fingerprint(df)
+            self.assertEqual(fingerprint, FitnessCache.fingerprint(df.copy()))
+            df.loc[1, 'net'] = 5
+            self.assertNotEqual(fingerprint, FitnessCache.fingerprint(df))
+
+    unittest.main()
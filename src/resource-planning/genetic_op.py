@@ -1,14 +1,30 @@
 import math
 import argparse
+import numpy as np
 import pygad
 from greedy import GreedySim
 from util import get_merged_dfs, missing_datetimes, process_file
-from peak_shave_sim import objective
+from limits import SCHEDULE_CACHE
+from parallel import FitnessPool
+from fitness_cache import CachedFitness, FitnessCache
+from halving import SuccessiveHalving
+from experiments import EXPERIMENTS, add_data_arguments, get_data_config
+from experiments import load_dataframe
+from peak_shave_sim import Incumbent, objective
 from peak_shave_sim import ConstLimPeakShaveSim
 from peak_shave_sim import DynamicLimPeakShaveSim
 from peak_shave_sim import EqualizedLimPeakShaveSim
+from population_sim import population_objective
 
 DF = None
+AGGREGATE = False
+EXPERIMENT = None
+LOOKAHEAD = 24
+FITNESS_CACHE = FitnessCache()
+HALVING = None
+# with early abort, the simulations are aborted once their peak power sum exceeds
+# the lowest one of a whole simulation in this process
+INCUMBENT = Incumbent()
 
 def print_gene_fitness(liion_cnt, flywh_cnt, sucap_cnt, cost,
                        metrics, margin=None, lookahead=None):
@@ -47,8 +63,10 @@ def fitness_const(sol, _) -> float:
     sucap_cnt = sol[2]
     margin = sol[3]
     costs, metrics = objective(ConstLimPeakShaveSim, DF, liion_cnt, flywh_cnt,
-                               sucap_cnt, margin=margin, penalize_charging=True,
-                               create_log=False)
+                               sucap_cnt, aggregate=AGGREGATE, store_trace=False,
+                               margin=margin, penalize_charging=True, create_log=False,
+                               **INCUMBENT.get_cutoff_config())
+    INCUMBENT.update(costs, metrics)
 
     # cost = costs['total_costs']
     # cost = metrics['max_bought']
@@ -80,10 +98,12 @@ def fitness_dyn(sol, _) -> float:
     flywh_cnt = sol[1]
     sucap_cnt = sol[2]
     margin = sol[3]
-    lookahead = 24
+    lookahead = LOOKAHEAD
     costs, metrics = objective(DynamicLimPeakShaveSim, DF, liion_cnt, flywh_cnt,
-                               sucap_cnt, lookahead=lookahead, margin=margin,
-                               penalize_charging=True, create_log=False)
+                               sucap_cnt, aggregate=AGGREGATE, store_trace=False,
+                               lookahead=lookahead, margin=margin, penalize_charging=True,
+                               create_log=False, **INCUMBENT.get_cutoff_config())
+    INCUMBENT.update(costs, metrics)
 
     # cost = costs['total_costs']
     # cost = metrics['max_bought']
@@ -108,10 +128,12 @@ def fitness_eq(sol, _) -> float:
     liion_cnt = sol[0]
     flywh_cnt = sol[1]
     sucap_cnt = sol[2]
-    lookahead = 24
+    lookahead = LOOKAHEAD
     costs, metrics = objective(EqualizedLimPeakShaveSim, DF, liion_cnt, flywh_cnt,
-                               sucap_cnt, lookahead=lookahead, penalize_charging=True,
-                               create_log=False)
+                               sucap_cnt, aggregate=AGGREGATE, store_trace=False,
+                               lookahead=lookahead, penalize_charging=True,
+                               create_log=False, **INCUMBENT.get_cutoff_config())
+    INCUMBENT.update(costs, metrics)
     # cost = costs['total_costs']
     # cost = metrics['max_bought']
     # cost = metrics['sum_above_limit']
@@ -136,7 +158,8 @@ def fitness_greedy(sol, _):
     flywh_cnt = sol[1]
     sucap_cnt = sol[2]
 
-    costs, metrics = objective(GreedySim, DF, liion_cnt, flywh_cnt, sucap_cnt)
+    costs, metrics = objective(GreedySim, DF, liion_cnt, flywh_cnt, sucap_cnt,
+                               aggregate=AGGREGATE, store_trace=False)
     # cost = costs['total_costs']
     # cost = metrics['max_bought']
     # cost = metrics['sum_above_limit']
@@ -145,17 +168,81 @@ def fitness_greedy(sol, _):
     print_gene_fitness(liion_cnt, flywh_cnt, sucap_cnt, costs['total_costs'], metrics)
     return 100000/cost
 
+POPULATION_EXPERIMENTS = {name: SimClass for name, SimClass in EXPERIMENTS.items()
+                          if name != 'greedy'}
+
+def fitness_population(solutions, _=None) -> list[float]:
+    '''Batch fitness function simulating all the solutions of a batch together
+    with `PopulationSim`, for the peak-shave experiments. The genes are the same
+    as in the fitness function of the experiment, e.g. `fitness_const`.
+    With early abort, the cost of an aborted solution is a lower bound.
+    Returns: list of the fitness values of the solutions: 100000/cost'''
+    solutions = np.asarray(solutions, dtype=float)
+    counts = solutions[:, :3].astype(int)
+    margins = solutions[:, 3] if EXPERIMENT in {'const', 'dyn'} else None
+    run_config = {'lookahead': LOOKAHEAD} if EXPERIMENT in {'dyn', 'equalize'} else {}
+    results = population_objective(POPULATION_EXPERIMENTS[EXPERIMENT], DF, counts,
+                                   margins, aggregate=AGGREGATE, **run_config,
+                                   **INCUMBENT.get_cutoff_config())
+
+    fitness = []
+    for idx, (costs, metrics) in enumerate(results):
+        INCUMBENT.update(costs, metrics)
+        cost = metrics['peak_power_sum']
+        margin = None if margins is None else margins[idx]
+        print_gene_fitness(*counts[idx].tolist(), costs['total_costs'], metrics,
+                           margin, run_config.get('lookahead'))
+        fitness.append(float('inf') if cost == 0 else 100000/cost)
+    return fitness
+
+def fitness_halving(solutions, _=None) -> list[float]:
+    '''Batch fitness function evaluating the solutions of a batch with successive
+    halving, for the peak-shave experiments. Only the best solutions are
+    simulated on the whole dataset, the fitness of the others is estimated from
+    the prefix they were simulated on (see `SuccessiveHalving.get_estimate`).
+    Returns: list of the fitness values of the solutions: 100000/cost'''
+    candidates = list(map(get_halving_candidate, solutions))
+    results = HALVING.evaluate(candidates)
+
+    fitness = []
+    for candidate, (horizon, costs, metrics) in zip(candidates, results):
+        cost = HALVING.get_estimate(horizon, costs, metrics)
+        print_gene_fitness(*candidate[:3], costs['total_costs'], metrics, candidate[3],
+                           HALVING.run_config.get('lookahead'))
+        fitness.append(float('inf') if cost == 0 else 100000/cost)
+    return fitness
+
+def get_halving_candidate(sol) -> tuple:
+    '''Returns the (liion_cnt, flywh_cnt, sucap_cnt, margin) candidate of a
+    solution evaluated by `fitness_halving`.'''
+    liion_cnt, flywh_cnt, sucap_cnt = (int(gene) for gene in sol[:3])
+    margin = float(sol[3]) if EXPERIMENT in {'const', 'dyn'} else None
+    return liion_cnt, flywh_cnt, sucap_cnt, margin
+
+def is_halving_final(sol) -> bool:
+    '''Returns whether a solution evaluated by `fitness_halving` was simulated on
+    the whole dataset. Only these fitness values are cached, the estimate of an
+    eliminated solution is refined if it is evaluated again.'''
+    return HALVING.get_horizon(get_halving_candidate(sol)) == len(DF)
+
 def on_generation(ga_instance: pygad.GA):
-    sol, fit, _ = ga_instance.best_solution()
+    # reuse the fitness of the generation instead of evaluating it again
+    sol, fit, _ = ga_instance.best_solution(ga_instance.last_generation_fitness)
     print(f'sol: {sol}, fitness value: {fit}')
+    print_cache_stats()
+
+def print_cache_stats():
+    print(f'Fitness cache: {FITNESS_CACHE.hits} hits, {FITNESS_CACHE.misses} ' +
+          f'misses, hit rate: {FITNESS_CACHE.get_hit_rate():.2%}')
 
 def optimize(config):
     ga_instance = pygad.GA(**config)
     ga_instance.run()
 
-    sol, sol_fitness, _ = ga_instance.best_solution()
+    sol, sol_fitness, _ = ga_instance.best_solution(ga_instance.last_generation_fitness)
     print(f'Solution: {sol}')
     print(f'Fitness: {sol_fitness}')
+    print_cache_stats()
 
 def parse_config() -> dict:
     parser = argparse.ArgumentParser(description='Run genetic algorithm to optimize' +
@@ -167,20 +254,52 @@ def parse_config() -> dict:
                         help='Number of generations in the genetic algorithm.')
     parser.add_argument('--sol_per_pop', type=int, default=10,
                         help='Number of solutions per population.')
-    parser.add_argument('--datafile', type=str, default='Sub71125.csv',
-                        help='Name of the file used as source data. File has to ' +
-                        'be in the data folder.')
     parser.add_argument('--penalize_charging', action=argparse.BooleanOptionalAction,
                         default=False)
+    add_data_arguments(parser)
+    parser.add_argument('--fitness_cache', type=str, default=None,
+                        help='SQLite file where the fitness of the evaluated ' +
+                        'genomes is stored and reused across runs.')
+    parser.add_argument('--population', action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help='Simulate the solutions of a generation together, ' +
+                        'not used by the `greedy` experiment.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes evaluating the fitness of a ' +
+                        'generation in parallel.')
+    parser.add_argument('--halving', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='Evaluate the solutions of a generation with ' +
+                        'successive halving: only the best ones are simulated on ' +
+                        'the whole dataset. Runs in the main process.')
+    parser.add_argument('--early_abort', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='Abort the simulations whose peak power sum exceeds ' +
+                        'the best one found so far, their fitness is an upper ' +
+                        'bound. Not used by `--halving` and `greedy`.')
+    parser.add_argument('--rungs', type=int, default=3,
+                        help='Number of horizons of successive halving.')
+    parser.add_argument('--keep', type=float, default=1/3,
+                        help='Fraction of the solutions promoted to the next ' +
+                        'horizon of successive halving.')
     args = parser.parse_args()
 
     if args.experiment not in {'const', 'dyn', 'equalize', 'greedy'}:
         raise Exception('--experiment must be either `const`, `dyn`, `equalize`, or `greedy`!')
+    if args.halving and args.experiment == 'greedy':
+        raise Exception('--halving is not supported by the `greedy` experiment!')
 
     run_config = {
-        'datafile': args.datafile,
+        **get_data_config(args),
         'penalize_charging': args.penalize_charging,
         'experiment': args.experiment,
+        'workers': args.workers,
+        'fitness_cache': args.fitness_cache,
+        'population': args.population,
+        'halving': args.halving,
+        'early_abort': args.early_abort and args.experiment != 'greedy',
+        'rungs': args.rungs,
+        'keep': args.keep,
     }
 
     pygad_config = {
@@ -213,9 +332,35 @@ def set_global_dataframe(*fnames: str) -> None:
         print(f'Set dataframe from files: {", ".join(fnames)}')
         DF = get_merged_dfs(*fnames)
 
+def init_worker(df, aggregate: bool, limit_cache_dir: str, experiment: str,
+                early_abort: bool = False) -> None:
+    '''Sets the globals of a fitness evaluating worker process. Every worker
+    aborts the simulations with its own cutoff.'''
+    global DF, AGGREGATE, EXPERIMENT, INCUMBENT
+    DF = df
+    AGGREGATE = aggregate
+    EXPERIMENT = experiment
+    INCUMBENT = Incumbent(enabled=early_abort)
+    SCHEDULE_CACHE.cachedir = limit_cache_dir
+
+def set_halving(run_config: dict) -> dict:
+    '''Creates the successive halving evaluator of the experiment.
+    Returns: the parameters of the evaluator, part of the fitness cache keys.'''
+    global HALVING
+    params = {'lookahead': LOOKAHEAD} if EXPERIMENT in {'dyn', 'equalize'} else {}
+    HALVING = SuccessiveHalving(POPULATION_EXPERIMENTS[EXPERIMENT], DF, AGGREGATE,
+                                rungs=run_config['rungs'], keep=run_config['keep'],
+                                **params)
+    return {'horizons': HALVING.horizons, 'keep': HALVING.keep}
+
 def main(configs):
+    global AGGREGATE, EXPERIMENT, INCUMBENT
     run_config = configs['run_config']
     pygad_config = configs['pygad_config']
+    AGGREGATE = run_config['aggregate']
+    EXPERIMENT = run_config['experiment']
+    INCUMBENT = Incumbent(enabled=run_config['early_abort'] and not run_config['halving'])
+    SCHEDULE_CACHE.cachedir = run_config['limit_cache_dir']
 
     num_genes = 3
     gene_type = [int, int, int]
@@ -240,7 +385,60 @@ def main(configs):
     pygad_config['num_genes'] = num_genes
     pygad_config['gene_type'] = gene_type
     pygad_config['gene_space'] = gene_space
-    optimize(pygad_config)
+
+    # strategy parameters that are not genes
+    params = {'aggregate': AGGREGATE}
+    if run_config['experiment'] in {'dyn', 'equalize'}:
+        params['lookahead'] = LOOKAHEAD
+    # the fitness of a genome aborted by early abort is a bound that depends on
+    # the run, and the workers do not report which genomes were aborted, so the
+    # fitness values of an early abort run are not cached. The exact values of
+    # other runs are still reused.
+    is_final = (lambda _: False) if INCUMBENT.enabled else None
+    FITNESS_CACHE.path = run_config['fitness_cache']
+    dataset = FitnessCache.fingerprint(DF)
+    fitness_func = pygad_config['fitness_func']
+    population = (run_config['population'] and
+                  run_config['experiment'] in POPULATION_EXPERIMENTS)
+    workers = run_config['workers']
+
+    # the solutions of a generation are evaluated as a single batch, and only the
+    # genomes missing from the fitness cache are simulated
+    pygad_config['fitness_batch_size'] = pygad_config['sol_per_pop']
+    if run_config['halving']:
+        params['halving'] = set_halving(run_config)
+        pygad_config['fitness_func'] = CachedFitness(
+            fitness_halving, FITNESS_CACHE, dataset, run_config['experiment'],
+            params, is_final=is_halving_final).evaluate
+        optimize(pygad_config)
+        return
+
+    if workers <= 1:
+        if population:
+            evaluate = fitness_population
+        else:
+            evaluate = lambda sols, idxs: list(map(fitness_func, sols, idxs))
+        pygad_config['fitness_func'] = CachedFitness(
+            evaluate, FITNESS_CACHE, dataset, run_config['experiment'], params,
+            is_final).evaluate
+        optimize(pygad_config)
+        return
+
+    with FitnessPool(fitness_population if population else fitness_func, DF, workers,
+                     init_worker, (AGGREGATE, SCHEDULE_CACHE.cachedir, EXPERIMENT,
+                                   INCUMBENT.enabled)) as pool:
+        if population:
+            # every worker simulates a part of the batch together
+            def evaluate(sols, _):
+                parts = [part for part in np.array_split(sols, workers) if len(part) > 0]
+                return [fitness for part_fitness in pool.imap(parts, range(len(parts)))
+                        for fitness in part_fitness]
+        else:
+            evaluate = pool.evaluate
+        pygad_config['fitness_func'] = CachedFitness(
+            evaluate, FITNESS_CACHE, dataset, run_config['experiment'], params,
+            is_final).evaluate
+        optimize(pygad_config)
 
 if __name__ == '__main__':
     configs = parse_config()
@@ -251,7 +449,7 @@ if __name__ == '__main__':
         'MP71125_1_Juli_31_Juli.csv'
     ]
     fnames = ['../data/' + fname for fname in fnames]
-    set_global_dataframe('../data/' + configs['run_config']['datafile'])
+    DF = load_dataframe(configs['run_config'])
     # set_global_dataframe(*fnames)
     # missing_datetimes(DF)
 
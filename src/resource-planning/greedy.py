@@ -1,7 +1,8 @@
 import numpy as np
 from concurrent.futures import process
 from batteries import EnergyHub
-from util import process_file
+from util import process_file, PriceIndex, ReserveTimeIndex, SimulationTrace
+from util import hours_of_day, infer_tdelta
 import os
 
 FILEPATH = os.path.dirname(os.path.abspath(__file__))
@@ -11,7 +12,9 @@ class GreedySim():
         super().__init__()
 
         self.df = process_file(config['datafile']) if df is None else df
-        self.ehub = EnergyHub(config)
+        # length of a step in hours
+        self.tdelta = config.get('tdelta') or infer_tdelta(self.df['timestamp'])
+        self.ehub = EnergyHub(dict(config, tdelta=self.tdelta))
         self.reset()
 
     def reset(self):
@@ -20,8 +23,8 @@ class GreedySim():
     def _compute_capex_opex(self):
         '''Computes the capital and the operational expenses of the energy hub by first
         determining the length of the period'''
-        start = self.df.iloc[0]['ReadTimestamp']
-        end = self.df.iloc[-1]['ReadTimestamp']
+        start = self.df.iloc[0]['timestamp']
+        end = self.df.iloc[-1]['timestamp']
         delta = end - start # simulation time
         delta = delta.days * 24 + delta.seconds // 60 // 60 # simulation in hours
 
@@ -30,55 +33,93 @@ class GreedySim():
 
         return capex, opex
 
-    def run(self, **kwargs):
+    def simulate(self, **kwargs) -> tuple[dict, SimulationTrace]:
+        '''Runs the greedy strategy on the whole dataset.
+        Adjustable args:
+            - verbose: print the decisions made in each step
+            - simulate_reserve: compute the reserve time by simulating the
+                discharge of the energy hub forward in every step (default). If
+                False, it is approximated with the cumulative demand (see
+                `util.ReserveTimeIndex`), which changes the results.
+            - trace_dtype: precision of the stored trace, e.g. `np.float32`
+            - metrics: `util.MetricsAccumulator` updated in every step
+            - store_trace: if False, the steps are not stored and no trace is
+                returned
+        Returns:
+            - costs: dict containing `energy_costs`, `capex`, `opex` and
+                `total_costs`.
+            - trace: `SimulationTrace` without limits, one element per step, or
+                None.'''
         verbose = False if 'verbose' not in kwargs else True
+        simulate_reserve = kwargs.get('simulate_reserve', True)
+        trace_dtype = kwargs.get('trace_dtype', np.float64)
+        metrics = kwargs.get('metrics')
+        store_trace = kwargs.get('store_trace', True)
 
         energy_cost = 0
-        powers = []
-
-        for idx, datarow in self.df.iterrows():
+        pnets = self.df['net'].to_numpy(dtype=float)
+        prices = self.df['price (cents/kWh)'].to_numpy()
+        if store_trace:
+            pboughts = np.empty_like(pnets)
+            socs = np.empty_like(pnets)
+        if metrics is not None:
+            hours = hours_of_day(self.df['timestamp'].to_numpy()).tolist()
+        if not simulate_reserve:
+            maxpower = sum(battery.etadischarge * battery.maxdischarge
+                           for battery in self.ehub.storages)
+            reserve_index = ReserveTimeIndex(pnets, self.tdelta, maxpower)
+        price_index = PriceIndex(prices)
+
+        for idx, pnet in enumerate(pnets.tolist()):
             if __debug__ and verbose:
-                print(f'{idx:3d} {datarow["net"]:5.1f}')
+                print(f'{idx:3d} {pnet:5.1f}')
 
             pbought = 0
-            pnets = list(self.df.iloc[idx:]['net'])
 
             # find how much time we could last with current battery charge
-            treserve = self.ehub.compute_reserve_time(pnets)
+            if simulate_reserve:
+                # the forward simulation stops when the hub is empty, so the rest
+                # of the data is not copied
+                treserve = self.ehub.compute_reserve_time(pnets[idx:])
+            else:
+                treserve = reserve_index.reserve_time(idx, self.ehub.get_soc())
 
             if __debug__ and verbose:
                 print(f'\ttreserve: {treserve}')
 
             # find the lowest electricity price within the given time frame
-            prices = self.df.iloc[idx:idx+treserve+1]['price (cents/kWh)']
-            min_id = np.argmin(prices)
-            
+            min_id = self.ehub.find_next_charge_time(price_index, treserve, idx)
+            price = prices[idx]
+
             if __debug__ and verbose:
-                print(f'\telectricity prices: {list(prices)}')
+                print(f'\telectricity prices: {list(prices[idx:idx+treserve+1])}')
                 print(f'\tlowest electricity price at: {min_id}')
 
             # if the lowest price is now
             if min_id == 0:
-                # see how much power we need to charge up completely
+                # see how much energy we need to charge up completely
                 pneed = self.ehub.power_to_max()
-                # buy that power
-                pbought += pneed * prices.iloc[0] / 100
-                # use it to charge the ehub
-                self.ehub.charge(pneed)
+                # buy that energy
+                pbought += pneed * price / 100
+                # use it to charge the ehub during this step
+                self.ehub.charge(pneed / self.tdelta)
                 # also, buy energy to satisfy current need
-                pbought += datarow['net'] * prices.iloc[0] / 100
+                pbought += pnet * self.tdelta * price / 100
                 if __debug__ and verbose:
                     print(f'\tWe need to charge!')
                     print(f'\tcharge {pneed:.2f} kWh!')
             else:
                 # discharge
-                self.ehub.discharge(datarow['net'])
+                self.ehub.discharge(pnet)
             if __debug__ and verbose:
-                print(f'\tdischarge: {datarow["net"]:.2f}')
+                print(f'\tdischarge: {pnet:.2f}')
                 print(f'\tnew soc: {self.ehub.get_soc():.2f}')
             
-            powers.append((datarow['timestamp'], datarow['net'], pbought,
-                           self.ehub.get_soc()))
+            if store_trace:
+                pboughts[idx] = pbought
+                socs[idx] = self.ehub.get_soc()
+            if metrics is not None:
+                metrics.update(hours[idx], pbought)
 
             energy_cost += pbought
         capex, opex = self._compute_capex_opex()
@@ -89,7 +130,18 @@ class GreedySim():
             'opex': opex,
             'total_costs': energy_cost + capex + opex
         }
-        return costs, powers
+        trace = None
+        if store_trace:
+            trace = SimulationTrace(self.df['timestamp'].to_numpy(), pnets, pboughts,
+                                    socs, dtype=trace_dtype)
+        return costs, trace
+
+    def run(self, **kwargs):
+        '''Runs the simulation and returns the results as a list of
+        (`timestamp`, `pnet`, `pbought`, `soc`) tuples. This is an adapter around
+        `simulate`.'''
+        costs, trace = self.simulate(**kwargs)
+        return costs, trace.to_powers()
 
 def test_greedy_sim():
     config = {
@@ -104,4 +156,20 @@ def test_greedy_sim():
     print(costs)
 
 if __name__ == '__main__':
-    test_greedy_sim()
+    import unittest
+
+    class TestGreedySim(unittest.TestCase):
+        def test1(self):
+            # the reserve time of the default run is simulated forward, as in the
+            # first version of the strategy
+            df = process_file(FILEPATH + '/../../data/full.csv').iloc[:500]
+            for counts in ((1, 0, 0), (3, 2, 1)):
+                config = dict(zip(('LiIonBattery', 'Flywheel', 'Supercapacitor'),
+                                  counts))
+                costs, trace = GreedySim(config, df).simulate()
+                expected_costs, expected = GreedySim(config, df).simulate(
+                    simulate_reserve=True)
+                self.assertEqual(costs, expected_costs)
+                np.testing.assert_array_equal(trace.pbought, expected.pbought)
+
+    unittest.main()
@@ -0,0 +1,289 @@
+from collections import OrderedDict
+import math
+from typing import Type
+import numpy as np
+import pandas as pd
+from peak_shave_sim import PeakShaveSim
+from peak_shave_sim import compute_metrics, estimate_results, get_simulation_hours
+from population_sim import PopulationSim
+from util import SimulationTrace, infer_tdelta
+
+# costs and metrics that grow with the length of the simulated period, their
+# value on a prefix of the data is scaled to the whole data by `get_estimate`
+ADDITIVE_METRICS = {'energy_costs', 'capex', 'opex', 'total_costs',
+                    'peak_power_sum', 'peak_power_count', 'sum_above_limit'}
+
+def get_horizons(steps: int, rungs: int = 3, factor: float = 3,
+                 unit: int = 24) -> list[int]:
+    '''Returns the number of steps simulated in each rung of successive halving:
+    the last rung simulates every step, and each rung before it a factor times
+    shorter prefix, rounded up to whole units (e.g. days).'''
+    horizons = []
+    for rung in range(rungs):
+        horizon = math.ceil(steps / factor ** (rungs - 1 - rung) / unit) * unit
+        horizon = min(horizon, steps)
+        if not horizons or horizon > horizons[-1]:
+            horizons.append(horizon)
+    return horizons
+
+class _State:
+    '''Saved state of a candidate after simulating the first `end` steps.'''
+
+    def __init__(self) -> None:
+        self.end = 0
+        # soc of the units, see `PopulationEnergyHub.get_unit_soc`
+        self.soc = None
+        self.energy_costs = 0.
+        # bought power and soc of the simulated segments, None if released
+        self.pboughts = []
+        self.socs = []
+        # horizon -> (costs, metrics)
+        self.results = {}
+
+class SuccessiveHalving:
+    '''Multi-fidelity evaluation of battery configurations with successive
+    halving. The candidates are simulated on a short prefix of the data first,
+    and only the best `keep` fraction of them is promoted to the next, longer
+    horizon, until the finalists are simulated on the whole data.
+    The state of every candidate (the soc of its units and its trace so far) is
+    saved after each rung, so a promotion continues the simulation from there,
+    and a candidate evaluated again later (e.g. in a later generation of the GA)
+    resumes from its last horizon. The limit schedules are computed on the whole
+    data, so the results of the finalists are the same as the ones of
+    `population_objective`.
+    Args:
+        - SimClass: the peak-shave strategy, see `PopulationSim`.
+        - df: pandas.DataFrame containing the price data and the net power data
+            under the `net` key.
+        - aggregate: see `objective`.
+        - horizons: increasing number of steps of the rungs, the last one is the
+            length of df. Default: `get_horizons` with `rungs` rungs, shortened by
+            the same factor as the number of candidates.
+        - rungs: number of rungs, only used if horizons is None.
+        - keep: fraction of the candidates promoted to the next rung.
+        - metric: the cost or the metric that ranks the candidates, lower is better.
+        - batch_size: number of candidates simulated together.
+        - maxsize: number of candidates whose state is kept.
+        - jit: see `PopulationSim.simulate`.
+        - **run_config: parameters of the limit strategy except the margin.'''
+
+    def __init__(self, SimClass: Type[PeakShaveSim], df: pd.DataFrame, aggregate=False,
+                 horizons: list[int] = None, rungs: int = 3, keep: float = 1/3,
+                 metric: str = 'peak_power_sum', batch_size: int = 256,
+                 maxsize: int = 4096, jit=True, **run_config) -> None:
+        self.SimClass = SimClass
+        self.df = df
+        self.aggregate = aggregate
+        self.tdelta = infer_tdelta(df['timestamp'])
+        if horizons is None:
+            horizons = get_horizons(len(df), rungs, 1 / keep,
+                                    unit=max(1, round(24 / self.tdelta)))
+        if horizons[-1] != len(df):
+            raise ValueError('The last horizon must be the length of the data!')
+        self.horizons = horizons
+        self.keep = keep
+        self.metric = metric
+        self.batch_size = batch_size
+        self.maxsize = maxsize
+        self.jit = jit
+        self.run_config = run_config
+        self.states = OrderedDict()
+        self.prices = df['price (cents/kWh)'].to_numpy(dtype=float)
+        self.simulated_steps = 0
+
+    @staticmethod
+    def _get_key(candidate) -> tuple:
+        liion_cnt, flywh_cnt, sucap_cnt, margin = candidate
+        return (int(liion_cnt), int(flywh_cnt), int(sucap_cnt),
+                None if margin is None else float(margin))
+
+    def _get_state(self, key: tuple) -> _State:
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = _State()
+        self.states.move_to_end(key)
+        return state
+
+    def _get_score(self, key: tuple, horizon: int) -> float:
+        costs, metrics = self.states[key].results[horizon]
+        return costs[self.metric] if self.metric in costs else metrics[self.metric]
+
+    def _simulate(self, keys: list[tuple], start: int, end: int):
+        '''Advances the candidates from their saved states at step start to end.'''
+        sim = PopulationSim(self.SimClass, self.df, [key[:3] for key in keys],
+                            self.aggregate, self.tdelta)
+        margins = [key[3] for key in keys]
+        if margins[0] is None:
+            margins = None
+        lowerlims, upperlims = sim._get_limit_schedules(margins, **self.run_config)
+        states = [self.states[key] for key in keys]
+        sim.ehub.reset()
+        for idx, state in enumerate(states):
+            if state.soc is not None:
+                sim.ehub.set_unit_soc(idx, state.soc)
+
+        pboughts, socs, penalties = sim.advance(start, end, lowerlims, upperlims,
+                                                self.jit)
+        self.simulated_steps += (end - start) * len(keys)
+        energy_costs = ((self.prices[start:end] * self.tdelta / 100) @ pboughts +
+                        penalties)
+        hours = get_simulation_hours(self.df.iloc[:end])
+        capex = sim.ehub.get_capex(hours)
+        opex = sim.ehub.get_opex(hours)
+        for idx, state in enumerate(states):
+            state.end = end
+            state.soc = sim.ehub.get_unit_soc(idx)
+            state.energy_costs += energy_costs[idx]
+            state.pboughts.append(pboughts[:, idx])
+            state.socs.append(socs[:, idx])
+
+            costs = {'energy_costs': state.energy_costs, 'capex': capex[idx],
+                     'opex': opex[idx],
+                     'total_costs': capex[idx] + opex[idx] + state.energy_costs}
+            trace = SimulationTrace(self.df['timestamp'].to_numpy()[:end],
+                                    self.df['net'].to_numpy()[:end],
+                                    np.concatenate(state.pboughts),
+                                    np.concatenate(state.socs),
+                                    lowerlims[:end, idx], upperlims[:end, idx])
+            if 'weight' in self.df.columns:
+                # representative days, the horizons are whole days
+                state.results[end] = estimate_results(self.df.iloc[:end], costs, trace,
+                                                      self.tdelta)
+            else:
+                state.results[end] = (costs, compute_metrics(trace, self.tdelta))
+            if end == self.horizons[-1]:
+                self._release(state)
+
+    def _advance(self, keys: list[tuple], horizon: int):
+        '''Simulates the candidates up to the horizon, the candidates at the same
+        step are simulated together.'''
+        groups = {}
+        for key in keys:
+            state = self.states[key]
+            if state.end < horizon and state.pboughts is None:
+                # the trace of an eliminated candidate is released, so it is
+                # simulated from the start again
+                state.end, state.soc, state.energy_costs = 0, None, 0.
+                state.pboughts, state.socs = [], []
+            if state.end < horizon:
+                groups.setdefault(state.end, []).append(key)
+        for start, group in groups.items():
+            for idx in range(0, len(group), self.batch_size):
+                self._simulate(group[idx:idx + self.batch_size], start, horizon)
+
+    @staticmethod
+    def _release(state: _State):
+        '''Frees the trace of a candidate that is not simulated further.'''
+        state.pboughts, state.socs = None, None
+
+    def evaluate(self, candidates: list) -> list[tuple[int, dict, dict]]:
+        '''Evaluates the candidates with successive halving.
+        Args:
+            - candidates: list of (liion_cnt, flywh_cnt, sucap_cnt, margin) tuples,
+                margin is None if the strategy has no margin.
+        Returns: list of (horizon, costs, metrics) tuples, the results of each
+            candidate at the longest horizon it was simulated on, see `objective`
+            for the costs and the metrics.'''
+        keys = list(OrderedDict.fromkeys(map(self._get_key, candidates)))
+        for key in keys:
+            self._get_state(key)
+
+        alive = keys
+        for horizon in self.horizons:
+            self._advance(alive, horizon)
+            if horizon == self.horizons[-1]:
+                break
+            count = max(1, math.ceil(self.keep * len(alive)))
+            ranked = sorted(alive, key=lambda key: self._get_score(key, horizon))
+            if len(self.states) > self.maxsize:
+                # more candidates than saved states, e.g. in an exhaustive search
+                for key in ranked[count:]:
+                    self._release(self.states[key])
+            alive = ranked[:count]
+
+        results = []
+        for key in map(self._get_key, candidates):
+            state = self.states[key]
+            results.append((state.end, *state.results[state.end]))
+        while len(self.states) > self.maxsize:
+            self.states.popitem(last=False)
+        return results
+
+    def get_horizon(self, candidate) -> int:
+        '''Returns the longest horizon a candidate was simulated on, 0 if it has no
+        saved state. The results of the candidates simulated on the whole data
+        are final, a later evaluation does not change them.'''
+        state = self.states.get(self._get_key(candidate))
+        return 0 if state is None else state.end
+
+    def get_estimate(self, horizon: int, costs: dict, metrics: dict) -> float:
+        '''Returns the value of the metric scaled from the horizon to the whole
+        data, so candidates eliminated in different rungs can be compared.'''
+        value = costs[self.metric] if self.metric in costs else metrics[self.metric]
+        if self.metric in ADDITIVE_METRICS:
+            value *= self.horizons[-1] / horizon
+        return value
+
+if __name__ == '__main__':
+    import unittest
+    from peak_shave_sim import ConstLimPeakShaveSim
+    from peak_shave_sim import EqualizedLimPeakShaveSim
+    from population_sim import get_test_data, population_objective
+
+    class TestSuccessiveHalving(unittest.TestCase):
+        def test1(self):
+            self.assertEqual(get_horizons(24 * 90), [24 * 10, 24 * 30, 24 * 90])
+            self.assertEqual(get_horizons(100, unit=24), [24, 48, 100])
+            self.assertEqual(get_horizons(24, unit=24), [24])
+
+        def test2(self):
+            # the finalists have the results of the full simulation
+            df = get_test_data(24 * 27)
+            candidates = [(3, 2, 1, .1), (9, 0, 4, .2), (1, 1, 1, .05), (0, 0, 0, .1),
+                          (5, 5, 5, .15), (3, 2, 1, .1)]
+            halving = SuccessiveHalving(ConstLimPeakShaveSim, df, keep=.5)
+            self.assertEqual(halving.horizons, [24 * 7, 24 * 14, 24 * 27])
+            results = halving.evaluate(candidates)
+            # 5 distinct candidates, 3 of them are promoted, and then 2
+            self.assertEqual(sorted(horizon for horizon, _, _ in results[:-1]),
+                             [24 * 7, 24 * 7, 24 * 14, 24 * 27, 24 * 27])
+            self.assertEqual(results[0], results[-1])
+
+            finalists = [(candidate, result) for candidate, result
+                         in zip(candidates[:-1], results) if result[0] == len(df)]
+            expected = population_objective(
+                ConstLimPeakShaveSim, df, [candidate[:3] for candidate, _ in finalists],
+                [candidate[3] for candidate, _ in finalists])
+            for (_, (_, costs, metrics)), (exp_costs, exp_metrics) in zip(finalists,
+                                                                          expected):
+                for key, value in exp_costs.items():
+                    self.assertAlmostEqual(costs[key], value, delta=1e-9 * abs(value))
+                for key, value in exp_metrics.items():
+                    self.assertAlmostEqual(metrics[key], value, delta=1e-9 * abs(value))
+
+            # the finalists are not simulated again, and the promoted candidates
+            # resume from their saved states
+            steps = halving.simulated_steps
+            finalist = next(candidate for candidate, _ in finalists)
+            self.assertEqual(halving.evaluate([finalist])[0][0], len(df))
+            self.assertEqual(halving.simulated_steps, steps)
+            second = next(candidate for candidate, result in zip(candidates, results)
+                          if result[0] == 24 * 14)
+            self.assertEqual(halving.evaluate([second])[0][0], len(df))
+            self.assertEqual(halving.simulated_steps - steps, len(df) - 24 * 14)
+
+        def test3(self):
+            df = get_test_data(24 * 9)
+            halving = SuccessiveHalving(EqualizedLimPeakShaveSim, df, keep=.5,
+                                        horizons=[24 * 3, 24 * 9], lookahead=24)
+            candidates = [(0, 0, 0, None), (9, 9, 9, None)]
+            results = halving.evaluate(candidates)
+            self.assertEqual([horizon for horizon, _, _ in results], [24 * 3, 24 * 9])
+            self.assertEqual([halving.get_horizon(candidate) for candidate in candidates],
+                             [24 * 3, 24 * 9])
+            self.assertEqual(halving.get_horizon((1, 1, 1, None)), 0)
+            horizon, costs, metrics = results[0]
+            self.assertAlmostEqual(halving.get_estimate(horizon, costs, metrics),
+                                   metrics['peak_power_sum'] * 3)
+
+    unittest.main()
@@ -0,0 +1,123 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# the compiled kernels are only used if numba is installed, the simulations
+# fall back to their NumPy implementation otherwise
+HAS_NUMBA = numba is not None
+
+def _jit(func):
+    '''Compiles func with numba if it is installed. The compiled code is cached
+    on disk, so other processes (e.g. the workers of a pool) load it instead of
+    compiling it again.'''
+    if numba is None:
+        return func
+    return numba.njit(cache=True)(func)
+
+@_jit
+def _penalty(deltasoc, unit_deltasoc, tdelta):
+    '''`Battery._penalty` of a single unit.'''
+    full, rest = divmod(abs(deltasoc), unit_deltasoc)
+    return (full * unit_deltasoc ** 2 + rest ** 2) / tdelta
+
+@_jit
+def peak_shave_kernel(pnets, lowerlims, upperlims, soc, minsoc, maxsoc, maxcharge,
+                      maxdischarge, etacharge, etadischarge, selfdischarge,
+                      unit_charge, unit_discharge, is_liion, tdelta):
+    '''Runs the time loop of the peak-shave simulation for a population of energy
+    hubs: in every step the demand above the upper limit is discharged from, and
+    the demand below the lower limit is charged into the units of each hub in
+    order, as in `PopulationEnergyHub.exchange`.
+    Args:
+        - pnets: (steps,) array of the net power demands (in kW)
+        - lowerlims, upperlims: (steps, configs) arrays of the limits
+        - soc: (configs, units) array of the initial soc, updated in place
+        - minsoc, etacharge, etadischarge, selfdischarge: (units,) arrays of the
+            parameters of the units
+        - maxsoc, maxcharge, maxdischarge: (configs, units) arrays
+        - unit_charge, unit_discharge: (units,) arrays of the soc change of a
+            single Li-ion unit at full power, used by the penalty
+        - is_liion: (units,) boolean array of the Li-ion units
+        - tdelta: length of a step in hours
+    Returns:
+        - pboughts: (steps, configs) array of the power bought from the grid
+        - socs: (steps, configs) array of the total soc after each step
+        - penalties: (configs,) array of the total penalty of each hub'''
+    steps, size = lowerlims.shape
+    units = soc.shape[1]
+    pboughts = np.empty((steps, size))
+    socs = np.empty((steps, size))
+    penalties = np.zeros(size)
+
+    for idx in range(steps):
+        pnet = pnets[idx]
+        for conf in range(size):
+            pdischarge = max(pnet - upperlims[idx, conf], 0.)
+            pcharge = 0. if pdischarge > 0 else max(lowerlims[idx, conf] - pnet, 0.)
+
+            total_charge, total_discharge, total_soc = 0., 0., 0.
+            cumlimit = 0.
+            for unit in range(units):
+                value = soc[conf, unit]
+                value = value - selfdischarge[unit] * value
+                if pcharge > 0:
+                    limit = min(maxcharge[conf, unit],
+                                (maxsoc[conf, unit] - value) / etacharge[unit] / tdelta)
+                    cumlimit += limit
+                    charged = min(max(pcharge - (cumlimit - limit), 0.), limit)
+                    deltasoc = etacharge[unit] * (charged * tdelta)
+                    value = min(value + deltasoc, maxsoc[conf, unit])
+                    total_charge += charged
+                    if is_liion[unit]:
+                        penalties[conf] += _penalty(deltasoc, unit_charge[unit], tdelta)
+                elif pdischarge > 0:
+                    limit = etadischarge[unit] * min(maxdischarge[conf, unit],
+                                                     (value - minsoc[unit]) / tdelta)
+                    cumlimit += limit
+                    discharged = (min(max(pdischarge - (cumlimit - limit), 0.), limit) /
+                                  etadischarge[unit])
+                    deltasoc = etadischarge[unit] * (discharged * tdelta)
+                    value = value - deltasoc
+                    # same as `chop`
+                    if abs(value) <= 1e-10:
+                        value = 0.
+                    value = max(value, minsoc[unit])
+                    total_discharge += discharged
+                    if is_liion[unit]:
+                        penalties[conf] += _penalty(deltasoc, unit_discharge[unit], tdelta)
+                soc[conf, unit] = value
+                total_soc += value
+
+            pboughts[idx, conf] = pnet + total_charge - total_discharge
+            socs[idx, conf] = total_soc
+    return pboughts, socs, penalties
+
+def run_peak_shave_kernel(ehub, pnets, lowerlims, upperlims):
+    '''Runs `peak_shave_kernel` on the state of a `PopulationEnergyHub`, and
+    updates the soc of the hub.
+    Args:
+        - ehub: the `PopulationEnergyHub`.
+        - pnets: (steps,) array of the net power demands (in kW)
+        - lowerlims, upperlims: (steps, configs) arrays of the limits
+    Returns: see `peak_shave_kernel`.'''
+    unit_charge = np.zeros(ehub.is_liion.size)
+    unit_charge[ehub.is_liion] = ehub.unit_charge
+    unit_discharge = np.zeros(ehub.is_liion.size)
+    unit_discharge[ehub.is_liion] = ehub.unit_discharge
+
+    soc = np.array(ehub.soc, dtype=float)
+    shape = soc.shape
+    results = peak_shave_kernel(
+        np.ascontiguousarray(pnets, dtype=float),
+        np.ascontiguousarray(lowerlims, dtype=float),
+        np.ascontiguousarray(upperlims, dtype=float),
+        soc, ehub.minsoc, np.broadcast_to(ehub.maxsoc, shape).copy(),
+        np.broadcast_to(ehub.maxcharge, shape).copy(),
+        np.broadcast_to(ehub.maxdischarge, shape).copy(), ehub.etacharge,
+        ehub.etadischarge, np.asarray(ehub.selfdischarge, dtype=float), unit_charge,
+        unit_discharge, ehub.is_liion, float(ehub.tdelta))
+    ehub.soc = soc
+    return results
@@ -0,0 +1,323 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+import hashlib
+from itertools import accumulate
+import json
+import os
+import tempfile
+import zipfile
+import numpy as np
+
+def forward_rolling_median(values, window: int) -> np.ndarray:
+    '''Computes the median of the next `window` values for every position, that is,
+    the median of `values[idx:idx+window]` (shorter at the end of the data). The
+    window is kept sorted while it slides backwards over the data, so each step
+    is a bisect and an O(w) list insertion and deletion instead of a fresh sort.
+    Args:
+        - values: the data, e.g. the net power demand for every hour.
+        - window: the number of values in the window (e.g. the lookahead).
+    Returns: array containing the median of every window.'''
+    values = np.asarray(values, dtype=float).tolist()
+    size = len(values)
+    medians = np.empty(size)
+
+    ordered = []
+    for idx in range(size - 1, -1, -1):
+        insort(ordered, values[idx])
+        if idx + window < size:
+            del ordered[bisect_left(ordered, values[idx + window])]
+
+        mid = len(ordered) // 2
+        if len(ordered) % 2 == 1:
+            medians[idx] = ordered[mid]
+        else:
+            medians[idx] = (ordered[mid - 1] + ordered[mid]) / 2
+    return medians
+
+def const_limit_schedule(pnets, margin: float):
+    '''Computes the limits of `ConstLimPeakShaveSim` for the whole dataset.
+    Args:
+        - pnets: net power demand for every hour.
+        - margin: distance of the limits from the mean in percentage.
+    Returns:
+        - lowerlims: array of the lower limits
+        - upperlims: array of the upper limits'''
+    pnets = np.asarray(pnets, dtype=float)
+    mean_demand = pnets.mean()
+    return (np.full(pnets.size, mean_demand * (1 - margin)),
+            np.full(pnets.size, mean_demand * (1 + margin)))
+
+def median_limit_schedule(pnets, lookahead: int, margin: float):
+    '''Computes the lower and upper limits of `DynamicLimPeakShaveSim` for the whole
+    dataset.
+    Args:
+        - pnets: net power demand for every hour.
+        - lookahead: the amount of future steps used to determine the median.
+        - margin: distance of the limits from the median in percentage.
+    Returns:
+        - lowerlims: array of the lower limits
+        - upperlims: array of the upper limits'''
+    pmedians = forward_rolling_median(pnets, lookahead)
+    return pmedians * (1 - margin), pmedians * (1 + margin)
+
+class SortedWindow:
+    '''Sliding window of values kept in sorted order together with its prefix sums.
+    Adding or removing a value costs O(w): the sorted list is shifted and the
+    prefix sums are rebuilt before the next query, both in C, which is cheaper
+    than a tree in Python for windows of a few days. The area below a lower limit
+    and above an upper limit is then a bisect and two lookups, O(log w).'''
+
+    def __init__(self) -> None:
+        self.values = []
+        self.prefix = [0]
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value: float):
+        insort(self.values, value)
+        self.dirty = True
+
+    def remove(self, value: float):
+        del self.values[bisect_left(self.values, value)]
+        self.dirty = True
+
+    def _get_prefix(self) -> list[float]:
+        if self.dirty:
+            self.prefix = [0, *accumulate(self.values)]
+            self.dirty = False
+        return self.prefix
+
+    def area_below(self, limit: float) -> float:
+        '''Returns the total area of the values below limit.'''
+        prefix = self._get_prefix()
+        count = bisect_left(self.values, limit)
+        return count * limit - prefix[count]
+
+    def area_above(self, limit: float) -> float:
+        '''Returns the total area of the values above limit.'''
+        prefix = self._get_prefix()
+        count = bisect_right(self.values, limit)
+        return (prefix[-1] - prefix[count]) - (len(self.values) - count) * limit
+
+    def _imbalance(self, mid: float, margin: float) -> float:
+        return self.area_above(mid + margin) - self.area_below(mid - margin)
+
+    def _bracket(self, offset: float, margin: float, lo: float, hi: float):
+        '''Narrows [lo, hi] around the root of `_imbalance` using the breakpoints
+        `value + offset`. The imbalance is non-increasing in mid, so a binary
+        search finds the last breakpoint where it is still non-negative.'''
+        left, right = 0, len(self.values)
+        while left < right:
+            center = (left + right) // 2
+            if self._imbalance(self.values[center] + offset, margin) >= 0:
+                left = center + 1
+            else:
+                right = center
+        if left > 0:
+            lo = max(lo, min(self.values[left - 1] + offset, hi))
+        if left < len(self.values):
+            hi = min(hi, max(self.values[left] + offset, lo))
+        return lo, hi
+
+    def balance(self, margin: float = 0.25) -> tuple[float, float]:
+        '''Computes the limits of `util.compute_limits` for the values in the window:
+        an upper and a lower limit at a distance of `margin * (max - min)` from a
+        mid point, for which the area above the upper limit equals the area below
+        the lower limit. The area difference is piecewise linear in the mid point,
+        with breakpoints at `value +- margin`, so the mid point is found exactly by
+        locating the linear piece that contains the root.
+        Returns:
+            - lowerlimit: limit for the lower threshold (in kW)
+            - upperlimit: limit for the upper threshold (in kW)'''
+        bot, top = self.values[0], self.values[-1]
+        margin = (top - bot) * margin
+
+        # the imbalance is non-negative at bot and non-positive at top
+        lo, hi = bot, top
+        lo, hi = self._bracket(-margin, margin, lo, hi)
+        lo, hi = self._bracket(margin, margin, lo, hi)
+
+        flo, fhi = self._imbalance(lo, margin), self._imbalance(hi, margin)
+        if flo <= 0:
+            mid = lo
+        elif fhi >= 0:
+            mid = hi
+        else:
+            mid = lo + flo * (hi - lo) / (flo - fhi)
+        return mid - margin, mid + margin
+
+def equalized_limit_schedule(pnets, lookahead: int, margin: float = 0.25,
+                             factor: float = 1):
+    '''Computes the limits of `EqualizedLimPeakShaveSim` for the whole dataset in a
+    single pass. The limits of hour idx are computed from the window
+    `pnets[idx-lookahead:idx+lookahead]`, which is updated incrementally as idx
+    advances.
+    Args:
+        - pnets: net power demand for every hour.
+        - lookahead: the amount of past and future steps used to compute the limits.
+        - margin: see `util.compute_limits`.
+        - factor: the lower limits are multiplied by factor.
+    Returns:
+        - lowerlims: array of the lower limits
+        - upperlims: array of the upper limits'''
+    pnets = np.asarray(pnets, dtype=float).tolist()
+    size = len(pnets)
+    lowerlims, upperlims = np.empty(size), np.empty(size)
+
+    # same window bounds as EqualizedLimPeakShaveSim._get_limits
+    window = SortedWindow()
+    idxfrom, idxto = 0, 0
+    for idx in range(size):
+        newfrom, newto = max(0, idx - lookahead), min(size - 1, idx + lookahead)
+        for pos in range(idxto, newto):
+            window.add(pnets[pos])
+        for pos in range(idxfrom, newfrom):
+            window.remove(pnets[pos])
+        idxfrom, idxto = newfrom, max(idxto, newto)
+
+        lowerlims[idx], upperlims[idx] = window.balance(margin)
+    return lowerlims * factor, upperlims
+
+class LimitScheduleCache:
+    '''Memoizes limit schedules. The limits only depend on the data and on the
+    parameters of the strategy, never on the batteries, so a GA run can compute
+    each schedule once and share it between the fitness evaluations.
+    The cache keeps the `maxsize` most recently used schedules in memory, and if
+    `cachedir` is set, it also stores every schedule in an `.npz` file there.'''
+
+    def __init__(self, maxsize: int = 32, cachedir: str = None) -> None:
+        self.maxsize = maxsize
+        self.cachedir = cachedir
+        self.schedules = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(pnets) -> str:
+        '''Returns a hash of the data the limits are computed from.'''
+        pnets = np.ascontiguousarray(pnets, dtype=float)
+        return hashlib.sha1(pnets.tobytes()).hexdigest()
+
+    def _get_path(self, key: tuple) -> str:
+        name = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.cachedir, f'limits_{name}.npz')
+
+    @staticmethod
+    def _load(path: str):
+        '''Returns the schedule stored in path, or None if it is missing or
+        unreadable, e.g. written by a process that was killed.'''
+        try:
+            with np.load(path) as data:
+                return data['lower'], data['upper']
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return None
+
+    def _save(self, path: str, limits):
+        '''Writes the schedule into a temporary file next to path and moves it into
+        place, so the workers sharing the directory never read a partial file.'''
+        os.makedirs(self.cachedir, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=self.cachedir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                np.savez(file, lower=limits[0], upper=limits[1])
+            os.replace(tmppath, path)
+        except BaseException:
+            os.remove(tmppath)
+            raise
+
+    def get(self, strategy: str, pnets, compute, **params):
+        '''Returns the limit schedule for the given data and strategy, computing it
+        with `compute(pnets, **params)` if it is not cached yet.
+        Args:
+            - strategy: name of the limit strategy, e.g. `median`.
+            - pnets: net power demand for every hour.
+            - compute: function computing the schedule.
+            - **params: parameters of the strategy, e.g. margin and lookahead.
+        Returns:
+            - lowerlims: read-only array of the lower limits
+            - upperlims: read-only array of the upper limits'''
+        key = (self.fingerprint(pnets), strategy, sorted(params.items()))
+        # numpy scalars (e.g. genes) are converted to plain numbers
+        key = json.dumps(key, default=lambda value: value.item())
+        if key in self.schedules:
+            self.hits += 1
+            self.schedules.move_to_end(key)
+            return self.schedules[key]
+
+        path = None if self.cachedir is None else self._get_path(key)
+        limits = None if path is None else self._load(path)
+        if limits is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            limits = compute(pnets, **params)
+            if path is not None:
+                self._save(path, limits)
+
+        for array in limits:
+            array.flags.writeable = False
+        self.schedules[key] = limits
+        if len(self.schedules) > self.maxsize:
+            self.schedules.popitem(last=False)
+        return limits
+
+SCHEDULE_CACHE = LimitScheduleCache()
+
+if __name__ == '__main__':
+    import unittest
+    import pandas as pd
+    from util import compute_limits
+
+    class TestLimits(unittest.TestCase):
+        def _get_pnets(self, size: int) -> np.ndarray:
+            rng = np.random.default_rng(0)
+            return (2000 + 1500 * np.sin(np.arange(size) * 2 * np.pi / 24) +
+                    rng.normal(0, 300, size))
+
+        def test1(self):
+            pnets = self._get_pnets(500)
+            for window in (1, 4, 24, 25):
+                # the pandas median of the reversed data is the forward median
+                expected = (pd.Series(pnets[::-1]).rolling(window, min_periods=1)
+                            .median().to_numpy()[::-1])
+                np.testing.assert_allclose(forward_rolling_median(pnets, window),
+                                           expected, rtol=1e-12)
+
+        def test2(self):
+            pnets = self._get_pnets(300)
+            lookahead = 24
+            lowerlims, upperlims = equalized_limit_schedule(pnets, lookahead)
+            # same windows as EqualizedLimPeakShaveSim._get_limits
+            for idx in range(len(pnets)):
+                window = pnets[max(0, idx - lookahead):min(len(pnets) - 1, idx + lookahead)]
+                lowerlim, upperlim = compute_limits(window, tolerance=1e-6)
+                self.assertAlmostEqual(lowerlims[idx], lowerlim, delta=1e-6)
+                self.assertAlmostEqual(upperlims[idx], upperlim, delta=1e-6)
+
+        def test3(self):
+            calls = []
+            def compute(pnets, margin):
+                calls.append(margin)
+                return const_limit_schedule(pnets, margin)
+
+            pnets = self._get_pnets(48)
+            with tempfile.TemporaryDirectory() as cachedir:
+                LimitScheduleCache(cachedir=cachedir).get('const', pnets, compute,
+                                                          margin=.1)
+                self.assertEqual(len(os.listdir(cachedir)), 1)
+                # a truncated file is computed again and replaced
+                path = os.path.join(cachedir, os.listdir(cachedir)[0])
+                with open(path, 'r+b') as file:
+                    file.truncate(10)
+                cache = LimitScheduleCache(cachedir=cachedir)
+                lowerlims, _ = cache.get('const', pnets, compute, margin=.1)
+                self.assertEqual((calls, cache.misses), ([.1, .1], 1))
+                np.testing.assert_allclose(lowerlims, pnets.mean() * .9)
+                self.assertEqual(os.listdir(cachedir), [os.path.basename(path)])
+                cache = LimitScheduleCache(cachedir=cachedir)
+                cache.get('const', pnets, compute, margin=.1)
+                self.assertEqual((calls, cache.hits), ([.1, .1], 1))
+
+    unittest.main()
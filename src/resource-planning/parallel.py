@@ -0,0 +1,117 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+class SharedDataFrame:
+    '''Places the columns of a DataFrame in a single shared memory block, so the
+    worker processes of a pool can map the dataset instead of each one parsing or
+    unpickling its own copy. Only numeric and datetime columns are shared, the
+    simulations do not use the others. Timezone aware timestamps are stored in UTC.
+    Args:
+        - df: pandas.DataFrame to share.'''
+
+    def __init__(self, df: pd.DataFrame) -> None:
+        arrays, columns, offset = [], [], 0
+        for name in df.columns:
+            tz = None
+            if isinstance(df[name].dtype, pd.DatetimeTZDtype):
+                tz = str(df[name].dt.tz)
+                values = df[name].dt.tz_convert('UTC').dt.tz_localize(None).to_numpy()
+            else:
+                values = df[name].to_numpy()
+            if values.dtype.kind not in 'biufM':
+                continue
+            values = np.ascontiguousarray(values)
+            # every column starts at an aligned offset
+            offset = -(-offset // 8) * 8
+            arrays.append((offset, values))
+            columns.append({'name': name, 'dtype': values.dtype.str, 'offset': offset,
+                            'tz': tz})
+            offset += values.nbytes
+
+        self.length = len(df)
+        self.columns = columns
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for offset, values in arrays:
+            target = np.ndarray(values.shape, dtype=values.dtype, buffer=self.shm.buf,
+                                offset=offset)
+            target[:] = values
+
+    def get_spec(self) -> dict:
+        '''Returns the picklable description of the block used by `attach`.'''
+        return {'name': self.shm.name, 'length': self.length, 'columns': self.columns}
+
+    @staticmethod
+    def attach(spec: dict) -> tuple[pd.DataFrame, shared_memory.SharedMemory]:
+        '''Maps a shared block created by another process as a DataFrame. The
+        columns are read-only views of the block, except for the timezone aware
+        ones. The returned SharedMemory has to be kept alive while the DataFrame
+        is used.'''
+        shm = shared_memory.SharedMemory(name=spec['name'])
+        data = {}
+        for col in spec['columns']:
+            values = np.ndarray((spec['length'],), dtype=np.dtype(col['dtype']),
+                                buffer=shm.buf, offset=col['offset'])
+            values.flags.writeable = False
+            if col['tz'] is not None:
+                values = pd.DatetimeIndex(values).tz_localize('UTC').tz_convert(col['tz'])
+            data[col['name']] = values
+        return pd.DataFrame(data, copy=False), shm
+
+    def close(self):
+        '''Releases the block. Views of it must not be used afterwards.'''
+        self.shm.close()
+        self.shm.unlink()
+
+# state of a worker process, set by `_init_worker`
+_WORKER_SHM = None
+
+def _init_worker(spec: dict, initializer, initargs: tuple):
+    global _WORKER_SHM
+    df, _WORKER_SHM = SharedDataFrame.attach(spec)
+    initializer(df, *initargs)
+
+class FitnessPool:
+    '''Persistent pool of processes evaluating a fitness function on the solutions
+    of a GA population. The dataset is shared with the workers once, when the pool
+    is created, and the workers are reused in every generation.
+
+    `evaluate` has the signature of a batch fitness function of pygad, so passing
+    it as `fitness_func` with `fitness_batch_size=sol_per_pop` evaluates the new
+    solutions of each generation in parallel.
+    Args:
+        - fitness_func: function(solution, solution_idx) -> fitness, it has to be
+            picklable, i.e. defined at the top level of a module.
+        - df: dataset of the simulations.
+        - workers: number of processes.
+        - initializer: function(df, *initargs) called in every worker with the
+            shared dataset, e.g. to set the globals used by fitness_func.
+        - initargs: additional arguments of initializer.'''
+
+    def __init__(self, fitness_func, df: pd.DataFrame, workers: int,
+                 initializer, initargs: tuple = ()) -> None:
+        self.fitness_func = fitness_func
+        self.shared = SharedDataFrame(df)
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(self.shared.get_spec(), initializer, initargs))
+
+    def evaluate(self, solutions, indices) -> list[float]:
+        '''Returns the fitness of every solution in the batch.'''
+        return list(self.imap(solutions, indices))
+
+    def imap(self, solutions, indices):
+        '''Returns an iterator over the fitness of the solutions, in order. The
+        values are yielded as soon as they are computed.'''
+        return self.executor.map(self.fitness_func, solutions, indices)
+
+    def close(self):
+        self.executor.shutdown()
+        self.shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -1,21 +1,103 @@
 import argparse
+import math
 from typing import Type
 import gym
+import numpy as np
 import pandas as pd
 from batteries import EnergyHub
 from greedy import GreedySim
+from limits import SCHEDULE_CACHE
+from limits import const_limit_schedule
+from limits import equalized_limit_schedule
+from limits import median_limit_schedule
 from util import calc_above_limit, calc_max_bought, process_file
 from util import compute_limits
 from util import calc_fluctuation
 from util import calc_periodic_fluctuation
 from util import calc_peak_power_sum
-from util import is_peak
+from util import find_peaks, get_peak_window
+from util import SimulationTrace, MetricsAccumulator, hours_of_day, infer_tdelta
+
+# objectives that can only grow as a simulation advances, so a simulation can be
+# aborted as soon as a lower bound of them exceeds a cutoff
+PRUNABLE_METRICS = {'peak_power_sum', 'sum_above_limit', 'energy_costs', 'total_costs'}
+
+class Incumbent:
+    '''The lowest value of a prunable metric over the whole (not aborted)
+    simulations of a process. With early abort, it is the cutoff of the next
+    simulations, see `objective`. Every worker process keeps its own incumbent.
+    Args:
+        - metric: one of `PRUNABLE_METRICS`.
+        - enabled: if False, the simulations are never aborted.'''
+
+    def __init__(self, metric: str = 'peak_power_sum', enabled: bool = False) -> None:
+        if enabled and metric not in PRUNABLE_METRICS:
+            raise ValueError(f'Early abort needs a metric of {sorted(PRUNABLE_METRICS)}!')
+        self.metric = metric
+        self.enabled = enabled
+        self.value = math.inf
+
+    def get_cutoff_config(self) -> dict:
+        '''Returns the cutoff parameters of the next simulation, see `objective`.'''
+        if not self.enabled:
+            return {}
+        return {'cutoff': self.value, 'cutoff_metric': self.metric}
+
+    def update(self, costs: dict, metrics: dict):
+        '''Lowers the cutoff to the result of a simulation, unless it was aborted.'''
+        if not self.enabled or metrics['pruned']:
+            return
+        value = costs[self.metric] if self.metric in costs else metrics[self.metric]
+        self.value = min(self.value, value)
+
+def get_energy_bounds(pnets, prices, lowerlims, upperlims, tdelta=1) -> np.ndarray:
+    '''Returns the lower bounds of the energy costs of the steps from each step to
+    the end of the data. The bought power of a step is at least min(pnet, upper),
+    as the batteries only discharge the demand above the upper limit, and at most
+    max(pnet, lower), as they only charge below the lower limit.
+    Args:
+        - pnets, prices: arrays of the net power demands and the prices.
+        - lowerlims, upperlims: (steps,) or (steps, configs) arrays of the limits.
+        - tdelta: length of a step in hours.
+    Returns: array of steps+1 rows, row idx is the bound of the steps [idx, steps).'''
+    pnets = np.asarray(pnets, dtype=float)
+    prices = np.asarray(prices, dtype=float)
+    if np.ndim(lowerlims) == 2:
+        pnets, prices = pnets[:, np.newaxis], prices[:, np.newaxis]
+    pboughts = np.where(prices >= 0, np.minimum(pnets, upperlims),
+                        np.maximum(pnets, lowerlims))
+    costs = prices * tdelta / 100 * pboughts
+    suffix = np.cumsum(costs[::-1], axis=0)[::-1]
+    return np.concatenate((suffix, np.zeros_like(suffix[:1])))
+
+def get_peak_sum(pboughts, uppers, start: int, end: int, delta: int):
+    '''Returns the sum of the peaks above the upper limit among the steps
+    [start, end), like `calc_peak_power_sum`. The steps need their whole peak
+    window in pboughts, so only the steps before len(pboughts) - delta are final,
+    unless pboughts covers the whole data.
+    Args:
+        - pboughts, uppers: (steps,) arrays, or (steps, configs) arrays of several
+            simulations.
+        - start, end: the range of the steps.
+        - delta: half width of the window of the peak test.
+    Returns: the sum, or an array of the sum of each simulation.'''
+    lo, hi = max(0, start - delta), min(len(pboughts), end + delta)
+    values = pboughts[start:end] - uppers[start:end]
+    peaks = find_peaks(pboughts[lo:hi], delta)[start - lo:end - lo] & (values > 0)
+    return np.where(peaks, values, 0).sum(axis=0)
+
+def get_simulation_hours(df: pd.DataFrame) -> int:
+    '''Returns the length of the simulated period in whole hours, from the first
+    to the last timestamp of the data.'''
+    delta = df.iloc[-1]['timestamp'] - df.iloc[0]['timestamp']
+    return delta.days * 24 + delta.seconds // 60 // 60
 
 class PeakShaveEnv(gym.Env):
     def __init__(self, config: dict) -> None:
         super().__init__()
 
         self.limdelta = config['delta_limit']
+        self.tdelta = config.get('tdelta', 1)
         self.upperlim = 3000
         self.lowerlim = 1000
         self.ehub = EnergyHub(config)
@@ -85,6 +167,7 @@ class PeakShaveEnv(gym.Env):
             - action: not implemented yet # TODO
             - pnet: net power demand for the next time period (in kW)
             - price: price of electricity in the next time period (in cents/kWh)
+        The length of the time period is `tdelta` hours (see the config).
         Returns:
             - state: not implemented yet # TODO
             - reward: total cost in cents to pay to the grid (negative value)
@@ -137,7 +220,7 @@ class PeakShaveEnv(gym.Env):
 
         infos['pbought'] = pbought
         infos['soc'] = self.ehub.get_soc()
-        cost = price * pbought / 100
+        cost = price * pbought * self.tdelta / 100
         reward = -cost - total_penalty
 
         if __debug__ and verbose:
@@ -154,6 +237,39 @@ class PeakShaveEnv(gym.Env):
 
         return state, reward, done, infos
 
+    def exchange(self, pnet: float) -> tuple[float, float]:
+        '''Charges or discharges the batteries based on the net power demand and the
+        current limits, like `step` does, but without executing an action and
+        without building the infos and the report.
+        Args:
+            - pnet: net power demand for the next time period (in kW)
+        Returns:
+            - pbought: power taken from the grid (in kW)
+            - penalty: total penalty signal from charging a Li-ion battery'''
+        if pnet > self.upperlim:
+            total_discharge, _, penalty = self.ehub.discharge(pnet - self.upperlim)
+            return pnet - total_discharge, penalty
+        if pnet < self.lowerlim:
+            total_charge, _, penalty = self.ehub.charge(self.lowerlim - pnet)
+            return pnet + total_charge, penalty
+        self.ehub.do_nothing()
+        return pnet, 0
+
+    def idle(self, pnets: np.ndarray, prices: np.ndarray):
+        '''Makes len(pnets) simulation steps during which the net power demand stays
+        between the lower and the upper limit, so the batteries only self-discharge.
+        The state-of-charge is advanced in closed form instead of step by step.
+        Args:
+            - pnets: net power demands of the steps (in kW)
+            - prices: prices of electricity in the steps (in cents/kWh)
+        Returns:
+            - rewards: array of the rewards of the steps, see `step`
+            - socs: array of the state-of-charge after each step
+            - total_selfdischarge: charge lost to self-discharge during the steps'''
+        socs, total_selfdischarge = self.ehub.idle(len(pnets))
+        rewards = -prices * pnets * self.tdelta / 100
+        return rewards, socs, total_selfdischarge
+
 class PeakShaveSim:
     def __init__(self, config, df=None):
         '''Creates a PeakShaveEnv environment for the simulation.
@@ -166,10 +282,13 @@ class PeakShaveSim:
                 - `LiIonBattery`: number of Li-Ion batteries.
                 - `Flywheel`: number of flywheels.
                 - `Supercapacitor`: number of supercapacitors.
+                - `tdelta`: length of a step in hours, inferred from the
+                    timestamps of the data if not provided.
             - df: pandas.DataFrame containing the net load and price data.
         '''
-        self.env = PeakShaveEnv(config)
         self.df = self._read_df(config['filename']) if df is None else df
+        self.tdelta = config.get('tdelta') or infer_tdelta(self.df['timestamp'])
+        self.env = PeakShaveEnv(dict(config, tdelta=self.tdelta))
 
     def _read_df(self, fname: str) -> pd.DataFrame:
         df = pd.read_csv(fname)
@@ -181,10 +300,7 @@ class PeakShaveSim:
     def _compute_capex_opex(self) -> tuple[float, float]:
         '''Computes the capital and the operational expenses of the energy hub by first
         determining the length of the period'''
-        start = self.df.iloc[0]['ReadTimestamp']
-        end = self.df.iloc[-1]['ReadTimestamp']
-        delta = end - start # simulation time
-        delta = delta.days * 24 + delta.seconds // 60 // 60 # simulation in hours
+        delta = get_simulation_hours(self.df)
 
         capex = self.env.ehub.get_capex(delta)
         opex = self.env.ehub.get_opex(delta)
@@ -220,22 +336,127 @@ class PeakShaveSim:
     def _get_limits(self, **kwargs):
         raise NotImplementedError()
 
-    def run(self, **kwargs):
+    def _get_limit_schedule(self, **kwargs) -> tuple[np.ndarray, np.ndarray]:
+        '''Returns the lower and the upper limits for every step of the simulation.
+        By default `_get_limits` is called for each row of the data.'''
+        limits = [self._get_limits(idx=idx, datarow=datarow, **kwargs)
+                  for idx, datarow in self.df.iterrows()]
+        lowerlims, upperlims = np.array(limits, dtype=float).reshape(-1, 2).T
+        return lowerlims, upperlims
+
+    @staticmethod
+    def _get_segments(idle: np.ndarray) -> list[tuple[int, int, bool]]:
+        '''Splits the steps into runs of consecutive idle and non-idle steps.
+        Returns: list of (`start`, `end`, `is_idle`) tuples.'''
+        bounds = np.flatnonzero(idle[1:] != idle[:-1]) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(idle)]))
+        return [(start, end, bool(idle[start]))
+                for start, end in zip(starts.tolist(), ends.tolist())]
+
+    def simulate(self, **kwargs) -> tuple[dict, SimulationTrace]:
+        '''Runs the simulation on contiguous arrays. The net power, the price and the
+        timestamp columns are read once, the limits are computed for the whole
+        horizon in advance, and the results of the steps are written into
+        preallocated arrays.
+        Args:
+            - **kwargs: see `run`, and the following:
+                - trace_dtype: precision of the stored trace, e.g. `np.float32`.
+                - metrics: `MetricsAccumulator` updated in every step.
+                - store_trace: if False, the steps are not stored and no trace
+                    is returned, the metrics can be computed with `metrics`.
+                - cutoff: if set, the simulation is aborted as soon as a lower
+                    bound of `cutoff_metric` exceeds it. `pruned` and `bound` are
+                    set on the simulation, and the costs and the trace only cover
+                    the steps simulated.
+                - cutoff_metric: one of `PRUNABLE_METRICS`, `peak_power_sum` by
+                    default. The peak and the limit metrics need `metrics`.
+        Returns:
+            - costs: dict containing `energy_costs`, `capex`, `opex` and
+                `total_costs`.
+            - trace: `SimulationTrace` with one element per step, or None.'''
         verbose = False if 'verbose' not in kwargs.keys() else kwargs['verbose']
+        trace_dtype = kwargs.get('trace_dtype', np.float64)
+        metrics = kwargs.get('metrics')
+        store_trace = kwargs.get('store_trace', True)
+        cutoff = kwargs.get('cutoff')
+        cutoff_metric = kwargs.get('cutoff_metric', 'peak_power_sum')
 
         energy_costs, total_costs = 0, 0
-        powers = []
-
-        for idx, datarow in self.df.iterrows():
-            lowerlim, upperlim = self._get_limits(idx=idx, datarow=datarow, **kwargs)
-            self.env.set_limits(lowerlim, upperlim)
-
-            pnet = datarow['net']
-            price = datarow['price (cents/kWh)']
-            _, reward, _, infos = self.env.step(0, pnet, price, verbose=verbose)
-            powers.append((datarow['timestamp'], infos['pnet'], infos['pbought'],
-                           infos['soc'], lowerlim, upperlim))
-            energy_costs += -reward
+        self.pruned, self.bound = False, None
+
+        lowerlims, upperlims = self._get_limit_schedule(**kwargs)
+        timestamps = self.df['timestamp'].to_numpy()
+        pnets = self.df['net'].to_numpy(dtype=float)
+        prices = self.df['price (cents/kWh)'].to_numpy(dtype=float)
+        if store_trace:
+            pboughts = np.empty_like(pnets)
+            socs = np.empty_like(pnets)
+        if metrics is not None:
+            hours = hours_of_day(timestamps)
+        if cutoff is not None:
+            if cutoff_metric not in PRUNABLE_METRICS:
+                raise ValueError(f'{cutoff_metric} is not one of {PRUNABLE_METRICS}!')
+            if metrics is None and cutoff_metric in {'peak_power_sum', 'sum_above_limit'}:
+                raise ValueError(f'The bound of {cutoff_metric} needs `metrics`!')
+            energy_bounds = get_energy_bounds(pnets, prices, lowerlims, upperlims,
+                                              self.tdelta)
+            capex, opex = self._compute_capex_opex()
+
+        def is_pruned(end: int) -> bool:
+            '''Checks the bound of the metric after the first end steps.'''
+            if cutoff_metric == 'peak_power_sum':
+                # the peaks whose window is complete
+                bound = metrics.peak_sum
+            elif cutoff_metric == 'sum_above_limit':
+                bound = metrics.sum_above_limit * self.tdelta
+            else:
+                bound = energy_costs + energy_bounds[end]
+                if cutoff_metric == 'total_costs':
+                    bound += capex + opex
+            if bound > cutoff:
+                self.pruned, self.bound = True, bound
+            return self.pruned
+
+        # in verbose mode every step is reported, so idle runs are not merged
+        idle = (lowerlims <= pnets) & (pnets <= upperlims) & (not verbose)
+        # number of the steps simulated
+        steps = len(pnets)
+        for start, end, is_idle in self._get_segments(idle):
+            if self.pruned:
+                break
+            if is_idle:
+                self.env.set_limits(lowerlims[end - 1], upperlims[end - 1])
+                rewards, idle_socs, _ = self.env.idle(pnets[start:end], prices[start:end])
+                if store_trace:
+                    socs[start:end] = idle_socs
+                    pboughts[start:end] = pnets[start:end]
+                if metrics is not None:
+                    metrics.extend(hours[start:end], pnets[start:end],
+                                   upperlims[start:end])
+                energy_costs += -rewards.sum()
+                if cutoff is not None and is_pruned(end):
+                    steps = end
+                continue
+
+            for idx in range(start, end):
+                self.env.set_limits(lowerlims[idx], upperlims[idx])
+                if verbose:
+                    _, reward, _, infos = self.env.step(0, pnets[idx], prices[idx],
+                                                        verbose=True)
+                    pbought = infos['pbought']
+                else:
+                    pbought, penalty = self.env.exchange(pnets[idx])
+                    reward = -prices[idx] * pbought * self.tdelta / 100 - penalty
+                if store_trace:
+                    pboughts[idx] = pbought
+                    socs[idx] = self.env.ehub.get_soc()
+                if metrics is not None:
+                    metrics.update(hours[idx], pbought, upperlims[idx])
+                energy_costs += -reward
+                if cutoff is not None and is_pruned(idx + 1):
+                    steps = idx + 1
+                    break
 
         capex, opex = self._compute_capex_opex()
         total_costs += capex + opex + energy_costs
@@ -246,8 +467,27 @@ class PeakShaveSim:
             'opex': opex,
             'total_costs': total_costs
         }
+        trace = None
+        if store_trace:
+            trace = SimulationTrace(timestamps[:steps], pnets[:steps], pboughts[:steps],
+                                    socs[:steps], lowerlims[:steps], upperlims[:steps],
+                                    dtype=trace_dtype)
+
+        return costs, trace
 
-        return costs, powers
+    def run(self, **kwargs):
+        '''Runs the simulation and returns the results as a list of tuples. This is
+        an adapter around `simulate`.
+        Args:
+            - **kwargs: parameters of the limit strategy, and `verbose` to print
+                a report in every step.
+        Returns:
+            - costs: dict containing `energy_costs`, `capex`, `opex` and
+                `total_costs`.
+            - powers: list of (`timestamp`, `pnet`, `pbought`, `soc`, `lower`,
+                `upper`) tuples, one for each step.'''
+        costs, trace = self.simulate(**kwargs)
+        return costs, trace.to_powers()
 
 class ConstLimPeakShaveSim(PeakShaveSim):
     '''Peak-shave simulation with constant limits.
@@ -256,13 +496,19 @@ class ConstLimPeakShaveSim(PeakShaveSim):
 
     def _get_limits(self, **kwargs):
         return self.lowerlim, self.upperlim
-    
-    def run(self, **kwargs):
+
+    @staticmethod
+    def compute_limit_schedule(pnets, **kwargs):
+        '''Returns the limits of every step for the net power demands pnets.'''
+        return SCHEDULE_CACHE.get('const', pnets, const_limit_schedule,
+                                  margin=kwargs['margin'])
+
+    def _get_limit_schedule(self, **kwargs):
         self.margin = kwargs['margin']
-        mean_demand = self.df['net'].mean()
-        self.upperlim = mean_demand * (1 + self.margin)
-        self.lowerlim = mean_demand * (1 - self.margin)
-        return super().run(**kwargs)
+        lowerlims, upperlims = self.compute_limit_schedule(self.df['net'].to_numpy(),
+                                                           **kwargs)
+        self.lowerlim, self.upperlim = lowerlims[0], upperlims[0]
+        return lowerlims, upperlims
 
 class DynamicLimPeakShaveSim(PeakShaveSim):
     '''Peak-shave simulation with dynamically changing upper and lower limits. The
@@ -283,6 +529,15 @@ class DynamicLimPeakShaveSim(PeakShaveSim):
         upperlim = pmedian * (1 + margin)
         return lowerlim, upperlim
 
+    @staticmethod
+    def compute_limit_schedule(pnets, **kwargs):
+        '''Returns the limits of every step for the net power demands pnets.'''
+        return SCHEDULE_CACHE.get('median', pnets, median_limit_schedule,
+                                  lookahead=kwargs['lookahead'], margin=kwargs['margin'])
+
+    def _get_limit_schedule(self, **kwargs):
+        return self.compute_limit_schedule(self.df['net'].to_numpy(), **kwargs)
+
 class EqualizedLimPeakShaveSim(PeakShaveSim):
     '''Peak-shave simulation with dynamically changing upper and lower limits. The
     algorithm looks ahead into the future (e.g. through prediction) and computes the
@@ -292,7 +547,8 @@ class EqualizedLimPeakShaveSim(PeakShaveSim):
     Adjustable parameters:
         - lookahead: the amount of future steps used to compute the limits.
         - tolerance: the limit computing algorithm stops if the difference between
-            the areas under the curve is below the tolerance level (in kWh).
+            the areas under the curve is below the tolerance level (in kWh). Only
+            used by `_get_limits`, the limit schedule of a run is solved exactly.
     '''
     def _get_limits(self, **kwargs):
         idx = kwargs['idx']
@@ -306,8 +562,19 @@ class EqualizedLimPeakShaveSim(PeakShaveSim):
         lowerlim, upperlim = compute_limits(next_pnets, tolerance)
         return lowerlim, upperlim
 
+    @staticmethod
+    def compute_limit_schedule(pnets, **kwargs):
+        '''Returns the limits of every step for the net power demands pnets.'''
+        # the limits are solved exactly, so the tolerance is not needed here
+        return SCHEDULE_CACHE.get('equalized', pnets, equalized_limit_schedule,
+                                  lookahead=kwargs['lookahead'])
+
+    def _get_limit_schedule(self, **kwargs):
+        return self.compute_limit_schedule(self.df['net'].to_numpy(), **kwargs)
+
 def objective(SimClass: Type[PeakShaveSim], df: pd.DataFrame, liion_cnt: int,
-              flywh_cnt: int, sucap_cnt: int, **run_config):
+              flywh_cnt: int, sucap_cnt: int, aggregate=False, store_trace=True,
+              **run_config):
     '''Objective function for the peak-shave optimization problem.
     Args:
         - SimClass: class of simulation type to run. E.g.: ConstLimPeakShaveSim
@@ -316,35 +583,143 @@ def objective(SimClass: Type[PeakShaveSim], df: pd.DataFrame, liion_cnt: int,
         - liion_cnt: number of LiIon batteries
         - flywh_cnt: number of flywheel batteries
         - sucap_cnt: number of supercapacitors
-        - **run_config: value fed to the class's run method.
+        - aggregate: represent the batteries of each type as one scaled unit, so
+            the cost of the simulation does not depend on the battery counts.
+        - store_trace: if False, the metrics are accumulated during the simulation
+            and the steps are not stored.
+        - **run_config: value fed to the class's simulate method, e.g. `cutoff`
+            and `cutoff_metric` to abort the simulations that can not get below
+            the cutoff.
 
     Returns:
         - costs: dict containing amount spent on buying electricity from the grid.
         - metrics: dict containing the following metrics: `fluctuation`,
-            `mean_periodic_fluctuation`, `peak_power_sum`, `peak_power_count`
+            `mean_periodic_fluctuation`, `peak_power_sum`, `peak_power_count`.
+            With a cutoff, `pruned` tells if the simulation was aborted. The
+            costs and metrics of an aborted one only cover the steps simulated,
+            and the cutoff metric is its lower bound.
     '''
     config = {
         'delta_limit': 1,
         'LiIonBattery': liion_cnt,
         'Flywheel': flywh_cnt,
-        'Supercapacitor': sucap_cnt
+        'Supercapacitor': sucap_cnt,
+        'aggregate': aggregate
     }
     sim = SimClass(config, df)
-    costs, powers = sim.run(**run_config)
+    # the data of representative days is weighted, which needs the trace
+    weighted = 'weight' in df.columns
+    if weighted and run_config.get('cutoff') is not None:
+        raise ValueError('A cutoff is not supported with representative days!')
+    if not store_trace and not weighted:
+        accumulator = MetricsAccumulator(tdelta=sim.tdelta)
+        costs, _ = sim.simulate(metrics=accumulator, store_trace=False, **run_config)
+        return flag_pruned(costs, accumulator.get_metrics(), run_config,
+                           getattr(sim, 'bound', None))
+
+    if run_config.get('cutoff') is not None:
+        # the peak and the limit bounds are accumulated step by step, `GreedySim` is
+        # never aborted
+        run_config = dict(run_config, metrics=MetricsAccumulator(tdelta=sim.tdelta))
+    costs, trace = sim.simulate(**run_config)
+    if weighted:
+        return estimate_results(df, costs, trace, sim.tdelta,
+                                peaks=SimClass is not GreedySim)
+    metrics = compute_metrics(trace, sim.tdelta, peaks=SimClass is not GreedySim)
+    return flag_pruned(costs, metrics, run_config, getattr(sim, 'bound', None))
+
+def flag_pruned(costs: dict, metrics: dict, run_config: dict,
+                bound: float = None) -> tuple[dict, dict]:
+    '''Adds the `pruned` flag to the metrics of a simulation with a cutoff. The
+    cutoff metric of an aborted simulation is replaced with its bound, and the
+    other costs and metrics accumulated over the run are unknown (NaN).
+    Args:
+        - costs, metrics: results of the simulation.
+        - run_config: parameters of the simulation, see `PeakShaveSim.simulate`.
+        - bound: the bound of the aborted simulation, None if it was not aborted.
+    Returns: the costs and the metrics.'''
+    if run_config.get('cutoff') is None:
+        return costs, metrics
+    metrics['pruned'] = bound is not None
+    if bound is not None:
+        for key in PRUNABLE_METRICS | {'peak_power_count'}:
+            (costs if key in {'energy_costs', 'total_costs'} else metrics)[key] = math.nan
+        metric = run_config.get('cutoff_metric', 'peak_power_sum')
+        (costs if metric in costs else metrics)[metric] = bound
+    return costs, metrics
 
+def compute_metrics(trace: SimulationTrace, tdelta=1, peaks=True) -> dict:
+    '''Computes the metrics of a simulation from its trace.
+    Args:
+        - trace: `SimulationTrace` of the simulation.
+        - tdelta: length of a step in hours.
+        - peaks: if True, the metrics related to the upper limit are computed as
+            well, the trace needs the limits for them.
+    Returns: dict containing the metrics, see `objective`.'''
     metrics = {
-        'fluctuation': calc_fluctuation(powers),
-        'mean_periodic_fluctuation': calc_periodic_fluctuation(powers),
-        'max_bought': calc_max_bought(powers),
+        'fluctuation': calc_fluctuation(trace),
+        'mean_periodic_fluctuation': calc_periodic_fluctuation(trace),
+        'max_bought': calc_max_bought(trace),
     }
 
-    if SimClass is not GreedySim:
-        ppsum, ppcount = calc_peak_power_sum(powers)
+    if peaks:
+        ppsum, ppcount = calc_peak_power_sum(trace, tdelta)
         metrics['peak_power_sum'] = ppsum
         metrics['peak_power_count'] = ppcount
-        metrics['sum_above_limit'] = calc_above_limit(powers)
+        metrics['sum_above_limit'] = calc_above_limit(trace, tdelta)
+    return metrics
+
+def estimate_results(df: pd.DataFrame, costs: dict, trace: SimulationTrace, tdelta=1,
+                     peaks=True) -> tuple[dict, dict]:
+    '''Estimates the costs and the metrics of the whole period from a simulation of
+    representative days (see `representative_days.build_dataset`). Every step
+    counts as many times as its `weight`, the number of days its day represents.
+    Args:
+        - df: the data of the representative days, whole days with a `weight`
+            column.
+        - costs: costs of the simulation of df.
+        - trace: `SimulationTrace` of the simulation of df.
+        - tdelta: length of a step in hours.
+        - peaks: see `compute_metrics`.
+    Returns: the estimated costs and metrics, see `objective`.'''
+    weights = df['weight'].to_numpy(dtype=float)
+    prices = df['price (cents/kWh)'].to_numpy(dtype=float)
+    pbought = trace.pbought.astype(float, copy=False)
+
+    # the penalties of the batteries are not traced, they are scaled by the mean
+    # weight, and the capex and opex by the length of the whole period
+    bought = prices * tdelta / 100 * pbought
+    penalty = costs['energy_costs'] - bought.sum()
+    energy_costs = weights @ bought + penalty * weights.mean()
+    scale = (weights.sum() - 1) * tdelta / max(get_simulation_hours(df), 1)
+    capex, opex = costs['capex'] * scale, costs['opex'] * scale
+    estimated_costs = {'energy_costs': energy_costs, 'capex': capex, 'opex': opex,
+                       'total_costs': capex + opex + energy_costs}
+
+    # every day is a period of the periodic fluctuation
+    steps = round(24 / tdelta)
+    days = pbought.reshape(-1, steps)
+    day_weights = weights[::steps]
+    day_sums = days.sum(axis=1)
+    day_flucts = np.zeros(len(days))
+    nonzero = day_sums != 0
+    day_flucts[nonzero] = (np.abs(np.diff(days[nonzero], axis=1)).sum(axis=1) /
+                           (day_sums[nonzero] / steps))
+    metrics = {
+        'fluctuation': float(weights[1:] @ np.abs(np.diff(pbought)) /
+                             (weights @ pbought / weights.sum())),
+        'mean_periodic_fluctuation': float(day_weights @ day_flucts / day_weights.sum()),
+        'max_bought': float(pbought.max()),
+    }
 
-    return costs, metrics
+    if peaks:
+        upper = trace.upper.astype(float, copy=False)
+        peak = find_peaks(pbought, get_peak_window(tdelta)) & (pbought > upper)
+        metrics['peak_power_sum'] = float(weights[peak] @ (pbought - upper)[peak])
+        metrics['peak_power_count'] = float(weights[peak].sum())
+        metrics['sum_above_limit'] = float(weights @ np.maximum(pbought - upper, 0) *
+                                           tdelta)
+    return estimated_costs, metrics
 
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
@@ -366,10 +741,11 @@ def get_args() -> argparse.Namespace:
     return args
 
 def observe_powers(powers: list, df_log=False):
+    peaks = find_peaks([power[2] for power in powers], 10)
     for idx, power in enumerate(powers):
         if df_log:
             power = list(power)
-            if is_peak(powers, idx, 10):
+            if peaks[idx]:
                 power.append(1)
             else:
                 power.append(0)
@@ -382,7 +758,7 @@ def observe_powers(powers: list, df_log=False):
                 f'soc: {power[3]:6.2f} - ' +
                 f'lower: {power[4]:6.2f} - ' +
                 f'upper: {power[5]:6.2f} - ' +
-                (f'peak! ' if is_peak(powers, idx, 10) else '')
+                (f'peak! ' if peaks[idx] else '')
             )
 
 def test_sim(SimClass: Type[PeakShaveSim], run_type: str, **sim_run_config):
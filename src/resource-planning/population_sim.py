@@ -0,0 +1,361 @@
+import copy
+from typing import Type
+import numpy as np
+import pandas as pd
+from batteries import PopulationEnergyHub
+from kernels import HAS_NUMBA, run_peak_shave_kernel
+from peak_shave_sim import PeakShaveSim
+from peak_shave_sim import PRUNABLE_METRICS, get_energy_bounds, get_peak_sum
+from peak_shave_sim import compute_metrics, estimate_results, flag_pruned
+from peak_shave_sim import get_simulation_hours
+from util import SimulationTrace, get_peak_window, infer_tdelta
+
+class PopulationSim:
+    '''Runs the peak-shave simulation of a population of battery configurations in
+    a single pass over the data. The states of all the energy hubs are advanced
+    together (see `PopulationEnergyHub`), and the bought power of every
+    configuration is stored in a (steps, configs) array. The steps in which every
+    configuration is between its limits are advanced in closed form, like the
+    idle runs of `PeakShaveSim.simulate`. If numba is installed, the whole time
+    loop runs in a compiled kernel instead (see `kernels.peak_shave_kernel`).
+    Args:
+        - SimClass: the peak-shave strategy, a subclass of `PeakShaveSim` with a
+            `compute_limit_schedule` method, e.g. `ConstLimPeakShaveSim`.
+        - df: pandas.DataFrame containing the price data and the net power data
+            under the `net` key.
+        - counts: (configs, 3) array with the number of Li-ion batteries,
+            flywheels and supercapacitors of each configuration.
+        - aggregate: see `EnergyHub`.
+        - tdelta: length of a step in hours, inferred from the timestamps of the
+            data if not provided.'''
+
+    def __init__(self, SimClass: Type[PeakShaveSim], df: pd.DataFrame, counts,
+                 aggregate=False, tdelta=None) -> None:
+        self.SimClass = SimClass
+        self.df = df
+        self.tdelta = tdelta or infer_tdelta(df['timestamp'])
+        self.ehub = PopulationEnergyHub(counts, aggregate, self.tdelta)
+
+    def _get_limit_schedules(self, margins=None, **kwargs):
+        '''Returns the (steps, configs) arrays of the lower and the upper limits.
+        The schedule of each distinct margin is computed once.'''
+        pnets = self.df['net'].to_numpy()
+        if margins is None:
+            lowerlims, upperlims = self.SimClass.compute_limit_schedule(pnets, **kwargs)
+            shape = (len(pnets), len(self.ehub))
+            return (np.broadcast_to(lowerlims[:, np.newaxis], shape),
+                    np.broadcast_to(upperlims[:, np.newaxis], shape))
+
+        distinct, inverse = np.unique(np.asarray(margins, dtype=float),
+                                      return_inverse=True)
+        schedules = [self.SimClass.compute_limit_schedule(pnets, **dict(kwargs, margin=margin))
+                     for margin in distinct.tolist()]
+        lowerlims = np.stack([lower for lower, _ in schedules], axis=1)
+        upperlims = np.stack([upper for _, upper in schedules], axis=1)
+        return lowerlims[:, inverse], upperlims[:, inverse]
+
+    def _simulate_steps(self, pnets, lowerlims, upperlims):
+        '''Advances the hubs over the data with NumPy.
+        Returns: see `kernels.peak_shave_kernel`.'''
+        # the power to discharge above the upper limit, and to charge below the
+        # lower limit (discharging takes precedence, as in `PeakShaveEnv.step`)
+        pdischarges = np.maximum(pnets[:, np.newaxis] - upperlims, 0)
+        pcharges = np.maximum(lowerlims - pnets[:, np.newaxis], 0)
+        pcharges[pdischarges > 0] = 0
+
+        size = len(self.ehub)
+        pboughts = np.empty((len(pnets), size))
+        socs = np.empty((len(pnets), size))
+        penalties = np.zeros(size)
+
+        idle = ~(pdischarges > 0).any(axis=1) & ~(pcharges > 0).any(axis=1)
+        for start, end, is_idle in PeakShaveSim._get_segments(idle):
+            if is_idle:
+                socs[start:end] = self.ehub.idle(end - start).T
+                pboughts[start:end] = pnets[start:end, np.newaxis]
+                continue
+
+            for idx in range(start, end):
+                total_charge, total_discharge, penalty = self.ehub.exchange(
+                    pcharges[idx], pdischarges[idx])
+                pboughts[idx] = pnets[idx] + total_charge - total_discharge
+                socs[idx] = self.ehub.get_soc()
+                penalties += penalty
+        return pboughts, socs, penalties
+
+    def advance(self, start: int, end: int, lowerlims, upperlims, jit=True):
+        '''Advances the hubs from their current state over the steps [start, end)
+        of the data, so a simulation can be continued from a saved state.
+        Args:
+            - start, end: the range of the steps.
+            - lowerlims, upperlims: (steps, configs) arrays of the limits of the
+                whole data, see `_get_limit_schedules`.
+            - jit: use the compiled kernel if numba is installed.
+        Returns: see `kernels.peak_shave_kernel`, for the steps of the range.'''
+        pnets = self.df['net'].to_numpy(dtype=float)[start:end]
+        lowerlims, upperlims = lowerlims[start:end], upperlims[start:end]
+        if jit and HAS_NUMBA:
+            return run_peak_shave_kernel(self.ehub, pnets, lowerlims, upperlims)
+        return self._simulate_steps(pnets, lowerlims, upperlims)
+
+    def _simulate_with_cutoff(self, lowerlims, upperlims, capex, opex, cutoff: float,
+                              cutoff_metric: str, jit=True):
+        '''Advances the hubs a week at a time, and stops simulating the ones whose
+        lower bound of the cutoff metric exceeds the cutoff. The bounds of the
+        aborted hubs are stored in `bounds`, NaN for the others.
+        Returns: see `kernels.peak_shave_kernel`, and the number of steps
+            simulated for each hub. The steps after them are zero.'''
+        if cutoff_metric not in PRUNABLE_METRICS:
+            raise ValueError(f'{cutoff_metric} is not one of {PRUNABLE_METRICS}!')
+        pnets = self.df['net'].to_numpy(dtype=float)
+        prices = self.df['price (cents/kWh)'].to_numpy(dtype=float)
+        size, total = len(self.ehub), len(pnets)
+        pboughts = np.zeros((total, size))
+        socs = np.zeros((total, size))
+        penalties = np.zeros(size)
+        steps = np.full(size, total)
+        self.bounds = np.full(size, np.nan)
+        if cutoff_metric in {'energy_costs', 'total_costs'}:
+            energy_bounds = get_energy_bounds(pnets, prices, lowerlims, upperlims,
+                                              self.tdelta)
+        delta = get_peak_window(self.tdelta)
+        chunk = max(1, round(24 * 7 / self.tdelta))
+
+        # the aborted hubs are dropped from a copy of the population
+        ehub, self.ehub = self.ehub, copy.copy(self.ehub)
+        alive = np.arange(size)
+        lows, ups = lowerlims, upperlims
+        # running sum of the metric, and the steps whose peaks are final
+        running = np.zeros(size)
+        confirmed = 0
+        try:
+            for start in range(0, total, chunk):
+                end = min(start + chunk, total)
+                pbought, soc, penalty = self.advance(start, end, lows, ups, jit)
+                pboughts[start:end, alive] = pbought
+                socs[start:end, alive] = soc
+                penalties[alive] += penalty
+                if end == total:
+                    break
+
+                if cutoff_metric == 'sum_above_limit':
+                    above = np.maximum(pbought - ups[start:end], 0).sum(axis=0)
+                    running[alive] += above * self.tdelta
+                    bounds = running[alive]
+                elif cutoff_metric == 'peak_power_sum':
+                    final = end - delta
+                    if final > confirmed:
+                        # only the steps around the newly final ones are needed
+                        lo = max(0, confirmed - delta)
+                        running[alive] += get_peak_sum(pboughts[lo:end, alive],
+                                                       ups[lo:end], confirmed - lo,
+                                                       final - lo, delta)
+                        confirmed = final
+                    bounds = running[alive]
+                else:
+                    running[alive] += ((prices[start:end] * self.tdelta / 100) @ pbought +
+                                       penalty)
+                    bounds = running[alive] + energy_bounds[end, alive]
+                    if cutoff_metric == 'total_costs':
+                        bounds = bounds + capex[alive] + opex[alive]
+
+                pruned = bounds > cutoff
+                if pruned.any():
+                    self.bounds[alive[pruned]] = bounds[pruned]
+                    steps[alive[pruned]] = end
+                    alive = alive[~pruned]
+                    if alive.size == 0:
+                        break
+                    self.ehub.select(~pruned)
+                    lows, ups = lowerlims[:, alive], upperlims[:, alive]
+        finally:
+            self.ehub = ehub
+        return pboughts, socs, penalties, steps
+
+    def simulate(self, margins=None, jit=True, cutoff: float = None,
+                 cutoff_metric: str = 'peak_power_sum',
+                 **kwargs) -> tuple[list[dict], list[SimulationTrace]]:
+        '''Runs the simulation of every configuration.
+        Args:
+            - margins: array with the margin of each configuration, or None if
+                all of them use the same parameters.
+            - jit: use the compiled kernel if numba is installed.
+            - cutoff: if set, the simulation of a configuration is aborted as soon
+                as a lower bound of `cutoff_metric` exceeds it, see
+                `PeakShaveSim.simulate`. The bounds are stored in `bounds`.
+            - cutoff_metric: one of `PRUNABLE_METRICS`.
+            - **kwargs: parameters of the limit strategy, see `PeakShaveSim.run`.
+        Returns:
+            - costs: list of dicts containing `energy_costs`, `capex`, `opex` and
+                `total_costs`, one for each configuration.
+            - traces: list of `SimulationTrace`, one for each configuration, only
+                the steps simulated.'''
+        self.ehub.reset()
+        lowerlims, upperlims = self._get_limit_schedules(margins, **kwargs)
+        timestamps = self.df['timestamp'].to_numpy()
+        pnets = self.df['net'].to_numpy(dtype=float)
+        prices = self.df['price (cents/kWh)'].to_numpy(dtype=float)
+        size = len(self.ehub)
+        hours = get_simulation_hours(self.df)
+        capex = self.ehub.get_capex(hours)
+        opex = self.ehub.get_opex(hours)
+
+        self.bounds = np.full(size, np.nan)
+        if cutoff is None:
+            pboughts, socs, penalties = self.advance(0, len(pnets), lowerlims, upperlims,
+                                                     jit)
+            steps = np.full(size, len(pnets))
+        else:
+            pboughts, socs, penalties, steps = self._simulate_with_cutoff(
+                lowerlims, upperlims, capex, opex, cutoff, cutoff_metric, jit)
+
+        energy_costs = (prices * self.tdelta / 100) @ pboughts + penalties
+        total_costs = capex + opex + energy_costs
+
+        costs = [{'energy_costs': values[0], 'capex': values[1], 'opex': values[2],
+                  'total_costs': values[3]}
+                 for values in zip(energy_costs.tolist(), capex.tolist(), opex.tolist(),
+                                   total_costs.tolist())]
+        traces = [SimulationTrace(timestamps[:end], pnets[:end], pboughts[:end, idx],
+                                  socs[:end, idx], lowerlims[:end, idx],
+                                  upperlims[:end, idx])
+                  for idx, end in enumerate(steps.tolist())]
+        return costs, traces
+
+def population_objective(SimClass: Type[PeakShaveSim], df: pd.DataFrame, counts,
+                         margins=None, aggregate=False, **run_config):
+    '''Evaluates `objective` for a population of configurations in a single
+    simulation pass.
+    Args:
+        - SimClass: class of the peak-shave strategy. E.g.: ConstLimPeakShaveSim
+        - df: pandas.DataFrame containing the price data and the net power data
+            under the `net` key.
+        - counts: (configs, 3) array with the number of Li-ion batteries,
+            flywheels and supercapacitors of each configuration.
+        - margins: array with the margin of each configuration, None if the
+            strategy has no margin or `margin` is given in run_config.
+        - aggregate: see `objective`.
+        - **run_config: parameters of the limit strategy, `jit`, `cutoff` and
+            `cutoff_metric`, see `PopulationSim.simulate`.
+    Returns: list of (`costs`, `metrics`) tuples, see `objective`.'''
+    sim = PopulationSim(SimClass, df, counts, aggregate)
+    if 'weight' in df.columns and run_config.get('cutoff') is not None:
+        raise ValueError('A cutoff is not supported with representative days!')
+    costs, traces = sim.simulate(margins, **run_config)
+    if 'weight' in df.columns:
+        # the data of representative days, see `estimate_results`
+        return [estimate_results(df, config_costs, trace, sim.tdelta)
+                for config_costs, trace in zip(costs, traces)]
+    # the peak metrics of the aborted simulations are not computed, see `flag_pruned`
+    return [flag_pruned(config_costs,
+                        compute_metrics(trace, sim.tdelta, peaks=np.isnan(bound)),
+                        run_config, None if np.isnan(bound) else bound)
+            for config_costs, trace, bound in zip(costs, traces, sim.bounds.tolist())]
+
+def get_test_data(size: int, noise: float = 300, seed: int = 0) -> pd.DataFrame:
+    '''Returns hourly test data from 2021-06-01: a daily sine wave of net power
+    with normal noise, and random prices. Used by the tests of the simulations.
+    Args:
+        - size: number of hours.
+        - noise: standard deviation of the noise of the net power (in kW).
+        - seed: seed of the noise and the prices.'''
+    rng = np.random.default_rng(seed)
+    pnets = 2000 + 1500 * np.sin(np.arange(size) * 2 * np.pi / 24)
+    return pd.DataFrame({
+        'timestamp': pd.date_range('2021-06-01', periods=size, freq='h'),
+        'net': pnets + rng.normal(0, noise, size),
+        'price (cents/kWh)': 30 + 10 * rng.random(size),
+    })
+
+if __name__ == '__main__':
+    import unittest
+    from peak_shave_sim import objective
+    from peak_shave_sim import ConstLimPeakShaveSim
+    from peak_shave_sim import DynamicLimPeakShaveSim
+    from peak_shave_sim import EqualizedLimPeakShaveSim
+
+    class TestPopulationSim(unittest.TestCase):
+        def _compare(self, SimClass, df, counts, margins, aggregate, **run_config):
+            results = population_objective(SimClass, df, counts, margins, aggregate,
+                                           **run_config)
+            for idx, (costs, metrics) in enumerate(results):
+                if margins is not None:
+                    run_config['margin'] = margins[idx]
+                expected = objective(SimClass, df, *counts[idx], aggregate=aggregate,
+                                     **run_config)
+                for key, value in expected[0].items():
+                    self.assertAlmostEqual(costs[key], value, delta=1e-6 * abs(value))
+                for key, value in expected[1].items():
+                    self.assertAlmostEqual(metrics[key], value, delta=1e-6 * abs(value))
+
+        def test1(self):
+            # same costs and metrics as simulating the configurations one by one
+            df = get_test_data(24 * 20)
+            counts = np.array([[0, 0, 0], [3, 2, 1], [9, 0, 4], [1, 1, 1]])
+            margins = np.array([.1, .05, .2, .05])
+            for aggregate in (False, True):
+                self._compare(ConstLimPeakShaveSim, df, counts, margins, aggregate)
+                self._compare(DynamicLimPeakShaveSim, df, counts, margins, aggregate,
+                              lookahead=24)
+                self._compare(EqualizedLimPeakShaveSim, df, counts, None, aggregate,
+                              lookahead=24)
+
+        def test2(self):
+            # the compiled kernel gives the same results as the NumPy steps
+            df = get_test_data(24 * 20)
+            counts = np.array([[0, 0, 0], [3, 2, 1], [9, 0, 4], [1, 1, 1]])
+            margins = np.array([.1, .05, .2, .05])
+            for aggregate in (False, True):
+                results = [PopulationSim(ConstLimPeakShaveSim, df, counts,
+                                         aggregate).simulate(margins, jit=jit)
+                           for jit in (False, True)]
+                for expected, costs in zip(*(costs for costs, _ in results)):
+                    for key, value in expected.items():
+                        self.assertAlmostEqual(costs[key], value, delta=1e-9 * abs(value))
+                for expected, trace in zip(*(traces for _, traces in results)):
+                    self.assertTrue(np.allclose(trace.pbought, expected.pbought))
+                    self.assertTrue(np.allclose(trace.soc, expected.soc))
+
+        def test3(self):
+            # an aborted simulation has a lower bound above the cutoff, the others
+            # have their full results
+            df = get_test_data(24 * 40)
+            counts = np.array([[0, 0, 0], [3, 2, 1], [9, 0, 4], [1, 1, 1], [9, 9, 9]])
+            margins = np.array([.1, .05, .2, .05, .1])
+            expected = population_objective(ConstLimPeakShaveSim, df, counts, margins)
+            for metric in ('peak_power_sum', 'sum_above_limit', 'energy_costs',
+                           'total_costs'):
+                values = [costs[metric] if metric in costs else metrics[metric]
+                          for costs, metrics in expected]
+                for cutoff in (float(np.median(values)), min(values) / 2):
+                    for jit in (False, True):
+                        results = population_objective(ConstLimPeakShaveSim, df, counts,
+                                                       margins, jit=jit, cutoff=cutoff,
+                                                       cutoff_metric=metric)
+                        for value, (costs, metrics) in zip(values, results):
+                            bound = costs[metric] if metric in costs else metrics[metric]
+                            if metrics['pruned']:
+                                self.assertGreater(bound, cutoff)
+                                self.assertLessEqual(bound, value * (1 + 1e-9))
+                            else:
+                                self.assertAlmostEqual(bound, value,
+                                                       delta=1e-9 * abs(value))
+                self.assertTrue(any(metrics['pruned'] for _, metrics in results))
+
+                # the simulation of a single configuration as well
+                cutoff = float(np.median(values))
+                for config in counts.tolist():
+                    for store_trace in (False, True):
+                        costs, metrics = objective(ConstLimPeakShaveSim, df, *config,
+                                                   store_trace=store_trace, margin=.1,
+                                                   cutoff=cutoff, cutoff_metric=metric)
+                        full = objective(ConstLimPeakShaveSim, df, *config, margin=.1)
+                        full = full[0][metric] if metric in full[0] else full[1][metric]
+                        bound = costs[metric] if metric in costs else metrics[metric]
+                        if metrics['pruned']:
+                            self.assertGreater(bound, cutoff)
+                            self.assertLessEqual(bound, full * (1 + 1e-9))
+                        else:
+                            self.assertAlmostEqual(bound, full, delta=1e-6 * abs(full))
+
+    unittest.main()
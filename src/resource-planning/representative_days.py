@@ -0,0 +1,183 @@
+import time
+import numpy as np
+import pandas as pd
+from util import infer_tdelta
+from peak_shave_sim import objective
+
+def get_daily_profiles(df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    '''Splits the data into days. Only the whole days are kept, i.e. the ones with
+    a step for every hour (or part of an hour) of the day.
+    Returns:
+        - starts: array of the index of the first step of each whole day.
+        - profiles: (days, 2*steps) array of the net power and price profiles of
+            the days, both scaled by their standard deviation over the data, so
+            they weigh the same in the distances.'''
+    steps = round(24 / infer_tdelta(df['timestamp']))
+    days = df['timestamp'].dt.floor('D').to_numpy()
+    _, starts, counts = np.unique(days, return_index=True, return_counts=True)
+    starts = starts[counts == steps]
+
+    rows = starts[:, np.newaxis] + np.arange(steps)
+    profiles = []
+    for name in ('net', 'price (cents/kWh)'):
+        values = df[name].to_numpy(dtype=float)
+        std = values.std()
+        profiles.append((values - values.mean()) / (std if std > 0 else 1))
+    return starts, np.hstack([values[rows] for values in profiles])
+
+def k_medoids(points: np.ndarray, k: int, seed: int = 0,
+              max_iter: int = 100) -> tuple[np.ndarray, np.ndarray]:
+    '''Clusters the points with the alternating k-medoids algorithm: the points are
+    assigned to the closest medoid, and the medoid of each cluster is replaced by
+    the member with the smallest total distance to the others, until the medoids
+    do not change. The medoids are initialized like in k-means++.
+    Args:
+        - points: (n, features) array.
+        - k: number of clusters, at most n.
+        - seed: seed of the initialization.
+        - max_iter: maximum number of iterations.
+    Returns:
+        - medoids: (k,) array of the indices of the medoid points.
+        - labels: (n,) array of the cluster of each point.'''
+    sqnorms = (points ** 2).sum(axis=1)
+    dists = np.sqrt(np.maximum(sqnorms[:, np.newaxis] + sqnorms - 2 * points @ points.T,
+                               0))
+    rng = np.random.default_rng(seed)
+    medoids = [rng.integers(len(points))]
+    for _ in range(1, k):
+        closest = dists[:, medoids].min(axis=1) ** 2
+        if closest.sum() == 0:
+            # fewer distinct points than clusters
+            medoids.append(rng.choice(np.setdiff1d(np.arange(len(points)), medoids)))
+        else:
+            medoids.append(rng.choice(len(points), p=closest / closest.sum()))
+    medoids = np.array(medoids)
+
+    for _ in range(max_iter):
+        labels = dists[:, medoids].argmin(axis=1)
+        # the medoids are members of their own clusters
+        labels[medoids] = np.arange(k)
+        updated = medoids.copy()
+        for cluster in range(k):
+            members = np.flatnonzero(labels == cluster)
+            updated[cluster] = members[dists[np.ix_(members, members)].sum(axis=1).argmin()]
+        if np.array_equal(updated, medoids):
+            break
+        medoids = updated
+    labels = dists[:, medoids].argmin(axis=1)
+    labels[medoids] = np.arange(k)
+    return medoids, labels
+
+def build_dataset(df: pd.DataFrame, clusters: int, seed: int = 0) -> pd.DataFrame:
+    '''Compresses the data into representative days: the days are clustered by
+    their net power and price profiles with k-medoids, and the medoid days are
+    kept in chronological order. The `weight` column holds the number of days the
+    day of each step represents, `objective` estimates the results of the whole
+    data with it (see `peak_shave_sim.estimate_results`).
+    Args:
+        - df: pandas.DataFrame with the `timestamp`, `net` and `price (cents/kWh)`
+            columns.
+        - clusters: number of representative days.
+        - seed: seed of the clustering.
+    Returns: the rows of the representative days with the `weight` column.'''
+    starts, profiles = get_daily_profiles(df)
+    medoids, labels = k_medoids(profiles, min(clusters, len(starts)), seed)
+    weights = np.bincount(labels, minlength=len(medoids))
+
+    order = np.argsort(starts[medoids])
+    steps = profiles.shape[1] // 2
+    rows = (starts[medoids][order][:, np.newaxis] + np.arange(steps)).ravel()
+    rdf = df.iloc[rows].reset_index(drop=True)
+    rdf['weight'] = np.repeat(weights[order], steps).astype(float)
+    return rdf
+
+def _relative_error(value: float, expected: float) -> float:
+    if expected == 0:
+        return abs(value)
+    return abs(value - expected) / abs(expected)
+
+def report_error(SimClass, df: pd.DataFrame, clusters: list[int], configs: list,
+                 seed: int = 0, aggregate=False, **run_config) -> list[dict]:
+    '''Compares the results estimated from representative days with the results
+    of the whole data, for several numbers of clusters.
+    Args:
+        - SimClass: class of the simulation, e.g. ConstLimPeakShaveSim.
+        - df: the whole data.
+        - clusters: the numbers of representative days.
+        - configs: list of (liion_cnt, flywh_cnt, sucap_cnt) tuples, the battery
+            configurations simulated.
+        - seed: seed of the clustering.
+        - aggregate, **run_config: see `objective`.
+    Returns: list of dicts, one for each number of clusters, with the number of
+        hours simulated, the speedup, and the largest relative error of each cost
+        and metric over the configurations.'''
+    def run(data):
+        start = time.time()
+        results = [objective(SimClass, data, *config, aggregate=aggregate,
+                             **run_config) for config in configs]
+        return results, time.time() - start
+
+    expected, elapsed = run(df)
+    report = []
+    for count in clusters:
+        rdf = build_dataset(df, count, seed)
+        results, rdf_elapsed = run(rdf)
+        row = {'clusters': count, 'hours': len(rdf) * infer_tdelta(df['timestamp']),
+               'speedup': elapsed / rdf_elapsed}
+        for (costs, metrics), (exp_costs, exp_metrics) in zip(results, expected):
+            for values, exp_values in ((costs, exp_costs), (metrics, exp_metrics)):
+                for key, value in exp_values.items():
+                    error = _relative_error(values[key], value)
+                    row[key] = max(row.get(key, 0), error)
+        report.append(row)
+    return report
+
+if __name__ == '__main__':
+    import unittest
+    from peak_shave_sim import ConstLimPeakShaveSim
+    from peak_shave_sim import EqualizedLimPeakShaveSim
+    from population_sim import get_test_data
+
+    class TestRepresentativeDays(unittest.TestCase):
+        def _get_df(self, days: int) -> pd.DataFrame:
+            df = get_test_data(24 * days, noise=100)
+            # every third day has a larger load
+            df['net'] *= np.repeat(np.arange(days) % 3 == 0, 24) * .5 + 1
+            # random prices would dominate the clustering
+            df['price (cents/kWh)'] = 30 + 10 * np.cos(np.arange(len(df)) * 2 * np.pi / 24)
+            return df
+
+        def test1(self):
+            points = np.array([[0, 0], [0, 1], [10, 10], [10, 11], [11, 10]],
+                              dtype=float)
+            medoids, labels = k_medoids(points, 2)
+            self.assertEqual(sorted(medoids.tolist()), [0, 2])
+            self.assertEqual(labels[:2].tolist(), [labels[0]] * 2)
+            self.assertEqual(labels[2:].tolist(), [labels[2]] * 3)
+
+        def test2(self):
+            df = self._get_df(30)
+            # an incomplete day is dropped
+            starts, profiles = get_daily_profiles(df.iloc[5:])
+            self.assertEqual((len(starts), profiles.shape[1]), (29, 48))
+
+            rdf = build_dataset(df, 2)
+            self.assertEqual(len(rdf), 48)
+            self.assertEqual(sorted(rdf['weight'].iloc[::24]), [10., 20.])
+
+        def test3(self):
+            # every day represents itself: the estimate is the full result
+            df = self._get_df(20)
+            rdf = build_dataset(df, 20)
+            self.assertEqual(rdf['weight'].sum(), len(df))
+            for SimClass, run_config in ((ConstLimPeakShaveSim, {'margin': .05}),
+                                         (EqualizedLimPeakShaveSim,
+                                          {'lookahead': 24})):
+                expected = objective(SimClass, df, 3, 2, 1, **run_config)
+                result = objective(SimClass, rdf, 3, 2, 1, **run_config)
+                for values, exp_values in zip(result, expected):
+                    for key, value in exp_values.items():
+                        self.assertAlmostEqual(values[key], value,
+                                               delta=1e-9 * abs(value))
+
+    unittest.main()
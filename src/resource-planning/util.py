@@ -1,54 +1,145 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import math
-from datetime import datetime, timedelta
-from operator import itemgetter
+import hashlib
+import heapq
+import os
+import tempfile
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 
-def calc_fluctuation(powers: list):
+def hours_of_day(timestamps) -> np.ndarray:
+    '''Returns the hour of the day of each timestamp as an integer array.'''
+    timestamps = np.asarray(timestamps, dtype='datetime64[ns]')
+    return timestamps.astype('datetime64[h]').astype(np.int64) % 24
+
+def infer_tdelta(timestamps) -> float:
+    '''Returns the length of a step of the data in hours, the median of the
+    differences of the timestamps (1 if there are less than two timestamps).'''
+    timestamps = np.asarray(timestamps, dtype='datetime64[ns]')
+    if timestamps.size < 2:
+        return 1
+    step = np.median(np.diff(timestamps).astype(np.int64))
+    return float(step) / 3600e9
+
+def get_peak_window(tdelta: float = 1) -> int:
+    '''Returns the half width of the window of the peak test in steps: 10 hours.'''
+    return max(1, round(10 / tdelta))
+
+class SimulationTrace:
+    '''Columnar record of a simulation run. Each value of the legacy
+    (`timestamp`, `pnet`, `pbought`, `soc`, `lower`, `upper`) tuples is stored in
+    its own array, so the metrics can work on whole columns at once. Indexing and
+    iterating still yields tuples for code written for the list of tuples.
+    Args:
+        - timestamp: timestamps of the steps.
+        - pnet: net power demand in each step (in kW).
+        - pbought: power bought from the grid in each step (in kW).
+        - soc: state-of-charge of the energy hub after each step (in kWh).
+        - lower, upper: limits of each step, optional.
+        - dtype: type of the value columns, e.g. `np.float32` to halve the memory.'''
+    columns = ('timestamp', 'pnet', 'pbought', 'soc', 'lower', 'upper')
+
+    def __init__(self, timestamp, pnet, pbought, soc, lower=None, upper=None,
+                 dtype=np.float64) -> None:
+        self.timestamp = np.asarray(timestamp, dtype='datetime64[ns]')
+        self.pnet = np.asarray(pnet, dtype=dtype)
+        self.pbought = np.asarray(pbought, dtype=dtype)
+        self.soc = np.asarray(soc, dtype=dtype)
+        self.lower = None if lower is None else np.asarray(lower, dtype=dtype)
+        self.upper = None if upper is None else np.asarray(upper, dtype=dtype)
+
+    @classmethod
+    def from_powers(cls, powers: list, dtype=np.float64) -> 'SimulationTrace':
+        '''Creates a trace from a list of (`timestamp`, `pnet`, `pbought`, `soc`,
+        `lower`[optional], `upper`[optional]) tuples.'''
+        ncols = 6 if len(powers) > 0 and len(powers[0]) >= 6 else 4
+        columns = [[power[col] for power in powers] for col in range(ncols)]
+        return cls(*columns, dtype=dtype)
+
+    def get_columns(self) -> list[np.ndarray]:
+        '''Returns the columns that are set, in the order of the legacy tuples.'''
+        return [getattr(self, name) for name in self.columns
+                if getattr(self, name) is not None]
+
+    def to_powers(self) -> list[tuple]:
+        '''Converts the trace into the legacy list of tuples.'''
+        return list(zip(pd.DatetimeIndex(self.timestamp),
+                        *(column.tolist() for column in self.get_columns()[1:])))
+
+    def get_hours(self) -> np.ndarray:
+        '''Returns the hour of the day of each step.'''
+        return hours_of_day(self.timestamp)
+
+    def __len__(self):
+        return self.timestamp.size
+
+    def __getitem__(self, idx: int) -> tuple:
+        return (pd.Timestamp(self.timestamp[idx]),
+                *(column[idx].item() for column in self.get_columns()[1:]))
+
+    def __iter__(self):
+        return iter(self.to_powers())
+
+def _get_column(powers, col: int) -> np.ndarray:
+    '''Returns a column of the powers as a float array. The powers can be a
+    `SimulationTrace`, a 2D array or a list of tuples.'''
+    if isinstance(powers, SimulationTrace):
+        return getattr(powers, SimulationTrace.columns[col]).astype(float, copy=False)
+    if isinstance(powers, np.ndarray):
+        return powers[:, col].astype(float)
+    return np.fromiter((power[col] for power in powers), dtype=float,
+                       count=len(powers))
+
+def _get_hours(powers) -> np.ndarray:
+    '''Returns the hour of the day of each step of the powers.'''
+    if isinstance(powers, SimulationTrace):
+        return powers.get_hours()
+    return np.fromiter((power[0].hour for power in powers), dtype=np.int64,
+                       count=len(powers))
+
+def calc_fluctuation(powers):
     '''Calculates fluctuation of power.
     Args:
-        - powers: list of tuples containin the following values: (`timestamp`, `pnet`,
-            `pbought`, `soc`, `upper`[optional], `lower`[optional])
+        - powers: `SimulationTrace`, or list of tuples containin the following
+            values: (`timestamp`, `pnet`, `pbought`, `soc`, `upper`[optional],
+            `lower`[optional])
     Returns: the fluctuation value.'''
-    size = len(powers)
-    total_diff = 0
-    for idx in range(1, size):
-        diff = abs(powers[idx][2] - powers[idx - 1][2])
-        total_diff += diff
-    psum = sum([power[2] for power in powers])
-    mean = psum / size
+    pbought = _get_column(powers, 2)
+    total_diff = np.abs(np.diff(pbought)).sum()
+    mean = pbought.sum() / pbought.size
     return total_diff / mean
 
-def calc_periodic_fluctuation(powers: list):
-    '''Calculates the periodic fluctuation of power with a 24 hour period
+def calc_periodic_fluctuation(powers):
+    '''Calculates the periodic fluctuation of power with a 24 hour period. Every
+    period ends with the last step of hour 23 (the only one for hourly data), the
+    steps after the last period are ignored, and the result is NaN if there is no
+    whole period, e.g. in an aborted simulation.
     Args:
-        - powers: list of tuples containin the following values: (`timestamp`, `pnet`,
-            `pbought`, `soc`, `upper`[optional], `lower`[optional])
+        - powers: `SimulationTrace`, or list of tuples containin the following
+            values: (`timestamp`, `pnet`, `pbought`, `soc`, `upper`[optional],
+            `lower`[optional])
     Returns: the fluctuation value.'''
+    pbought = _get_column(powers, 2)
+    hours = _get_hours(powers)
+    ends = np.flatnonzero((hours == 23) & (np.append(hours[1:], -1) != 23))
+    starts = np.concatenate(([0], ends[:-1] + 1))
 
-    prev_p = None
-    total_diff = 0
-    psum = 0
-    count = 0
-    fluct_sum = 0
-    fluct_cnt = 0
-    for power in powers:
-        psum += power[2]
-        count += 1
-        if prev_p is None:
-            prev_p = power[2]
-        else:
-            diff = abs(power[2] - prev_p)
-            total_diff += diff
-            prev_p = power[2]
-        if power[0].hour == 23:
-            fluct = 0
-            if psum != 0 and count != 0:
-                fluct = total_diff / (psum / count)
-            fluct_sum += fluct
-            fluct_cnt += 1
-            prev_p = None
-            total_diff, psum, count = 0, 0, 0
-    return fluct_sum / fluct_cnt
+    # the difference between the last step of a period and the first step of the
+    # next one is not part of the fluctuation
+    diffsum = np.concatenate(([0], np.cumsum(np.abs(np.diff(pbought)))))
+    psum = np.concatenate(([0], np.cumsum(pbought)))
+    total_diffs = diffsum[ends] - diffsum[starts]
+    psums = psum[ends + 1] - psum[starts]
+    counts = ends + 1 - starts
+
+    nonzero = psums != 0
+    flucts = np.zeros(ends.size)
+    flucts[nonzero] = total_diffs[nonzero] / (psums[nonzero] / counts[nonzero])
+    if len(ends) == 0:
+        return math.nan
+    return float(flucts.sum()) / len(ends)
 
 def is_peak(powers: list, idx: int, delta: int) -> bool:
     curr_value = powers[idx][2]
@@ -67,63 +158,377 @@ def is_peak(powers: list, idx: int, delta: int) -> bool:
     local_peak = max(powers[i][2] for i in range(left, right))
     return math.isclose(curr_value, local_peak)
 
-def calc_peak_power_sum(powers: list):
+def find_peaks(values, delta: int) -> np.ndarray:
+    '''Vectorized version of `is_peak` for every index at once. A value is a peak
+    if it is a strict local maximum within `delta` steps on both sides, and no
+    other value in that window is close to it. The maxima of the windows on the
+    left and on the right are computed with sliding windows.
+    Args:
+        - values: array of values, e.g. the bought power, or a (steps, columns)
+            array, whose columns are searched separately
+        - delta: half width of the window
+    Returns: boolean array of the shape of values, True at the peaks.'''
+    values = np.asarray(values, dtype=float)
+    size = values.shape[0]
+    if size < 3:
+        return np.zeros(values.shape, dtype=bool)
+
+    padding = np.full((delta,) + values.shape[1:], -np.inf)
+    padded = np.concatenate((padding, values, padding))
+    window_max = sliding_window_view(padded, delta, axis=0).max(axis=-1)
+    # window_max[idx] is the max of values[idx-delta:idx], the left neighbours,
+    # and window_max[idx+delta+1] is the max of values[idx+1:idx+delta+1]
+    neighbours = np.maximum(window_max[:size], window_max[delta + 1:])
+
+    # same as math.isclose with the default relative tolerance
+    close = (np.abs(values - neighbours) <=
+             1e-9 * np.maximum(np.abs(values), np.abs(neighbours)))
+    peaks = (values > neighbours) & ~close
+    peaks[0] = peaks[-1] = False
+    return peaks
+
+def calc_peak_power_sum(powers, tdelta: float = 1):
     '''Calculates sum of peaks above the upper limit.
     Args:
-        - powers: list of tuples containin the following values: (`timestamp`, `pnet`,
-            `pbought`, `soc`, `lower`, `upper`)
+        - powers: `SimulationTrace`, list of tuples containin the following values:
+            (`timestamp`, `pnet`, `pbought`, `soc`, `lower`, `upper`), or a 2D
+            array with these columns
+        - tdelta: length of a step in hours, the peaks are searched within 10
+            hours on both sides
     Returns:
         - the sum of peaks,
         - the number of peaks.'''
+    pbought = _get_column(powers, 2)
+    upper = _get_column(powers, 5)
+    peaks = find_peaks(pbought, get_peak_window(tdelta)) & (pbought > upper)
+    total = np.sum(pbought[peaks] - upper[peaks])
+    return total, int(np.count_nonzero(peaks))
 
-    total = 0
-    count = 0
-    for idx, power in enumerate(powers):
-        if is_peak(powers, idx, 10) and power[2] > power[5]:
-            count += 1
-            total += power[2] - power[5]
-    return total, count
+def _get_read_args(fname: str) -> dict:
+    '''Returns the arguments of `pd.read_csv` for a data file, None for an unknown
+    file.'''
+    if 'short.csv' in fname or 'full.csv' in fname:
+        return {}
+    if '71125' in fname: # data from trafo-71125
+        return {'sep': ';', 'decimal': ','}
+    return None
 
-def process_file(fname: str) -> pd.DataFrame:
-    df = None
+def _process_frame(df: pd.DataFrame, fname: str) -> pd.DataFrame:
+    '''Computes the `timestamp`, `net` and `price (cents/kWh)` columns of the rows
+    read from a data file.'''
     if 'short.csv' in fname or 'full.csv' in fname:
-        df = pd.read_csv(fname)
         df['timestamp'] = pd.to_datetime(df['timestamp'], format='%m%d%Y %H:%M')
         df['net'] = df['Load (kWh)'] - df['PV (kWh)']
-    elif '71125' in fname: # data from trafo-71125
-        df = pd.read_csv(fname, sep=';', decimal=',')
+    else:
         df['ReadTimestamp'] = pd.to_datetime(df['ReadTimestamp'])
         # df['EntryDateTime'] = pd.to_datetime(df['EntryDateTime'])
-        df = df.sort_values('ReadTimestamp', ascending=True).reset_index()
         df['net'] = df['Delta A+[kWh]']
         df['timestamp'] = df['ReadTimestamp']
         # TODO: find proper price data
         df['price (cents/kWh)'] = df['net'] # this is only temporary
     return df
 
-def get_merged_dfs(*fnames: str) -> pd.DataFrame:
-    df_list = []
-    for fname in fnames:
-        df_list.append(process_file(fname))
+def _read_file(fname: str) -> pd.DataFrame:
+    read_args = _get_read_args(fname)
+    if read_args is None:
+        return None
+    df = _process_frame(pd.read_csv(fname, **read_args), fname)
+    if '71125' in fname:
+        df = df.sort_values('ReadTimestamp', ascending=True).reset_index()
+    return df
+
+CACHE_COLUMNS = ('timestamp', 'net', 'price (cents/kWh)')
+
+def _file_digest(fname: str) -> str:
+    '''Returns the sha1 hash of the content of a file.'''
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _load_cached(path: str) -> pd.DataFrame:
+    with np.load(path) as data:
+        timestamps = pd.to_datetime(data['timestamp'].view(str(data['unit'])))
+        if str(data['tz']):
+            timestamps = timestamps.tz_localize('UTC').tz_convert(str(data['tz']))
+        return pd.DataFrame({'timestamp': timestamps, 'net': data['net'],
+                             'price (cents/kWh)': data['price']})
+
+def _save_cached(path: str, df: pd.DataFrame):
+    '''Writes the cache file into a temporary file next to it and moves it into
+    place, so a killed or concurrent write never leaves a truncated file at path.'''
+    timestamps = df['timestamp']
+    tz = '' if timestamps.dt.tz is None else str(timestamps.dt.tz)
+    if tz:
+        timestamps = timestamps.dt.tz_convert('UTC').dt.tz_localize(None)
+    timestamps = timestamps.to_numpy()
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            np.savez(file, timestamp=timestamps.view(np.int64),
+                     unit=np.array(str(timestamps.dtype)), net=df['net'].to_numpy(),
+                     price=df['price (cents/kWh)'].to_numpy(), tz=np.array(tz))
+        os.replace(tmppath, path)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+def _remove_stale(cachedir: str, name: str, digest: str):
+    '''Removes the cache files of the earlier versions of the data file `name`.
+    Files removed by another process in the meantime are skipped.'''
+    for stale in os.listdir(cachedir):
+        parts = stale.split('.')
+        if (stale.startswith(name + '.') and len(parts) == name.count('.') + 3 and
+                parts[-1] == 'npz' and parts[-2] != digest):
+            try:
+                os.remove(os.path.join(cachedir, stale))
+            except FileNotFoundError:
+                pass
 
-    df = (pd.concat(df_list)
-          .sort_values('timestamp')
-          .drop_duplicates()
-          .reset_index(drop=True))
+def process_file(fname: str, use_cache: bool = True,
+                 cachedir: str = None) -> pd.DataFrame:
+    '''Reads a data file and computes the net power demand.
+    Args:
+        - fname: name of the file, `short.csv`, `full.csv` or a Sub71125 export.
+        - use_cache: store the processed columns in a binary file, keyed by the
+            hash of the content of the data file, and load them from there the
+            next time. A changed data file gets a new cache file.
+        - cachedir: directory of the cache files, `.cache` next to the data file
+            by default.
+    Returns: pandas.DataFrame with the `timestamp`, `net` and `price (cents/kWh)`
+        columns, or with all the columns of the file if use_cache is False.'''
+    if not use_cache:
+        return _read_file(fname)
+
+    if cachedir is None:
+        cachedir = os.path.join(os.path.dirname(os.path.abspath(fname)), '.cache')
+    name = os.path.basename(fname)
+    digest = _file_digest(fname)
+    path = os.path.join(cachedir, f'{name}.{digest}.npz')
+    if os.path.exists(path):
+        return _load_cached(path)
+
+    df = _read_file(fname)
+    if df is None:
+        return df
+    df = df[list(CACHE_COLUMNS)].reset_index(drop=True)
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        _save_cached(path, df)
+        _remove_stale(cachedir, name, digest)
+    except OSError:
+        # the cache is only an optimization, e.g. the directory may be read-only
+        pass
     return df
 
+def _iter_file_chunks(fname: str, chunksize: int):
+    '''Reads a data file in chunks. The rows of the file have to be in time order.
+    Yields: (`timestamps`, `nets`, `prices`) arrays of the rows in a chunk, the
+        timestamps as int64 nanoseconds.'''
+    read_args = _get_read_args(fname)
+    if read_args is None:
+        raise ValueError(f'Unknown data file: {fname}')
+    last = None
+    with pd.read_csv(fname, chunksize=chunksize, **read_args) as reader:
+        for chunk in reader:
+            chunk = _process_frame(chunk, fname)
+            timestamps = pd.DatetimeIndex(chunk['timestamp']).as_unit('ns').asi8
+            if timestamps.size == 0:
+                continue
+            if np.any(timestamps[1:] < timestamps[:-1]) or (
+                    last is not None and timestamps[0] < last):
+                raise ValueError(f'The rows of {fname} are not in time order!')
+            last = timestamps[-1]
+            yield (timestamps, chunk['net'].to_numpy(dtype=float),
+                   chunk['price (cents/kWh)'].to_numpy(dtype=float))
+
+def _equal(values: np.ndarray) -> np.ndarray:
+    '''Tells whether each value equals the previous one, NaNs are equal.'''
+    prev, curr = values[:-1], values[1:]
+    return (prev == curr) | (np.isnan(prev) & np.isnan(curr))
+
+def _drop_duplicates(carry: tuple, parts: list[tuple]) -> tuple[tuple, tuple]:
+    '''Merges the rows of the parts by timestamp and drops the duplicate rows, also
+    the ones that were in the previous block (`carry`). Rows with the same
+    timestamp keep the order of the parts, e.g. the repeated hour at the end of
+    the daylight saving time.
+    Returns:
+        - block: (`timestamps`, `nets`, `prices`) of the new rows.
+        - carry: the rows with the last timestamp of the block.'''
+    timestamps, nets, prices = (np.concatenate(values) for values in zip(carry, *parts))
+    positions = np.arange(timestamps.size)
+
+    # equal rows are next to each other in this order, the first one is kept
+    order = np.lexsort((positions, prices, nets, timestamps))
+    duplicate = np.zeros(timestamps.size, dtype=bool)
+    duplicate[order[1:]] = ((timestamps[order[1:]] == timestamps[order[:-1]]) &
+                            _equal(nets[order]) & _equal(prices[order]))
+
+    order = np.argsort(timestamps, kind='stable')
+    order = order[~duplicate[order]]
+    new = order[order >= carry[0].size]
+    last = order[timestamps[order] == timestamps[order[-1]]]
+    return ((timestamps[new], nets[new], prices[new]),
+            (timestamps[last], nets[last], prices[last]))
+
+def iter_merged_files(*fnames: str, chunksize: int = 100000, max_workers: int = None):
+    '''Merges data files by timestamp without loading them fully. The files have
+    to be in time order, like the meter exports are. They are read in chunks in a
+    thread pool, and a heap keyed by the last timestamp of the chunk of each file
+    tells up to which timestamp the rows of every file can be merged.
+    Duplicate rows are dropped on the fly.
+    Args:
+        - fnames: names of the data files, see `process_file`.
+        - chunksize: number of rows read from a file at once.
+        - max_workers: number of reader threads, one per file by default.
+    Yields: pandas.DataFrame chunks with the `timestamp`, `net` and
+        `price (cents/kWh)` columns, in time order.'''
+    readers = [_iter_file_chunks(fname, chunksize) for fname in fnames]
+    buffers = {}
+    heap = []
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(readers), 1)) as pool:
+        pending = {idx: pool.submit(next, reader, None)
+                   for idx, reader in enumerate(readers)}
+
+        def refill(idx: int):
+            chunk = pending.pop(idx).result()
+            if chunk is None:
+                return
+            # read the next chunk while this one is merged
+            pending[idx] = pool.submit(next, readers[idx], None)
+            buffers[idx] = chunk
+            heapq.heappush(heap, (chunk[0][-1], idx))
+
+        for idx in range(len(readers)):
+            refill(idx)
+
+        carry = (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0))
+        while heap:
+            # every file has all its rows up to bound in the buffers
+            bound = heap[0][0]
+            parts = []
+            for idx, chunk in list(buffers.items()):
+                cut = np.searchsorted(chunk[0], bound, side='right')
+                parts.append(tuple(values[:cut] for values in chunk))
+                if cut == chunk[0].size:
+                    del buffers[idx]
+                else:
+                    buffers[idx] = tuple(values[cut:] for values in chunk)
+            while heap and heap[0][0] == bound:
+                refill(heapq.heappop(heap)[1])
+
+            (timestamps, nets, prices), carry = _drop_duplicates(carry, parts)
+            if timestamps.size > 0:
+                yield pd.DataFrame({'timestamp': timestamps.view('datetime64[ns]'),
+                                    'net': nets, 'price (cents/kWh)': prices})
+
+def get_merged_dfs(*fnames: str, chunksize: int = 100000) -> pd.DataFrame:
+    '''Merges the data files into a single DataFrame, see `iter_merged_files`.'''
+    chunks = list(iter_merged_files(*fnames, chunksize=chunksize))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=list(CACHE_COLUMNS))
+    return pd.concat(chunks, ignore_index=True)
+
+def _to_wall_hours(timestamps) -> np.ndarray:
+    '''Returns the timestamps floored to the hour, as hours since the epoch in
+    local wall-clock time: the timezone of aware timestamps is dropped without
+    converting them (unlike `timeseries._to_utc_hours`).'''
+    timestamps = np.asarray(pd.DatetimeIndex(timestamps).tz_localize(None))
+    return timestamps.astype('datetime64[h]').astype(np.int64)
+
+def find_gaps(timestamps) -> dict:
+    '''Finds the duplicate and the missing hours of time ordered timestamps. The
+    hours are counted in wall-clock time, so with timezone aware timestamps the
+    hour skipped at the start of daylight saving time is reported as missing, and
+    the hour repeated at its end as a duplicate.
+    Args:
+        - timestamps: timestamps of the rows, e.g. `df['timestamp']`.
+    Returns: dict containing
+        - `duplicates`: number of rows in the same hour as the previous row
+        - `duplicate_times`: the hours of these rows
+        - `gap_starts`: first missing hour of each gap
+        - `gap_lengths`: number of missing hours in each gap
+        - `missing`: total number of missing hours'''
+    hours = _to_wall_hours(timestamps)
+    steps = np.diff(hours)
+    if np.any(steps < 0):
+        raise ValueError('The timestamps are not in time order!')
+
+    duplicate = steps == 0
+    gap = steps > 1
+    return {
+        'duplicates': int(np.count_nonzero(duplicate)),
+        'duplicate_times': hours[1:][duplicate].astype('datetime64[h]'),
+        'gap_starts': (hours[:-1][gap] + 1).astype('datetime64[h]'),
+        'gap_lengths': steps[gap] - 1,
+        'missing': int(np.sum(steps[gap] - 1)),
+    }
+
+def regularize_hourly(df: pd.DataFrame, fill: str = 'interpolate',
+                      duplicates: str = 'first', columns=None) -> tuple[pd.DataFrame, dict]:
+    '''Reindexes time ordered data onto a strict hourly grid from the first to the
+    last hour, so every row is one hour after the previous one. The grid is in
+    wall-clock time (see `find_gaps`) and its timestamps are timezone naive.
+    Args:
+        - df: pandas.DataFrame with a `timestamp` column.
+        - fill: how the missing hours are filled: `interpolate` (linear in time),
+            `ffill` (previous value), `zero` or `nan`.
+        - duplicates: which of several rows in the same hour is kept: `first`,
+            `last` or `mean`.
+        - columns: the value columns, all numeric columns by default.
+    Returns:
+        - df: pandas.DataFrame with the `timestamp` column and the value columns.
+        - report: the gaps and duplicates of the data, see `find_gaps`.'''
+    if fill not in {'interpolate', 'ffill', 'zero', 'nan'}:
+        raise ValueError(f'Unknown fill policy: {fill}')
+    if duplicates not in {'first', 'last', 'mean'}:
+        raise ValueError(f'Unknown duplicate policy: {duplicates}')
+    if columns is None:
+        columns = [col for col in df.columns
+                   if col != 'timestamp' and pd.api.types.is_numeric_dtype(df[col])]
+
+    report = find_gaps(df['timestamp'])
+    hours = _to_wall_hours(df['timestamp'])
+    if hours.size == 0:
+        return df[['timestamp', *columns]].copy(), report
+
+    starts = np.flatnonzero(np.diff(hours, prepend=hours[0] - 1) != 0)
+    positions = hours[starts] - hours[0]
+    grid = np.arange(hours[0], hours[-1] + 1)
+    present = np.zeros(grid.size, dtype=bool)
+    present[positions] = True
+
+    regular = {'timestamp': grid.astype('datetime64[h]').astype('datetime64[ns]')}
+    for col in columns:
+        values = df[col].to_numpy(dtype=float)
+        if duplicates == 'first':
+            values = values[starts]
+        elif duplicates == 'last':
+            values = values[np.append(starts[1:], hours.size) - 1]
+        else:
+            values = (np.add.reduceat(values, starts) /
+                      np.diff(np.append(starts, hours.size)))
+
+        if fill == 'interpolate':
+            regular[col] = np.interp(grid - hours[0], positions, values)
+            continue
+        column = np.full(grid.size, np.nan)
+        column[positions] = values
+        if fill == 'ffill':
+            column = column[np.maximum.accumulate(
+                np.where(present, np.arange(grid.size), 0))]
+        elif fill == 'zero':
+            column[~present] = 0
+        regular[col] = column
+    return pd.DataFrame(regular), report
+
 def missing_datetimes(df: pd.DataFrame):
-    times = df['timestamp']
-    delta = timedelta(hours=1)
-    time = min(times)
-    missing = []
-    for idx, row in df.iterrows():
-        while time < row['timestamp']:
-            missing.append(time)
-            time += delta
-        time += delta
-    for miss in missing:
-        print(miss)
+    '''Prints the missing hours of the data.'''
+    report = find_gaps(df['timestamp'])
+    for start, length in zip(report['gap_starts'], report['gap_lengths']):
+        for miss in start + np.arange(length):
+            print(pd.Timestamp(miss))
 
 def sum_above_below(pnets, lower, upper):
     '''Calculates the sum of values in the pnets list above the upper limit
@@ -143,26 +548,156 @@ def sum_above_below(pnets, lower, upper):
             sumabove += pnet - upper
     return sumbelow, sumabove
 
-def calc_above_limit(powers: list) -> float:
+def calc_above_limit(powers, tdelta: float = 1) -> float:
     '''Computes the amount of power bought above the upper limit.
     Args:
-        - powers: list of tuples containing power related info. `timestamp`,
-            `pnet`, `pnought`, `soc`, `lowerlimt`, `upperlim`.
-    Returns: the total sum of power above the upper limit.'''
-    total = 0
-    for power in powers:
-        if power[2] > power[5]:
-            total += power[2] - power[5]
-    return total
-
-def calc_max_bought(powers: list) -> float:
+        - powers: `SimulationTrace`, or list of tuples containing power related
+            info. `timestamp`, `pnet`, `pnought`, `soc`, `lowerlimt`, `upperlim`.
+        - tdelta: length of a step in hours.
+    Returns: the total energy bought above the upper limit (in kWh).'''
+    pbought = _get_column(powers, 2)
+    upper = _get_column(powers, 5)
+    return float(np.sum(np.maximum(pbought - upper, 0))) * tdelta
+
+def calc_max_bought(powers) -> float:
     '''Calculates the maximum buoght power.
     Args:
-        - powers: list of tuples containing power related info. `timestamp`,
-            `pnet`, `pnought`, `soc`, `lowerlimt`, `upperlim`.
+        - powers: `SimulationTrace`, or list of tuples containing power related
+            info. `timestamp`, `pnet`, `pnought`, `soc`, `lowerlimt`, `upperlim`.
     Returns: the maximum bought power during the period.'''
-    max_bought = max(powers, key=itemgetter(2))[2]
-    return max_bought
+    return float(_get_column(powers, 2).max())
+
+class MetricsAccumulator:
+    '''Computes the metrics of a simulation step by step, without storing the
+    steps. The results are the same as the ones of `calc_fluctuation`,
+    `calc_periodic_fluctuation`, `calc_max_bought`, `calc_peak_power_sum` and
+    `calc_above_limit`. Only the last `2*delta+1` steps are kept for the peak
+    test, so the memory used does not depend on the length of the run.
+    Args:
+        - delta: half width of the window of the peak test, 10 hours by default.
+        - tdelta: length of a step in hours.'''
+
+    def __init__(self, delta: int = None, tdelta: float = 1) -> None:
+        self.delta = get_peak_window(tdelta) if delta is None else delta
+        self.tdelta = tdelta
+        delta = self.delta
+        self.window = deque(maxlen=2 * delta + 1)
+        self.count = 0
+        self.has_limits = False
+
+        self.prev_p = None
+        self.total_diff = 0
+        self.psum = 0
+        self.max_bought = -math.inf
+        self.sum_above_limit = 0
+
+        # state of the current period of the periodic fluctuation
+        self.prev_hour = None
+        self.day_prev_p = None
+        self.day_diff, self.day_psum, self.day_count = 0, 0, 0
+        self.fluct_sum, self.fluct_cnt = 0, 0
+
+        self.peak_sum, self.peak_count = 0, 0
+
+    def _is_peak(self, pos: int) -> bool:
+        '''Peak test of `find_peaks` for the step at position pos of the window.'''
+        curr_value, upper = self.window[pos]
+        if upper is None or curr_value <= upper:
+            return False
+        neighbours = max(self.window[i][0]
+                         for i in range(max(0, pos - self.delta),
+                                        min(len(self.window), pos + self.delta + 1))
+                         if i != pos)
+        close = (abs(curr_value - neighbours) <=
+                 1e-9 * max(abs(curr_value), abs(neighbours)))
+        return curr_value > neighbours and not close
+
+    def update(self, hour: int, pbought: float, upper: float = None):
+        '''Adds a step of the simulation.
+        Args:
+            - hour: hour of the day of the step.
+            - pbought: power bought from the grid (in kW).
+            - upper: upper limit of the step, if the simulation has limits.'''
+        if self.prev_p is not None:
+            self.total_diff += abs(pbought - self.prev_p)
+        self.prev_p = pbought
+        self.psum += pbought
+        self.max_bought = max(self.max_bought, pbought)
+
+        if upper is not None:
+            self.has_limits = True
+            self.sum_above_limit += max(pbought - upper, 0)
+
+        # a period ends with the last step of hour 23
+        if self.prev_hour == 23 and hour != 23:
+            self.fluct_sum += self._get_period_fluctuation()
+            self.fluct_cnt += 1
+            self.day_prev_p = None
+            self.day_diff, self.day_psum, self.day_count = 0, 0, 0
+        self.prev_hour = hour
+
+        self.day_psum += pbought
+        self.day_count += 1
+        if self.day_prev_p is not None:
+            self.day_diff += abs(pbought - self.day_prev_p)
+        self.day_prev_p = pbought
+
+        # the window is complete for the step delta steps ago, the first step
+        # can not be a peak
+        self.window.append((pbought, upper))
+        self.count += 1
+        if self.count - 1 - self.delta > 0:
+            self._add_peak(len(self.window) - 1 - self.delta)
+
+    def _get_period_fluctuation(self) -> float:
+        if self.day_psum == 0:
+            return 0
+        return self.day_diff / (self.day_psum / self.day_count)
+
+    def _add_peak(self, pos: int):
+        if self._is_peak(pos):
+            pbought, upper = self.window[pos]
+            self.peak_sum += pbought - upper
+            self.peak_count += 1
+
+    def extend(self, hours, pboughts, uppers=None):
+        '''Adds several steps of the simulation, see `update`.'''
+        if uppers is None:
+            uppers = [None] * len(pboughts)
+        for hour, pbought, upper in zip(np.asarray(hours).tolist(),
+                                        np.asarray(pboughts).tolist(),
+                                        np.asarray(uppers).tolist()):
+            self.update(hour, pbought, upper)
+
+    def get_metrics(self) -> dict:
+        '''Returns the metrics of the steps added so far, in the format of
+        `peak_shave_sim.objective`. The peak test of the last `delta` steps is
+        done with the shorter window at the end of the data.'''
+        peak_sum, peak_count = self.peak_sum, self.peak_count
+        offset = self.count - len(self.window)
+        # the last step can not be a peak
+        for center in range(max(1, self.count - self.delta), self.count - 1):
+            if self._is_peak(center - offset):
+                pbought, upper = self.window[center - offset]
+                peak_sum += pbought - upper
+                peak_count += 1
+
+        fluct_sum, fluct_cnt = self.fluct_sum, self.fluct_cnt
+        if self.prev_hour == 23:
+            fluct_sum += self._get_period_fluctuation()
+            fluct_cnt += 1
+
+        metrics = {
+            'fluctuation': self.total_diff / (self.psum / self.count),
+            'mean_periodic_fluctuation': (fluct_sum / fluct_cnt if fluct_cnt > 0
+                                          else math.nan),
+            'max_bought': self.max_bought,
+        }
+        if self.has_limits:
+            metrics['peak_power_sum'] = peak_sum
+            metrics['peak_power_count'] = peak_count
+            metrics['sum_above_limit'] = self.sum_above_limit * self.tdelta
+        return metrics
 
 def compute_limits(pnets, tolerance=2, margin=0.25, factor=1):
     '''Compute an upper and lower limit for which the area below the lower limits and
@@ -203,6 +738,76 @@ def compute_limits(pnets, tolerance=2, margin=0.25, factor=1):
 
     return lowerlimit * factor, upperlimit
 
+class ReserveTimeIndex:
+    '''Answers how many hours the stored energy would last from a given hour on,
+    using the cumulative sum of the demand and a binary search instead of
+    simulating the discharge forward. Every step drains the demand, capped at the
+    power the storage can deliver. This is an approximation of
+    `EnergyHub.compute_reserve_time`: self-discharge is not taken into account,
+    hours with negative net demand do not drain the storage, and the forward
+    simulation also counts the steps spent draining the residual soc that a
+    unit keeps when it cannot cover a whole step, so the reserve time is shorter.'''
+
+    def __init__(self, pnets, tdelta: float = 1, maxpower: float = math.inf):
+        '''Args:
+            - pnets: net power demand for every step of the dataset (in kW)
+            - tdelta: length of a step in hours, the reserve time is counted in
+                steps
+            - maxpower: the most power the storage can deliver in a step after
+                the discharge losses (in kW), e.g. the sum of `etadischarge *
+                maxdischarge` of the units'''
+        demand = np.clip(np.asarray(pnets, dtype=float), 0, maxpower) * tdelta
+        self.cumdemand = np.concatenate(([0], np.cumsum(demand)))
+
+    def reserve_time(self, idx: int, energy: float) -> int:
+        '''Computes the number of hours after which we still have energy left if
+        we cover the demand from hour idx on with the given energy.
+        Args:
+            - idx: the hour from which the demand is covered
+            - energy: the available stored energy (in kWh)
+        Returns:
+            - hours: how many hours would the energy last'''
+        if energy <= 0:
+            return 0
+        end = np.searchsorted(self.cumdemand, self.cumdemand[idx] + energy, side='left')
+        return int(end - idx - 1)
+
+class PriceIndex:
+    '''Range-minimum index over the electricity prices of a dataset. A sparse
+    table of argmins is built once, after which the cheapest hour of any window
+    is found in O(1).'''
+
+    def __init__(self, prices):
+        '''Args:
+            - prices: price of electricity for every hour of the dataset'''
+        self.prices = np.asarray(prices, dtype=float)
+        size = self.prices.size
+        # table[j][i] is the index of the cheapest hour in [i, i + 2^j)
+        self.table = [np.arange(size)]
+        width = 1
+        while 2 * width <= size:
+            prev = self.table[-1]
+            left, right = prev[:-width], prev[width:]
+            self.table.append(np.where(self.prices[left] <= self.prices[right],
+                                       left, right))
+            width *= 2
+
+    def __len__(self):
+        return self.prices.size
+
+    def argmin(self, start: int, end: int) -> int:
+        '''Returns the index of the cheapest hour in [start, end). In case of a
+        tie, the earliest hour is returned, like `np.argmin` does.'''
+        level = int(end - start).bit_length() - 1
+        left = self.table[level][start]
+        right = self.table[level][end - (1 << level)]
+        return int(left if self.prices[left] <= self.prices[right] else right)
+
+    def is_cheapest(self, idx: int, hours: int) -> bool:
+        '''Tells whether hour idx is the cheapest within the next `hours` hours.'''
+        end = min(idx + hours + 1, len(self))
+        return self.argmin(idx, end) == idx
+
 def test_compute_limits():
     df = process_file('../data/Sub71125.csv')
     pnets = list(df['net'][1:25])
@@ -218,6 +823,15 @@ if __name__ == '__main__':
     import numpy as np
     import matplotlib.pyplot as plt
 
+    class TestReserveTimeIndex(unittest.TestCase):
+        def test1(self):
+            pnets = [5, 5, -3, 5, 5]
+            self.assertEqual(ReserveTimeIndex(pnets).reserve_time(0, 2.5), 0)
+            # the storage delivers at most 1 kW, negative demand does not drain it
+            index = ReserveTimeIndex(pnets, maxpower=1)
+            self.assertEqual(index.reserve_time(0, 2.5), 3)
+            self.assertEqual(index.reserve_time(1, 0), 0)
+
     class TestPeakPowerSumCalculator(unittest.TestCase):
         def test1(self):
             x = np.arange(0, 10, 0.01)
@@ -266,6 +880,17 @@ if __name__ == '__main__':
             
             self.assertEqual(count, 0)
 
+        def test6(self):
+            # compare against is_peak, with plateaus and near-equal values
+            x = np.round(np.random.rand(1000) * 20)
+            x[::50] += 1e-12
+
+            c = np.zeros(x.size)
+            powers = np.array([x, x, x, c, c, c]).transpose()
+            expected = [is_peak(powers, idx, 10) for idx in range(x.size)]
+
+            self.assertEqual(list(find_peaks(x, 10)), expected)
+
     class TestFluctuationCalculator(unittest.TestCase):
         def test1(self):
             count = 100
@@ -289,6 +914,208 @@ if __name__ == '__main__':
             fcalc = calc_fluctuation(powers)
             self.assertAlmostEqual(fcalc, 0)
 
+    class TestSimulationTrace(unittest.TestCase):
+        def _get_trace(self, dtype=np.float64):
+            size = 24 * 7 + 5
+            timestamps = pd.date_range('2021-01-01 03:00', periods=size, freq='h')
+            values = np.random.rand(4, size) * 10
+            return SimulationTrace(timestamps, *values, values[2] * 0 + 5, dtype=dtype)
+
+        def test1(self):
+            trace = self._get_trace()
+            powers = trace.to_powers()
+            self.assertEqual(len(powers), len(trace))
+            self.assertEqual(powers[7], trace[7])
+
+            restored = SimulationTrace.from_powers(powers)
+            for name in SimulationTrace.columns:
+                self.assertTrue(np.array_equal(getattr(restored, name),
+                                               getattr(trace, name)))
+
+        def test2(self):
+            # the vectorized metrics give the same results as the legacy loops
+            trace = self._get_trace()
+            powers = trace.to_powers()
+
+            prev_p, total_diff, psum, count = None, 0, 0, 0
+            fluct_sum, fluct_cnt = 0, 0
+            for power in powers:
+                psum += power[2]
+                count += 1
+                if prev_p is not None:
+                    total_diff += abs(power[2] - prev_p)
+                prev_p = power[2]
+                if power[0].hour == 23:
+                    fluct_sum += total_diff / (psum / count)
+                    fluct_cnt += 1
+                    prev_p, total_diff, psum, count = None, 0, 0, 0
+
+            self.assertAlmostEqual(calc_periodic_fluctuation(trace),
+                                   fluct_sum / fluct_cnt)
+            self.assertAlmostEqual(calc_periodic_fluctuation(powers),
+                                   fluct_sum / fluct_cnt)
+            self.assertAlmostEqual(calc_above_limit(trace),
+                                   sum(max(p[2] - p[5], 0) for p in powers))
+            self.assertEqual(calc_max_bought(trace), max(p[2] for p in powers))
+            self.assertAlmostEqual(calc_fluctuation(trace), calc_fluctuation(powers))
+            self.assertEqual(calc_peak_power_sum(trace), calc_peak_power_sum(powers))
+
+        def test3(self):
+            trace = self._get_trace(np.float32)
+            self.assertEqual(trace.pbought.dtype, np.float32)
+            self.assertAlmostEqual(calc_fluctuation(trace),
+                                   calc_fluctuation(trace.to_powers()), places=4)
+
+    class TestMetricsAccumulator(unittest.TestCase):
+        def test1(self):
+            # same metrics as computing them on the trace afterwards
+            size = 24 * 10 + 7
+            timestamps = pd.date_range('2021-01-01 05:00', periods=size, freq='h')
+            pboughts = np.round(np.random.rand(size) * 20)
+            uppers = np.full(size, 12.)
+            trace = SimulationTrace(timestamps, pboughts, pboughts, pboughts, uppers,
+                                    uppers)
+
+            accumulator = MetricsAccumulator()
+            accumulator.extend(trace.get_hours(), pboughts[:100], uppers[:100])
+            for idx in range(100, size):
+                accumulator.update(trace.get_hours()[idx], pboughts[idx], uppers[idx])
+            metrics = accumulator.get_metrics()
+
+            ppsum, ppcount = calc_peak_power_sum(trace)
+            self.assertAlmostEqual(metrics['fluctuation'], calc_fluctuation(trace))
+            self.assertAlmostEqual(metrics['mean_periodic_fluctuation'],
+                                   calc_periodic_fluctuation(trace))
+            self.assertEqual(metrics['max_bought'], calc_max_bought(trace))
+            self.assertAlmostEqual(metrics['peak_power_sum'], ppsum)
+            self.assertEqual(metrics['peak_power_count'], ppcount)
+            self.assertAlmostEqual(metrics['sum_above_limit'], calc_above_limit(trace))
+
+        def test2(self):
+            # 15 minute steps
+            size = 96 * 5 + 13
+            timestamps = pd.date_range('2021-01-01 05:00', periods=size, freq='15min')
+            pboughts = np.round(np.random.rand(size) * 20)
+            uppers = np.full(size, 12.)
+            trace = SimulationTrace(timestamps, pboughts, pboughts, pboughts, uppers,
+                                    uppers)
+            tdelta = infer_tdelta(timestamps)
+            self.assertEqual(tdelta, .25)
+            self.assertEqual(get_peak_window(tdelta), 40)
+
+            accumulator = MetricsAccumulator(tdelta=tdelta)
+            accumulator.extend(trace.get_hours(), pboughts, uppers)
+            metrics = accumulator.get_metrics()
+
+            ppsum, ppcount = calc_peak_power_sum(trace, tdelta)
+            self.assertAlmostEqual(metrics['mean_periodic_fluctuation'],
+                                   calc_periodic_fluctuation(trace))
+            self.assertAlmostEqual(metrics['peak_power_sum'], ppsum)
+            self.assertEqual(metrics['peak_power_count'], ppcount)
+            self.assertAlmostEqual(metrics['sum_above_limit'],
+                                   calc_above_limit(trace, tdelta))
+            self.assertAlmostEqual(metrics['sum_above_limit'],
+                                   tdelta * np.sum(np.maximum(pboughts - uppers, 0)))
+
+    class TestProcessFileCache(unittest.TestCase):
+        def test1(self):
+            import tempfile
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fname = os.path.join(tmpdir, 'short.csv')
+                with open(fname, 'w') as file:
+                    file.write('timestamp,PV (kWh),Load (kWh),price (cents/kWh)\n'
+                               '01012011 0:00,0,2667,43.17\n'
+                               '01012011 1:00,5,2591,41.20\n')
+                cachedir = os.path.join(tmpdir, '.cache')
+                expected = process_file(fname, use_cache=False)[list(CACHE_COLUMNS)]
+
+                df = process_file(fname, cachedir=cachedir)
+                self.assertEqual(len(os.listdir(cachedir)), 1)
+                pd.testing.assert_frame_equal(df, expected)
+                pd.testing.assert_frame_equal(process_file(fname, cachedir=cachedir),
+                                              expected)
+
+                # a changed file replaces the cache
+                with open(fname, 'a') as file:
+                    file.write('01012011 2:00,7,2500,40.00\n')
+                self.assertEqual(len(process_file(fname, cachedir=cachedir)), 3)
+                self.assertEqual(len(os.listdir(cachedir)), 1)
+
+                # only the other versions of the same file are removed
+                other = os.path.join(cachedir, 'short.csv.gz.' + '0' * 40 + '.npz')
+                open(other, 'w').close()
+                with open(fname, 'a') as file:
+                    file.write('01012011 3:00,7,2400,40.00\n')
+                self.assertEqual(len(process_file(fname, cachedir=cachedir)), 4)
+                self.assertEqual(sorted(os.listdir(cachedir)),
+                                 sorted([os.path.basename(other),
+                                         f'short.csv.{_file_digest(fname)}.npz']))
+
+    class TestMergedFiles(unittest.TestCase):
+        def test1(self):
+            # same rows as concatenating, sorting and dropping the duplicates
+            import tempfile
+            timestamps = pd.date_range('2011-01-01', periods=60, freq='h')
+            rows = [f'{time:%m%d%Y %H:%M},{idx % 3},{100 + idx},{idx % 5}.5'
+                    for idx, time in enumerate(timestamps)]
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fnames = []
+                for idx, (start, end) in enumerate([(0, 30), (20, 45), (10, 60)]):
+                    fnames.append(os.path.join(tmpdir, f'{idx}_short.csv'))
+                    with open(fnames[-1], 'w') as file:
+                        file.write('timestamp,PV (kWh),Load (kWh),price (cents/kWh)\n')
+                        file.write('\n'.join(rows[start:end]) + '\n')
+                # a row that differs from the others at the same time is kept
+                with open(fnames[0], 'a') as file:
+                    file.write(rows[29].replace(',129,', ',128,') + '\n')
+
+                expected = (pd.concat([process_file(fname, use_cache=False)
+                                       for fname in fnames])[list(CACHE_COLUMNS)]
+                            .astype({'net': float, 'price (cents/kWh)': float})
+                            .sort_values('timestamp', kind='stable')
+                            .drop_duplicates()
+                            .reset_index(drop=True))
+                df = get_merged_dfs(*fnames, chunksize=7)
+
+            self.assertEqual(len(df), 61)
+            pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+
+    class TestRegularizeHourly(unittest.TestCase):
+        def test1(self):
+            timestamps = pd.to_datetime(['2021-03-28 00:00', '2021-03-28 01:00',
+                                         '2021-03-28 01:00', '2021-03-28 04:00',
+                                         '2021-03-28 05:30'])
+            df = pd.DataFrame({'timestamp': timestamps,
+                               'net': [1., 2., 4., 8., 10.]})
+
+            report = find_gaps(df['timestamp'])
+            self.assertEqual(report['duplicates'], 1)
+            self.assertEqual(report['missing'], 2)
+            self.assertEqual(list(report['gap_lengths']), [2])
+            self.assertEqual(report['gap_starts'][0], np.datetime64('2021-03-28T02', 'h'))
+
+            expected = {
+                ('interpolate', 'first'): [1, 2, 4, 6, 8, 10],
+                ('ffill', 'last'): [1, 4, 4, 4, 8, 10],
+                ('zero', 'mean'): [1, 3, 0, 0, 8, 10],
+            }
+            for (fill, duplicates), values in expected.items():
+                regular, _ = regularize_hourly(df, fill, duplicates)
+                self.assertEqual(list(regular['net']), values)
+                self.assertTrue(np.all(np.diff(regular['timestamp']) ==
+                                       np.timedelta64(1, 'h')))
+
+            regular, _ = regularize_hourly(df, 'nan')
+            self.assertEqual(int(regular['net'].isna().sum()), 2)
+
+        def test2(self):
+            # hourly UTC data skips 02:00 in wall-clock time at the DST change
+            timestamps = pd.date_range('2021-03-28 00:00', periods=4, freq='h',
+                                       tz='UTC').tz_convert('Europe/Budapest')
+            report = find_gaps(timestamps)
+            self.assertEqual(report['missing'], 1)
+            self.assertEqual(report['gap_starts'][0], np.datetime64('2021-03-28T02', 'h'))
+
     unittest.main()
 
 def chop(val, to=0, delta=1e-10):